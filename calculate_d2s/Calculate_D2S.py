@@ -2,13 +2,46 @@
 from itertools import groupby
 from D2S_tools import *
 import math
+import numpy as np
 import logging
+import multiprocessing
 import argparse
 import sys
 DESCRIPTION = '''
 Calculate the D2S score between two Kmer sets.
+
+With --measures, several distances are calculated in one merge over both Kmer sets and
+written as one row with a column per measure, after a '#' header row:
+    D2S     -log of the normalised D2S score (the default distance)
+    D2      (1 - D2/sqrt(D2_11*D2_22))/2, from the raw kmer counts
+    D2star  (1 - D2*/sqrt(D2*_11*D2*_22))/2, residuals scaled by the expected counts
+    CVTree  (1 - cosine)/2 of the relative residuals (count - expected)/expected
+    Jaccard 1 - shared kmers/all kmers
+    Mash    -log(2J/(1+J))/k of the Jaccard index J
+The expected counts (NumKmers*Pw) come from the character frequencies. The cross terms
+are summed over the shared Kmers and the self terms over the Kmers of each set.
+
+Canonical Kmer sets (each kmer collapsed with its reverse complement, e.g. jellyfish count -C
+or Convert_Kmer_Profile.py --canonical) are scored with the canonical probability model
+Pw + P(reverse complement of w). Binary kmer profiles record if they are canonical, text
+Kmer sets need --canonical.
+
+Kmer sets filtered by count (--min_count/--max_count) are scored without the removed Kmers.
+NumKmers still comes from the character frequencies, so it includes the removed Kmers and
+the expected counts of the kept Kmers are the same as without filtering.
 '''
 
+# Largest --prefix_bases accepted (4^10 ~ 1M shards).
+MAX_PREFIX_BASES = 10
+
+# Distances --measures can calculate.
+MEASURES = ('D2S', 'D2', 'D2star', 'CVTree', 'Jaccard', 'Mash')
+
+# Sums collected by calculate_Measure_Statistics, in order.
+MEASURE_STATISTICS = ('num_kmers1', 'num_kmers2', 'num_shared',
+                      'D2', 'D2_1', 'D2_2', 'D2S', 'D2S_1', 'D2S_2',
+                      'D2star', 'D2star_1', 'D2star_2', 'CVTree', 'CVTree_1', 'CVTree_2')
+
 # Pass arguments.
 
 
@@ -17,17 +50,29 @@ def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
     parser.add_argument('--kmerset1', metavar='KmerSet1.21mers.gz', type=lambda x: check_file_exists(x),
-                        required=True, help='Kmers for dataset 1, can be gziped')
+                        required=True, help='Kmers for dataset 1, can be gziped or a binary kmer profile (.nkp)')
     parser.add_argument('--kmerset1_freq', metavar='KmerSet1.21mers.charFreq', type=lambda x: check_file_exists(x),
                         required=True, help='Character frequency for dataset 1, can be gziped')
 
     parser.add_argument('--kmerset2', metavar='KmerSet2.21mers.gz',
-                        type=lambda x: check_file_exists(x), required=True, help='Kmer for dataset 2, can be gziped')
+                        type=lambda x: check_file_exists(x), required=True, help='Kmer for dataset 2, can be gziped or a binary kmer profile (.nkp)')
     parser.add_argument('--kmerset2_freq', metavar='KmerSet2.21mers.charFreq', type=lambda x: check_file_exists(x),
                         required=True, help='Character frequency for dataset 2, can be gziped')
 
     parser.add_argument('--D2S_out', metavar='D2S.txt', type=lambda x: write_file_check_compression(
         x), required=False, default=sys.stdout, help='Output for D2S score (default: %(default)s)')
+    parser.add_argument('--single_pass', action='store_true', required=False, default=False,
+                        help='Calculate the cross and self scores in one pass over both Kmer sets (default: %(default)s)')
+    parser.add_argument('--threads', metavar='N', type=int, required=False, default=1,
+                        help='Number of processes scoring prefix shards of the Kmer space, binary kmer profiles only (default: %(default)s)')
+    parser.add_argument('--prefix_bases', metavar='P', type=int, required=False, default=None,
+                        help='Shard the Kmer space by the first P bases, giving 4^P shards (default: enough for 16 shards per process)')
+    parser.add_argument('--measures', metavar='D2S,D2,Mash', type=lambda x: check_measures(x), required=False, default=['D2S'],
+                        help='Comma separated distances to calculate in one pass, from: %s (default: D2S)' % ','.join(MEASURES))
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='The text Kmer sets hold canonical kmers, binary kmer profiles record this themselves (default: %(default)s)')
+    parser.add_argument('--no_self_cache', action='store_true', required=False, default=False,
+                        help='Always recompute the self scores instead of using the cached ones (default: %(default)s)')
     parser.add_argument('--debug', action='store_true', required=False, default=False,
                         help='Print DEBUG info (default: %(default)s)')
     args = parser.parse_args()
@@ -43,20 +88,82 @@ def main():
 
     logger.debug('%s', args)  # DEBUG
 
-    d2Score_kmerset1_VS_kmerset2 = calculate_D2S(
-        args.kmerset1, args.kmerset1_freq, args.kmerset2, args.kmerset2_freq, logger)
+    use_cache = not args.no_self_cache
+
+    # Both Kmer sets have to be scored with the same probability model.
+    canonical = check_canonical_Kmer_sets(
+        args.kmerset1, args.kmerset2, args.canonical, logger)
+    model = Self_Score_model(canonical)
+
+    for kmerset, kmerset_freq in ((args.kmerset1, args.kmerset1_freq), (args.kmerset2, args.kmerset2_freq)):
+        check_Kmer_Filter(kmerset, kmerset_freq, logger)
+
+    if args.measures != ['D2S']:
+        if args.threads > 1:
+            logger.warning('--threads is not supported with --measures, '
+                           'scoring serially')  # WARNING
+
+        distances = calculate_Measures(args.kmerset1, args.kmerset1_freq,
+                                       args.kmerset2, args.kmerset2_freq, args.measures, logger, use_cache=use_cache, canonical=canonical)
+
+        args.D2S_out.write('#kmerset1;kmerset2;' + ';'.join(args.measures) + '\n')
+        args.D2S_out.write(args.kmerset1 + ';' + args.kmerset2 + ';' +
+                           ';'.join(str(distances[measure]) for measure in args.measures) + '\n')
+        args.D2S_out.flush()
+        args.D2S_out.close()
+        return
+
+    # Prefix shards are slices of the memory-mapped profiles, text Kmer sets are scored serially.
+    sharded = args.threads > 1 and is_Kmer_profile(
+        args.kmerset1) and is_Kmer_profile(args.kmerset2)
+    if args.threads > 1 and not sharded:
+        logger.warning('--threads needs binary kmer profiles for both datasets, '
+                       'scoring serially')  # WARNING
+
+    # The self scores only depend on one dataset, so they are cached next to the Kmer sets.
+    d2Score_kmerset1_VS_kmerset1 = load_Self_Score(
+        args.kmerset1, args.kmerset1_freq, model=model) if use_cache else None
+    d2Score_kmerset2_VS_kmerset2 = load_Self_Score(
+        args.kmerset2, args.kmerset2_freq, model=model) if use_cache else None
+
+    if args.single_pass and (d2Score_kmerset1_VS_kmerset1 is None or d2Score_kmerset2_VS_kmerset2 is None):
+        # One merge over both files gives all three scores.
+        if sharded:
+            d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2 = calculate_D2S_Sharded(
+                args.kmerset1, args.kmerset1_freq, args.kmerset2, args.kmerset2_freq, logger,
+                args.threads, prefix_bases=args.prefix_bases, single_pass=True, canonical=canonical)
+        else:
+            d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2 = calculate_D2S_Single_Pass(
+                args.kmerset1, args.kmerset1_freq, args.kmerset2, args.kmerset2_freq, logger, canonical=canonical)
+
+        if use_cache:
+            for kmerset, kmerset_freq, d2Score in ((args.kmerset1, args.kmerset1_freq, d2Score_kmerset1_VS_kmerset1),
+                                                   (args.kmerset2, args.kmerset2_freq, d2Score_kmerset2_VS_kmerset2)):
+                if not save_Self_Score(kmerset, kmerset_freq, d2Score, model=model):
+                    logger.warning('Could not cache the self score for %s',
+                                   kmerset)  # WARNING
+    else:
+        if sharded:
+            d2Score_kmerset1_VS_kmerset2 = calculate_D2S_Sharded(
+                args.kmerset1, args.kmerset1_freq, args.kmerset2, args.kmerset2_freq, logger,
+                args.threads, prefix_bases=args.prefix_bases, canonical=canonical)[0]
+        else:
+            d2Score_kmerset1_VS_kmerset2 = calculate_D2S(
+                args.kmerset1, args.kmerset1_freq, args.kmerset2, args.kmerset2_freq, logger, canonical=canonical)
+
+        if d2Score_kmerset1_VS_kmerset1 is None:
+            d2Score_kmerset1_VS_kmerset1 = calculate_D2S_Self_Score(
+                args.kmerset1, args.kmerset1_freq, logger, use_cache=use_cache, canonical=canonical)
+        if d2Score_kmerset2_VS_kmerset2 is None:
+            d2Score_kmerset2_VS_kmerset2 = calculate_D2S_Self_Score(
+                args.kmerset2, args.kmerset2_freq, logger, use_cache=use_cache, canonical=canonical)
+
     logger.info('kmerset1 VS. kmerset2 d2Score:%s',
                 d2Score_kmerset1_VS_kmerset2)  # INFO
-
-    d2Score_kmerset1_VS_kmerset1 = calculate_D2S(
-        args.kmerset1, args.kmerset1_freq, args.kmerset1, args.kmerset1_freq, logger)
     logger.info('kmerset1 VS. kmerset1 d2Score:%s',
-                d2Score_kmerset1_VS_kmerset2)  # INFO
-
-    d2Score_kmerset2_VS_kmerset2 = calculate_D2S(
-        args.kmerset2, args.kmerset2_freq, args.kmerset2, args.kmerset2_freq, logger)
+                d2Score_kmerset1_VS_kmerset1)  # INFO
     logger.info('kmerset2 VS. kmerset2 d2Score:%s',
-                d2Score_kmerset1_VS_kmerset2)  # INFO
+                d2Score_kmerset2_VS_kmerset2)  # INFO
 
     D2S_distance = d2ScoreNormalization(
         d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2)
@@ -73,6 +180,70 @@ def main():
     args.D2S_out.close()
 
 
+def check_measures(measures):
+    '''
+    Splits and checks the --measures argument.
+    '''
+    measures = [measure.strip() for measure in measures.split(',') if measure.strip()]
+
+    for measure in measures:
+        if measure not in MEASURES:
+            raise argparse.ArgumentTypeError('Unknown measure %s, choose from: %s' %
+                                             (measure, ','.join(MEASURES)))
+
+    if not measures:
+        raise argparse.ArgumentTypeError('No measures given')
+
+    return measures
+
+
+def check_canonical_Kmer_sets(KmerSet1_fileName, KmerSet2_fileName, canonical, logger):
+    '''
+    Checks that both Kmer sets are canonical or both are not (see is_canonical_Kmer_set).
+
+    Returns True if the Kmer sets are canonical.
+    '''
+    KmerSet1_canonical = is_canonical_Kmer_set(KmerSet1_fileName, canonical)
+    KmerSet2_canonical = is_canonical_Kmer_set(KmerSet2_fileName, canonical)
+
+    if KmerSet1_canonical != KmerSet2_canonical:
+        logger.error('Only one of the datasets is canonical, use --canonical for canonical text Kmer sets: %s:%s\t%s:%s',
+                     KmerSet1_fileName, KmerSet1_canonical, KmerSet2_fileName, KmerSet2_canonical)  # ERROR
+        sys.exit(1)
+
+    return KmerSet1_canonical
+
+
+def check_Kmer_Filter(KmerSet_fileName, KmerSet_freq_fileName, logger):
+    '''
+    Checks that the kept and removed Kmers of a profile filtered by count add up to
+    at most the NumKmers of its character frequencies, i.e. that they describe the
+    same dataset.
+    '''
+    if not is_Kmer_profile(KmerSet_fileName):
+        return
+
+    profile = load_Kmer_profile(KmerSet_fileName)
+    if 'removed_total_count' not in profile.metadata:
+        return
+
+    kmerset_freq, kmerset_NumKmers = load_Kmer_Background(
+        KmerSet_freq_fileName, profile.k, logger)
+    logger.info('%s: kept Kmers counted [%s, %s] times, removed %s Kmers (total count %s)', KmerSet_fileName,
+                profile.metadata['min_count'], profile.metadata['max_count'],
+                profile.metadata['removed_num_kmers'], profile.metadata['removed_total_count'])  # INFO
+
+    # Sketches only hold a sample of the kept Kmers.
+    total_count = profile.metadata['removed_total_count']
+    if not profile.flags & FLAG_SKETCH:
+        total_count += profile.total_count
+
+    if total_count > kmerset_NumKmers:
+        logger.warning('%s counts %s Kmers but %s only allows for %s, the character frequencies '
+                       'do not match the Kmer set', KmerSet_fileName, total_count,
+                       KmerSet_freq_fileName, kmerset_NumKmers)  # WARNING
+
+
 def d2ScoreNormalization(d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2):
     '''
     Function used to normalize the D2score -> creates a distance.
@@ -93,85 +264,518 @@ def d2ScoreNormalization(d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmers
     return D2S_distance
 
 
-def calculate_D2S(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger):
+def calculate_D2S(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=False):
+
+    k, KmerSet1_chunks, KmerSet2_chunks = open_Kmer_Set_Pair(
+        KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=canonical)
+
+    d2Score = 0.0
+
+    # We are only interested in Kmers that are shared between both sets.
+    for KmerSet1_codes, KmerSet1_residuals, KmerSet2_codes, KmerSet2_residuals in merge_Kmer_chunks(KmerSet1_chunks, KmerSet2_chunks):
+
+        d2Score_tmp = calculate_D2S_Shared(KmerSet1_codes, KmerSet1_residuals,
+                                           KmerSet2_codes, KmerSet2_residuals)
+        d2Score += d2Score_tmp
+
+        logger.debug('KmerSet1 Kmers:%s\tKmerSet2 Kmers:%s\td2Score:%s',
+                     len(KmerSet1_codes), len(KmerSet2_codes), d2Score_tmp)  # DEBUG
+
+    return d2Score
+
+
+def calculate_D2S_Single_Pass(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger,
+                              canonical=False):
+    '''
+    Calculate the kmerset1 VS. kmerset2, kmerset1 VS. kmerset1 and kmerset2 VS. kmerset2
+    d2Scores in one full outer merge of both Kmer sets, so each file is only read once.
+    '''
+    k, KmerSet1_chunks, KmerSet2_chunks = open_Kmer_Set_Pair(
+        KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=canonical)
+
+    d2Score_kmerset1_VS_kmerset2 = 0.0
+    d2Score_kmerset1_VS_kmerset1 = 0.0
+    d2Score_kmerset2_VS_kmerset2 = 0.0
+
+    # Every Kmer of both sets is seen exactly once by the merge.
+    for KmerSet1_codes, KmerSet1_residuals, KmerSet2_codes, KmerSet2_residuals in merge_Kmer_chunks(KmerSet1_chunks, KmerSet2_chunks):
+
+        d2Score_kmerset1_VS_kmerset2 += calculate_D2S_Shared(KmerSet1_codes, KmerSet1_residuals,
+                                                             KmerSet2_codes, KmerSet2_residuals)
+        d2Score_kmerset1_VS_kmerset1 += calculate_D2S_Self(KmerSet1_residuals)
+        d2Score_kmerset2_VS_kmerset2 += calculate_D2S_Self(KmerSet2_residuals)
+
+    return d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2
+
+
+def calculate_D2S_Sharded(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger,
+                          threads, prefix_bases=None, single_pass=False, canonical=False):
+    '''
+    Calculate the d2Scores of two binary kmer profiles with a pool of processes.
+
+    Both profiles are sorted, so the Kmers starting with the same prefix_bases bases
+    are a contiguous slice of each profile and every prefix shard can be scored on
+    its own. The partial sums are added up in prefix order, so the result does not
+    depend on the order the workers finish in.
+
+    Returns the kmerset1 VS. kmerset2, kmerset1 VS. kmerset1 and kmerset2 VS. kmerset2
+    d2Scores (the self scores are only calculated with single_pass, otherwise 0.0).
+    '''
+    KmerSet1_profile = load_Kmer_profile(KmerSet1_fileName)
+    KmerSet2_profile = load_Kmer_profile(KmerSet2_fileName)
+
+    # Check if the kmer_seq's are the same size.
+    if KmerSet1_profile.k != KmerSet2_profile.k:
+        logger.error('Kmer sizes are different between the two datasets: %s:%s\t%s:%s',
+                     KmerSet1_fileName, KmerSet1_profile.k, KmerSet2_fileName, KmerSet2_profile.k)  # ERROR
+        sys.exit(1)
+
+    k = KmerSet1_profile.k
+    logger.info('k-mer:%s', k)  # DEBUG
+
+    # Enough shards to keep every process busy when they are uneven in size.
+    if prefix_bases is None:
+        prefix_bases = 0
+        while 4 ** prefix_bases < 16 * threads and prefix_bases < k:
+            prefix_bases += 1
+
+    # Every one of the 4^prefix_bases shards gets a bound, so keep the table small.
+    if not 0 <= prefix_bases <= min(k, MAX_PREFIX_BASES):
+        logger.error('--prefix_bases has to be between 0 and %s: %s',
+                     min(k, MAX_PREFIX_BASES), prefix_bases)  # ERROR
+        sys.exit(1)
+
+    # Check the precomputed residuals here once, rather than in every worker.
+    KmerSet1_residuals = has_Kmer_Residuals(KmerSet1_fileName, KmerSet1_freq_fileName, logger, canonical=canonical)
+    KmerSet2_residuals = has_Kmer_Residuals(KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=canonical)
+
+    KmerSet1_bounds = Kmer_prefix_bounds(KmerSet1_profile.codes, k, prefix_bases)
+    KmerSet2_bounds = Kmer_prefix_bounds(KmerSet2_profile.codes, k, prefix_bases)
+
+    shards = []
+    for prefix in range(4 ** prefix_bases):
+        KmerSet1_slice = (int(KmerSet1_bounds[prefix]), int(KmerSet1_bounds[prefix + 1]))
+        KmerSet2_slice = (int(KmerSet2_bounds[prefix]), int(KmerSet2_bounds[prefix + 1]))
+
+        KmerSet1_empty = KmerSet1_slice[0] == KmerSet1_slice[1]
+        KmerSet2_empty = KmerSet2_slice[0] == KmerSet2_slice[1]
+
+        # Without the self scores a shard only counts if both sets have Kmers in it.
+        if (KmerSet1_empty and KmerSet2_empty) or (not single_pass and (KmerSet1_empty or KmerSet2_empty)):
+            continue
+
+        shards.append((KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet1_slice, KmerSet1_residuals,
+                       KmerSet2_fileName, KmerSet2_freq_fileName, KmerSet2_slice, KmerSet2_residuals,
+                       single_pass, canonical))
+
+    logger.info('Scoring %s of %s prefix shards (prefix_bases:%s) with %s processes',
+                len(shards), 4 ** prefix_bases, prefix_bases, threads)  # INFO
+
+    pool = multiprocessing.Pool(threads, initializer=init_D2S_Shard_Worker,
+                                initargs=(logger.getEffectiveLevel(),))
+    try:
+        shard_scores = pool.map(calculate_D2S_Shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    d2Score_kmerset1_VS_kmerset2 = 0.0
+    d2Score_kmerset1_VS_kmerset1 = 0.0
+    d2Score_kmerset2_VS_kmerset2 = 0.0
+
+    for d2Score_xy, d2Score_xx, d2Score_yy in shard_scores:
+        d2Score_kmerset1_VS_kmerset2 += d2Score_xy
+        d2Score_kmerset1_VS_kmerset1 += d2Score_xx
+        d2Score_kmerset2_VS_kmerset2 += d2Score_yy
+
+    return d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2
+
+
+def calculate_Measures(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName,
+                       measures, logger, use_cache=True, canonical=False):
+    '''
+    Calculate several distances between two Kmer sets in one full outer merge. Each
+    piece of the merge only adds to the sums in MEASURE_STATISTICS, and the distances
+    are calculated from the sums at the end. With use_cache the D2S self scores are
+    saved to the self score cache as well.
+
+    Returns a dict of measure -> distance.
+    '''
+    KmerSet1_k, KmerSet1_chunks = open_Kmer_Expected(
+        KmerSet1_fileName, KmerSet1_freq_fileName, logger, canonical=canonical)
+    KmerSet2_k, KmerSet2_chunks = open_Kmer_Expected(
+        KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=canonical)
+
+    # Check if the kmer_seq's are the same size.
+    if KmerSet1_k != KmerSet2_k:
+        logger.error('Kmer sizes are different between the two datasets: %s:%s\t%s:%s',
+                     KmerSet1_fileName, KmerSet1_k, KmerSet2_fileName, KmerSet2_k)  # ERROR
+        sys.exit(1)
+
+    k = KmerSet1_k
+    logger.info('k-mer:%s', k)  # DEBUG
+
+    statistics = np.zeros(len(MEASURE_STATISTICS))
+    for KmerSet1_codes, KmerSet1_values, KmerSet2_codes, KmerSet2_values in merge_Kmer_chunks(KmerSet1_chunks, KmerSet2_chunks):
+        statistics += calculate_Measure_Statistics(KmerSet1_codes, KmerSet1_values,
+                                                   KmerSet2_codes, KmerSet2_values)
+
+    statistics = dict(zip(MEASURE_STATISTICS, statistics.tolist()))
+    logger.debug('%s', statistics)  # DEBUG
+
+    if use_cache:
+        for kmerset, kmerset_freq, d2Score in ((KmerSet1_fileName, KmerSet1_freq_fileName, statistics['D2S_1']),
+                                               (KmerSet2_fileName, KmerSet2_freq_fileName, statistics['D2S_2'])):
+            if not save_Self_Score(kmerset, kmerset_freq, d2Score, model=Self_Score_model(canonical)):
+                logger.warning('Could not cache the self score for %s',
+                               kmerset)  # WARNING
+
+    distances = {}
+    for measure in measures:
+        distances[measure] = calculate_Measure_Distance(measure, statistics, k)
+        logger.info('%s_distance:%s', measure, distances[measure])  # INFO
+
+    return distances
+
+
+def calculate_Measure_Statistics(KmerSet1_codes, KmerSet1_values, KmerSet2_codes, KmerSet2_values):
+    '''
+    The MEASURE_STATISTICS sums of one piece of the merge. The values columns are the
+    counts, expected counts and residuals of each Kmer (see open_Kmer_Expected).
+    '''
+    KmerSet1_values = np.reshape(KmerSet1_values, (-1, 3))
+    KmerSet2_values = np.reshape(KmerSet2_values, (-1, 3))
+
+    KmerSet1_shared, KmerSet2_shared = intersect_Kmer_codes(
+        KmerSet1_codes, KmerSet2_codes)
+
+    statistics = [len(KmerSet1_codes), len(KmerSet2_codes), len(KmerSet1_shared)]
+
+    # D2 from the counts, D2S from the residuals.
+    X, Y = KmerSet1_values[:, 0], KmerSet2_values[:, 0]
+    statistics += [np.dot(X[KmerSet1_shared], Y[KmerSet2_shared]), np.dot(X, X), np.dot(Y, Y)]
+    statistics += [calculate_D2S_Shared(KmerSet1_codes, KmerSet1_values[:, 2], KmerSet2_codes, KmerSet2_values[:, 2]),
+                   calculate_D2S_Self(KmerSet1_values[:, 2]), calculate_D2S_Self(KmerSet2_values[:, 2])]
+
+    # D2* scales the residuals by the square root of the expected counts, CVTree by the expected counts.
+    for scale in (np.sqrt, lambda expected: expected):
+        X = KmerSet1_values[:, 2] / scale(KmerSet1_values[:, 1])
+        Y = KmerSet2_values[:, 2] / scale(KmerSet2_values[:, 1])
+        statistics += [np.dot(X[KmerSet1_shared], Y[KmerSet2_shared]), np.dot(X, X), np.dot(Y, Y)]
+
+    return np.array(statistics, dtype=np.float64)
+
+
+def calculate_Measure_Distance(measure, statistics, k):
+    '''
+    Turns the MEASURE_STATISTICS sums into the distance of one measure.
+    '''
+    if measure == 'D2S':
+        return d2ScoreNormalization(statistics['D2S'], statistics['D2S_1'], statistics['D2S_2'])
+
+    if measure in ('Jaccard', 'Mash'):
+        union = statistics['num_kmers1'] + statistics['num_kmers2'] - statistics['num_shared']
+        jaccard = statistics['num_shared'] / union if union else 0.0
+
+        if measure == 'Jaccard':
+            return 1.0 - jaccard
+
+        # Nothing shared is as far apart as Mash distances go.
+        if jaccard == 0:
+            return 1.0
+        return -math.log(2 * jaccard / (1 + jaccard)) / k
+
+    # D2, D2star and CVTree are all cosine dissimilarities.
+    norm = math.sqrt(statistics[measure + '_1'] * statistics[measure + '_2'])
+    if norm == 0:
+        return 1.0
+    return (1.0 - statistics[measure] / norm) / 2
+
+
+def init_D2S_Shard_Worker(level):
+    '''
+    Keeps the workers from repeating the INFO messages of every shard.
+    '''
+    logging.getLogger(__name__).setLevel(max(level, logging.WARNING))
+
+
+def calculate_D2S_Shard(shard):
+    '''
+    Pool worker scoring one prefix shard. The profiles are reopened (memory-mapped)
+    from their file names so nothing large is sent between processes. Whether to
+    use the precomputed residuals was already checked by calculate_D2S_Sharded.
+
+    Returns the three partial d2Scores of the shard.
+    '''
+    (KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet1_slice, KmerSet1_residuals,
+     KmerSet2_fileName, KmerSet2_freq_fileName, KmerSet2_slice, KmerSet2_residuals,
+     single_pass, canonical) = shard
+    logger = logging.getLogger(__name__)
+
+    KmerSet1_k, KmerSet1_chunks = open_Kmer_Residuals(
+        KmerSet1_fileName, KmerSet1_freq_fileName, logger, KmerSet_slice=KmerSet1_slice, canonical=canonical,
+        use_residuals=KmerSet1_residuals)
+    KmerSet2_k, KmerSet2_chunks = open_Kmer_Residuals(
+        KmerSet2_fileName, KmerSet2_freq_fileName, logger, KmerSet_slice=KmerSet2_slice, canonical=canonical,
+        use_residuals=KmerSet2_residuals)
+
+    d2Score_kmerset1_VS_kmerset2 = 0.0
+    d2Score_kmerset1_VS_kmerset1 = 0.0
+    d2Score_kmerset2_VS_kmerset2 = 0.0
+
+    for KmerSet1_codes, KmerSet1_residuals, KmerSet2_codes, KmerSet2_residuals in merge_Kmer_chunks(KmerSet1_chunks, KmerSet2_chunks):
 
-    # Open files. Best to do this here instead of as part of argparser as we need to operate on the same file
-    # at the same time - will not work if we only have one file handle.
-    KmerSet1_fh = read_file_check_compression(KmerSet1_fileName)
-    KmerSet2_fh = read_file_check_compression(KmerSet2_fileName)
-    KmerSet1_freq_fh = read_file_check_compression(KmerSet1_freq_fileName)
-    KmerSet2_freq_fh = read_file_check_compression(KmerSet2_freq_fileName)
+        d2Score_kmerset1_VS_kmerset2 += calculate_D2S_Shared(KmerSet1_codes, KmerSet1_residuals,
+                                                             KmerSet2_codes, KmerSet2_residuals)
+        if single_pass:
+            d2Score_kmerset1_VS_kmerset1 += calculate_D2S_Self(KmerSet1_residuals)
+            d2Score_kmerset2_VS_kmerset2 += calculate_D2S_Self(KmerSet2_residuals)
 
-    # Initiate the Kmer_set iterator so we can check the Kmer sizes in both sets
-    Kmer_iter = iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger,
-                                  Both_KmerSets=True, KmerSet1_Only=False, KmerSet2_Only=False)
-    KmerSet1_seq, KmerSet1_count, KmerSet2_seq, KmerSet2_count = Kmer_iter.next()
+    return d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2
+
+
+def open_Kmer_Set_Pair(KmerSet1_fileName, KmerSet1_freq_fileName, KmerSet2_fileName, KmerSet2_freq_fileName, logger,
+                       canonical=False):
+    '''
+    Opens two Kmer sets as generators of sorted (codes, residuals) chunks.
+
+    Returns:
+        k, KmerSet1_chunks, KmerSet2_chunks
+    '''
+    KmerSet1_k, KmerSet1_chunks = open_Kmer_Residuals(
+        KmerSet1_fileName, KmerSet1_freq_fileName, logger, canonical=canonical)
+    KmerSet2_k, KmerSet2_chunks = open_Kmer_Residuals(
+        KmerSet2_fileName, KmerSet2_freq_fileName, logger, canonical=canonical)
 
     # Check if the kmer_seq's are the same size.
-    if len(KmerSet1_seq) != len(KmerSet2_seq):
+    if KmerSet1_k != KmerSet2_k:
         logger.error('Kmer sizes are different between the two datasets: %s:%s\t%s:%s',
-                     KmerSet1_fh.name, len(KmerSet1_seq), KmerSet2_fh.name, len(KmerSet2_seq))  # ERROR
+                     KmerSet1_fileName, KmerSet1_k, KmerSet2_fileName, KmerSet2_k)  # ERROR
         sys.exit(1)
 
     # Save Kmer size for later
-    k = len(KmerSet1_seq)
+    k = KmerSet1_k
     logger.info('k-mer:%s', k)  # DEBUG
 
-    # Load the frequencies for each dataset.
-    kmerset1_freq = load_Character_Frequency(KmerSet1_freq_fh, logger)
-    kmerset2_freq = load_Character_Frequency(KmerSet2_freq_fh, logger)
+    return k, KmerSet1_chunks, KmerSet2_chunks
 
-    # Get 'NUM_SEQUENCES' and 'NUM_CHARACTERS' from file and remove from dict.
-    kmerset1_NumSeqs = kmerset1_freq.pop('NUM_SEQUENCES')
-    kmerset2_NumSeqs = kmerset2_freq.pop('NUM_SEQUENCES')
 
-    kmerset1_NumChar = kmerset1_freq.pop('NUM_CHARACTERS')
-    kmerset2_NumChar = kmerset2_freq.pop('NUM_CHARACTERS')
+def open_Kmer_Residuals(KmerSet_fileName, KmerSet_freq_fileName, logger, KmerSet_slice=None, canonical=False,
+                        use_residuals=None):
+    '''
+    Opens a Kmer set as a generator of sorted (codes, residuals) chunks, where the
+    residual of a Kmer is kmer_count - NumKmers*Pw. Residuals precomputed by
+    Calculate_Residuals.py are used when they are up to date, otherwise they are
+    calculated from the counts and character frequencies.
 
-    # Calculate the number of Kmers possible from each dataset.
-    # No. K-mers = (len-k)+1
-    # No. K-mers (multiple seqs) = total_bases - (num_seqs * (k-1))
-    kmerset1_NumKmers = kmerset1_NumChar - (kmerset1_NumSeqs * (k-1))
-    kmerset2_NumKmers = kmerset2_NumChar - (kmerset2_NumSeqs * (k-1))
+    KmerSet_slice=(start, stop) limits a binary kmer profile to the Kmers [start, stop).
+    canonical marks a text Kmer set as canonical (see is_canonical_Kmer_set).
+    use_residuals=True/False skips checking the precomputed residuals, when the
+    caller already has (see has_Kmer_Residuals).
 
-    logger.debug('kmerset1_NumKmers:%s\tkmerset2_NumKmers:%s',
-                 kmerset1_NumKmers, kmerset2_NumKmers)  # DEBUG
+    Returns the Kmer size and the chunk generator.
+    '''
+    start, stop = KmerSet_slice or (0, None)
+    canonical = is_canonical_Kmer_set(KmerSet_fileName, canonical)
 
-    # (Re-)Initiate the Kmer iterator. We are only interested in Kmers that are shared between both sets.
-    Kmer_iter = iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger,
-                                  Both_KmerSets=True, KmerSet1_Only=False, KmerSet2_Only=False)
+    # Binary kmer profiles are memory-mapped, text kmer files are parsed a chunk at a time.
+    if KmerSet_slice is None:
+        k, KmerSet_chunks = open_Kmer_set(KmerSet_fileName)
+    else:
+        KmerSet_profile = load_Kmer_profile(KmerSet_fileName)
+        k, KmerSet_chunks = KmerSet_profile.k, profile_Kmer_chunks(
+            KmerSet_profile, start=start, stop=stop)
+
+    residuals = None
+    if use_residuals is not False:
+        residuals = load_Kmer_residuals(
+            KmerSet_fileName, KmerSet_freq_fileName, canonical=canonical, validate=use_residuals is None)
+    if residuals is not None:
+        logger.info('Using precomputed residuals for %s', KmerSet_fileName)  # INFO
+        return k, residual_Kmer_chunks(KmerSet_chunks, residuals[start:stop])
+
+    # Load the frequencies and number of possible Kmers for the dataset.
+    kmerset_freq, kmerset_NumKmers = load_Kmer_Background(
+        KmerSet_freq_fileName, k, logger)
+    logger.debug('%s NumKmers:%s', KmerSet_fileName, kmerset_NumKmers)  # DEBUG
+
+    return k, calculate_Residual_Chunks(KmerSet_chunks, kmerset_freq, kmerset_NumKmers, k, canonical=canonical)
+
+
+def has_Kmer_Residuals(KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=False):
+    '''
+    Checks if a Kmer set has up to date precomputed residuals (see open_Kmer_Residuals).
+    '''
+    canonical = is_canonical_Kmer_set(KmerSet_fileName, canonical)
+
+    if load_Kmer_residuals(KmerSet_fileName, KmerSet_freq_fileName, canonical=canonical) is None:
+        return False
+
+    logger.info('Using precomputed residuals for %s', KmerSet_fileName)  # INFO
+    return True
+
+
+def open_Kmer_Expected(KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=False):
+    '''
+    Opens a Kmer set as a generator of sorted (codes, values) chunks, where the
+    columns of values are the kmer_count, the expected count NumKmers*Pw and the
+    residual of each Kmer. Residuals precomputed by Calculate_Residuals.py are used
+    when they are up to date, so the D2S distance matches Calculate_D2S.py without
+    --measures. The expected counts are always calculated, as they are too small
+    to get back from the counts and residuals.
+
+    Returns the Kmer size and the chunk generator.
+    '''
+    k, KmerSet_chunks = open_Kmer_set(KmerSet_fileName)
+    canonical = is_canonical_Kmer_set(KmerSet_fileName, canonical)
+
+    kmerset_freq, kmerset_NumKmers = load_Kmer_Background(
+        KmerSet_freq_fileName, k, logger)
+    logger.debug('%s NumKmers:%s', KmerSet_fileName, kmerset_NumKmers)  # DEBUG
+
+    residuals = load_Kmer_residuals(
+        KmerSet_fileName, KmerSet_freq_fileName, canonical=canonical)
+    if residuals is not None:
+        logger.info('Using precomputed residuals for %s', KmerSet_fileName)  # INFO
+
+    return k, expected_Kmer_chunks(KmerSet_chunks, kmerset_freq, kmerset_NumKmers, k, residuals, canonical)
+
+
+def expected_Kmer_chunks(KmerSet_chunks, kmerset_freq, kmerset_NumKmers, k, residuals=None, canonical=False):
+    '''
+    Turns (codes, counts) chunks into (codes, values) chunks for open_Kmer_Expected.
+    '''
+    start = 0
+    for KmerSet_codes, KmerSet_counts in KmerSet_chunks:
+        KmerSet_expected = kmerset_NumKmers * \
+            calculate_PropKmerOccurrence_Codes(KmerSet_codes, k, kmerset_freq, canonical)
+
+        if residuals is None:
+            KmerSet_residuals = KmerSet_counts - KmerSet_expected
+        else:
+            KmerSet_residuals = residuals[start:start + len(KmerSet_codes)]
+            start += len(KmerSet_codes)
+
+        yield KmerSet_codes, np.column_stack((KmerSet_counts, KmerSet_expected, KmerSet_residuals))
 
-    d2Score = 0.0
 
-    for KmerSet1_seq, KmerSet1_count, KmerSet2_seq, KmerSet2_count in Kmer_iter:
+def read_Kmer_Residuals(KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=False):
+    '''
+    Reads all the codes and residuals of a Kmer set into memory.
 
-        # Probability of k-mer occurrence in seq 1.
-        PwX = calculate_PropKmerOccurrence(KmerSet1_seq, kmerset1_freq)
-        # Probability of k-mer occurrence in seq 2.
-        PwY = calculate_PropKmerOccurrence(KmerSet2_seq, kmerset2_freq)
+    Returns the Kmer size, codes and residuals.
+    '''
+    k, KmerSet_chunks = open_Kmer_Residuals(
+        KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=canonical)
 
-        kmerScoreXBis = KmerSet1_count - (kmerset1_NumKmers*PwX)
-        kmerScoreYBis = KmerSet2_count - (kmerset2_NumKmers*PwY)
+    KmerSet_codes = [np.zeros(0, dtype=np.uint64)]
+    KmerSet_residuals = [np.zeros(0, dtype=np.float64)]
+    for codes, residuals in KmerSet_chunks:
+        KmerSet_codes.append(np.array(codes, dtype=np.uint64))
+        KmerSet_residuals.append(np.array(residuals, dtype=np.float64))
 
-        d2Score_tmp = (kmerScoreXBis*kmerScoreYBis) / \
-            math.sqrt(kmerScoreXBis*kmerScoreXBis +
-                      kmerScoreYBis*kmerScoreYBis)
-        d2Score += (kmerScoreXBis*kmerScoreYBis) / \
-            math.sqrt(kmerScoreXBis*kmerScoreXBis +
-                      kmerScoreYBis*kmerScoreYBis)
+    return k, np.concatenate(KmerSet_codes), np.concatenate(KmerSet_residuals)
 
-        logger.debug('PwX:%s\tPwY:%s\tkmerScoreXBis:%s\tkmerScoreYBis:%s\td2Score:%s',
-                     PwX, PwY, kmerScoreXBis, kmerScoreYBis, d2Score_tmp)  # DEBUG
 
-    # Close up
-    KmerSet1_fh.close()
-    KmerSet2_fh.close()
-    KmerSet1_freq_fh.close()
-    KmerSet2_freq_fh.close()
+def calculate_D2S_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, logger, use_cache=True, canonical=False):
+    '''
+    Calculate the D2S score of a Kmer set against itself. With use_cache the score
+    is taken from (and saved to) the self score cache when the Kmer set and
+    character frequency files are unchanged.
+    '''
+    canonical = is_canonical_Kmer_set(KmerSet_fileName, canonical)
+    model = Self_Score_model(canonical)
+
+    if use_cache:
+        d2Score = load_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, model=model)
+        if d2Score is not None:
+            logger.info('Using cached self score for %s', KmerSet_fileName)  # INFO
+            return d2Score
+
+    k, KmerSet_chunks = open_Kmer_Residuals(
+        KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=canonical)
+
+    # Every Kmer is shared with itself, so no merge is needed.
+    d2Score = 0.0
+    for KmerSet_codes, KmerSet_residuals in KmerSet_chunks:
+        d2Score += calculate_D2S_Self(KmerSet_residuals)
+
+    if use_cache and not save_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, d2Score, model=model):
+        logger.warning('Could not cache the self score for %s',
+                       KmerSet_fileName)  # WARNING
 
     return d2Score
 
 
+def calculate_Kmer_Residuals(KmerSet_codes, KmerSet_counts, kmerset_freq, kmerset_NumKmers, k, canonical=False):
+    '''
+    The observed minus expected count (kmer_count - NumKmers*Pw) of each Kmer.
+    '''
+    Pw = calculate_PropKmerOccurrence_Codes(KmerSet_codes, k, kmerset_freq, canonical)
+
+    return KmerSet_counts - (kmerset_NumKmers*Pw)
+
+
+def calculate_Residual_Chunks(KmerSet_chunks, kmerset_freq, kmerset_NumKmers, k, canonical=False):
+    '''
+    Turns (codes, counts) chunks into (codes, residuals) chunks.
+    '''
+    for KmerSet_codes, KmerSet_counts in KmerSet_chunks:
+        yield KmerSet_codes, calculate_Kmer_Residuals(KmerSet_codes, KmerSet_counts,
+                                                      kmerset_freq, kmerset_NumKmers, k, canonical)
+
+
+def calculate_D2S_Self(KmerSet_residuals):
+    '''
+    Sum of the D2S terms of an array of Kmer residuals against itself.
+    '''
+    kmerScoreBis = np.asarray(KmerSet_residuals)
+
+    return float(np.sum((kmerScoreBis*kmerScoreBis) /
+                        np.sqrt(kmerScoreBis*kmerScoreBis + kmerScoreBis*kmerScoreBis)))
+
+
+def calculate_D2S_Shared(KmerSet1_codes, KmerSet1_residuals, KmerSet2_codes, KmerSet2_residuals):
+    '''
+    Sum of the D2S terms over the Kmers shared by two sorted code arrays.
+    '''
+    KmerSet1_shared, KmerSet2_shared = intersect_Kmer_codes(
+        KmerSet1_codes, KmerSet2_codes)
+
+    if not len(KmerSet1_shared):
+        return 0.0
+
+    kmerScoreXBis = KmerSet1_residuals[KmerSet1_shared]
+    kmerScoreYBis = KmerSet2_residuals[KmerSet2_shared]
+
+    return float(np.sum((kmerScoreXBis*kmerScoreYBis) /
+                        np.sqrt(kmerScoreXBis*kmerScoreXBis + kmerScoreYBis*kmerScoreYBis)))
+
+
+def load_Kmer_Background(freq_fileName, k, logger):
+    '''
+    Loads the character frequencies of a dataset and calculates the number of
+    Kmers possible from it.
+
+    Returns the character frequencies (without 'NUM_SEQUENCES' and 'NUM_CHARACTERS')
+    and the number of possible Kmers.
+    '''
+    freq_fh = read_file_check_compression(freq_fileName)
+    charFreq = load_Character_Frequency(freq_fh, logger)
+    freq_fh.close()
+
+    # Get 'NUM_SEQUENCES' and 'NUM_CHARACTERS' from file and remove from dict.
+    NumSeqs = charFreq.pop('NUM_SEQUENCES')
+    NumChar = charFreq.pop('NUM_CHARACTERS')
+
+    # Calculate the number of Kmers possible from each dataset.
+    # No. K-mers = (len-k)+1
+    # No. K-mers (multiple seqs) = total_bases - (num_seqs * (k-1))
+    NumKmers = NumChar - (NumSeqs * (k-1))
+
+    return charFreq, NumKmers
+
+
 def load_Character_Frequency(freq_fh, logger):
     '''
     Loads (from file) the frequecny of each possible character (e.g. A, T, G, C)
@@ -201,5 +805,33 @@ def calculate_PropKmerOccurrence(Kmer_seq, charFreq):
     return freq
 
 
+def calculate_PropKmerOccurrence_Codes(Kmer_codes, k, charFreq, canonical=False):
+    '''
+    Vectorised calculate_PropKmerOccurrence for an array of 2-bit packed Kmer codes.
+    Uses the number of times each character occurs in each Kmer.
+
+    With canonical, each code stands for a Kmer and its reverse complement, so the
+    probability of the reverse complement (the complement of each base, A<->T and
+    C<->G) is added, unless the Kmer is its own reverse complement.
+    '''
+    freq = np.array([charFreq[char] for char in CODE_BASES])
+    base_counts = Kmer_base_counts(Kmer_codes, k)
+    Pw = np.prod(freq ** base_counts, axis=1)
+
+    if not canonical:
+        return Pw
+
+    # CODE_BASES reversed is the complement of each base.
+    Prc = np.prod(freq ** base_counts[:, ::-1], axis=1)
+
+    # Only Kmers of even length can be their own reverse complement.
+    if k % 2:
+        return Pw + Prc
+
+    palindromes = reverse_complement_Kmer_codes(Kmer_codes, k) == np.asarray(Kmer_codes, dtype=np.uint64)
+
+    return Pw + np.where(palindromes, 0.0, Prc)
+
+
 if __name__ == '__main__':
     main()
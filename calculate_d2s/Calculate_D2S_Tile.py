@@ -0,0 +1,142 @@
+#!/usr/bin/python2
+from D2S_tools import *
+from Calculate_D2S import calculate_D2S_Self, calculate_D2S_Shared, d2ScoreNormalization, read_Kmer_Residuals
+import logging
+import argparse
+import sys
+DESCRIPTION = '''
+Calculate the D2S distance of every pair of Kmer sets in a tile: one Kmer set from block 1 and one
+from block 2 (or every pair within the block if both are the same block). Each Kmer set is read
+once per tile instead of once per pair. The blocks are written by create_d2s_jobs.py --tile_memory.
+
+Block file format (one Kmer set per line):
+        name<\\t>KmerSet.21mers.nkp<\\t>KmerSet.21mers.charFreq
+
+Pairs file format (optional, only these pairs of the tile are calculated):
+        name1<\\t>name2
+
+Writes name1-name2.txt for each pair to the output folder, in the same format as Calculate_D2S.py.
+'''
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--block1', metavar='block_0.txt', type=lambda x: check_file_exists(x),
+                        required=True, help='Kmer sets of the first block')
+    parser.add_argument('--block2', metavar='block_1.txt', type=lambda x: check_file_exists(x),
+                        required=True, help='Kmer sets of the second block, can be the same as --block1')
+    parser.add_argument('--data_output_path', metavar='genomes_D2S/', type=str,
+                        required=True, help='Output folder for the D2S distances')
+    parser.add_argument('--pairs', metavar='pairs.txt', type=lambda x: check_file_exists(x),
+                        required=False, default=None, help='Only calculate these pairs of the tile (default: all pairs)')
+    parser.add_argument('--no_self_cache', action='store_true', required=False, default=False,
+                        help='Always recompute the self scores instead of using the cached ones (default: %(default)s)')
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='The text Kmer sets hold canonical kmers, binary kmer profiles record this themselves (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    block1 = read_Kmer_block(args.block1)
+    block2 = read_Kmer_block(args.block2)
+
+    # Pairs within a block (the diagonal tiles) are only calculated once.
+    if os.path.abspath(args.block1) == os.path.abspath(args.block2):
+        pairs = [(block1[i], block1[j]) for i in range(len(block1))
+                 for j in range(i + 1, len(block1))]
+    else:
+        pairs = [(kmerset1, kmerset2) for kmerset1 in block1 for kmerset2 in block2]
+
+    if args.pairs is not None:
+        pairs_fh = read_file_check_compression(args.pairs)
+        selected = set(tuple(columns[:2]) for columns in pass_column_file(pairs_fh))
+        pairs_fh.close()
+
+        pairs = [pair for pair in pairs if (pair[0][0], pair[1][0]) in selected]
+
+    if not os.path.exists(args.data_output_path):
+        os.makedirs(args.data_output_path)
+
+    calculate_D2S_Tile(pairs, args.data_output_path, logger,
+                       use_cache=not args.no_self_cache, canonical=args.canonical)
+
+
+def read_Kmer_block(block_fileName):
+    '''
+    Reads the (name, KmerSet, KmerSet_freq) of each Kmer set in a block file.
+    '''
+    block_fh = read_file_check_compression(block_fileName)
+    block = [tuple(columns) for columns in pass_column_file(block_fh)]
+    block_fh.close()
+
+    return block
+
+
+def calculate_D2S_Tile(pairs, D2S_out_dir, logger, use_cache=True, canonical=False):
+    '''
+    Calculates the D2S distance of each pair of (name, KmerSet, KmerSet_freq),
+    keeping the codes and residuals of every Kmer set in the tile in memory.
+    '''
+    KmerSets = {}
+    for pair in pairs:
+        for name, KmerSet_fileName, KmerSet_freq_fileName in pair:
+            if name in KmerSets:
+                continue
+
+            KmerSet_canonical = is_canonical_Kmer_set(KmerSet_fileName, canonical)
+            model = Self_Score_model(KmerSet_canonical)
+
+            k, codes, residuals = read_Kmer_Residuals(
+                KmerSet_fileName, KmerSet_freq_fileName, logger, canonical=KmerSet_canonical)
+
+            # The self score is a sum over the residuals that were just read.
+            d2Score = load_Self_Score(
+                KmerSet_fileName, KmerSet_freq_fileName, model=model) if use_cache else None
+            if d2Score is None:
+                d2Score = calculate_D2S_Self(residuals)
+                if use_cache and not save_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, d2Score, model=model):
+                    logger.warning('Could not cache the self score for %s',
+                                   KmerSet_fileName)  # WARNING
+
+            KmerSets[name] = ((k, KmerSet_canonical), codes, residuals, d2Score)
+            logger.info('Loaded %s (%s kmers)', KmerSet_fileName, len(codes))  # INFO
+
+    for (name1, KmerSet1_fileName, KmerSet1_freq_fileName), (name2, KmerSet2_fileName, KmerSet2_freq_fileName) in pairs:
+        KmerSet1_k, KmerSet1_codes, KmerSet1_residuals, d2Score_kmerset1_VS_kmerset1 = KmerSets[name1]
+        KmerSet2_k, KmerSet2_codes, KmerSet2_residuals, d2Score_kmerset2_VS_kmerset2 = KmerSets[name2]
+
+        # Check if the kmer_seq's are the same size and both (or neither) are canonical.
+        if KmerSet1_k != KmerSet2_k:
+            logger.error('Kmer sizes (and canonical) are different between the two datasets: %s:%s\t%s:%s',
+                         KmerSet1_fileName, KmerSet1_k, KmerSet2_fileName, KmerSet2_k)  # ERROR
+            sys.exit(1)
+
+        d2Score_kmerset1_VS_kmerset2 = calculate_D2S_Shared(KmerSet1_codes, KmerSet1_residuals,
+                                                            KmerSet2_codes, KmerSet2_residuals)
+        D2S_distance = d2ScoreNormalization(
+            d2Score_kmerset1_VS_kmerset2, d2Score_kmerset1_VS_kmerset1, d2Score_kmerset2_VS_kmerset2)
+        logger.info('%s-%s D2S_distance:%s', name1, name2, D2S_distance)  # INFO
+
+        D2S_out = write_file_check_compression(
+            os.path.join(D2S_out_dir, name1 + '-' + name2 + '.txt'))
+        D2S_out.write(KmerSet1_fileName + ';' + KmerSet2_fileName + ';' + str(D2S_distance) + '\n')
+        D2S_out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python2
+from D2S_tools import *
+from Calculate_D2S import calculate_D2S_Self, calculate_Residual_Chunks, load_Kmer_Background
+import logging
+import argparse
+import sys
+DESCRIPTION = '''
+Precompute the residuals (kmer_count - NumKmers*Pw) of a Kmer set and store them next to it
+(KmerSet.21mers.nkp.Residuals). Calculate_D2S.py then only has to intersect the Kmer codes and
+sum the D2S terms for every pair the Kmer set takes part in, instead of recomputing the Kmer
+probabilities. The self score is computed from the residuals and cached at the same time.
+'''
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--kmerset', metavar='KmerSet.21mers.gz', type=lambda x: check_file_exists(x),
+                        required=True, help='Kmers for the dataset, can be gziped or a binary kmer profile (.nkp)')
+    parser.add_argument('--kmerset_freq', metavar='KmerSet.21mers.charFreq', type=lambda x: check_file_exists(x),
+                        required=True, help='Character frequency for the dataset, can be gziped')
+    parser.add_argument('--force', action='store_true', required=False, default=False,
+                        help='Recompute the residuals even if they are up to date (default: %(default)s)')
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='The text Kmer set holds canonical kmers, binary kmer profiles record this themselves (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    canonical = is_canonical_Kmer_set(args.kmerset, args.canonical)
+
+    residuals = None if args.force else load_Kmer_residuals(
+        args.kmerset, args.kmerset_freq, canonical=canonical)
+
+    if residuals is None:
+        k, KmerSet_chunks = open_Kmer_set(args.kmerset)
+        kmerset_freq, kmerset_NumKmers = load_Kmer_Background(
+            args.kmerset_freq, k, logger)
+
+        residual_chunks = (KmerSet_residuals for KmerSet_codes, KmerSet_residuals in calculate_Residual_Chunks(
+            KmerSet_chunks, kmerset_freq, kmerset_NumKmers, k, canonical))
+
+        num_kmers = write_Kmer_residuals(
+            args.kmerset, args.kmerset_freq, k, residual_chunks, canonical=canonical)
+        logger.info('Wrote %s residuals to %s', num_kmers,
+                    args.kmerset + RESIDUAL_EXT)  # INFO
+
+        residuals = load_Kmer_residuals(
+            args.kmerset, args.kmerset_freq, canonical=canonical)
+        if residuals is None:
+            logger.error('Could not read back the residuals for %s',
+                         args.kmerset)  # ERROR
+            sys.exit(1)
+    else:
+        logger.info('Residuals for %s are up to date', args.kmerset)  # INFO
+
+    # The self score is a sum over the residuals alone.
+    d2Score = 0.0
+    for start in range(0, len(residuals), 1 << 22):
+        d2Score += calculate_D2S_Self(residuals[start:start + (1 << 22)])
+
+    if not save_Self_Score(args.kmerset, args.kmerset_freq, d2Score, model=Self_Score_model(canonical)):
+        logger.error('Could not write the self score cache for %s',
+                     args.kmerset)  # ERROR
+        sys.exit(1)
+
+    logger.info('kmerset VS. kmerset d2Score:%s', d2Score)  # INFO
+
+
+if __name__ == '__main__':
+    main()
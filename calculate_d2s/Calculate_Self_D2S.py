@@ -0,0 +1,61 @@
+#!/usr/bin/python2
+from D2S_tools import *
+from Calculate_D2S import calculate_D2S_Self_Score
+import logging
+import argparse
+import sys
+DESCRIPTION = '''
+Calculate the D2S score of a Kmer set against itself and store it in the self score cache
+(KmerSet.21mers.gz.SelfScore). Calculate_D2S.py reuses the cached score for every pair the
+Kmer set takes part in, as long as the Kmer set and character frequency files do not change.
+'''
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--kmerset', metavar='KmerSet.21mers.gz', type=lambda x: check_file_exists(x),
+                        required=True, help='Kmers for the dataset, can be gziped or a binary kmer profile (.nkp)')
+    parser.add_argument('--kmerset_freq', metavar='KmerSet.21mers.charFreq', type=lambda x: check_file_exists(x),
+                        required=True, help='Character frequency for the dataset, can be gziped')
+    parser.add_argument('--force', action='store_true', required=False, default=False,
+                        help='Recompute the self score even if a valid one is cached (default: %(default)s)')
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='The text Kmer set holds canonical kmers, binary kmer profiles record this themselves (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    canonical = is_canonical_Kmer_set(args.kmerset, args.canonical)
+    model = Self_Score_model(canonical)
+
+    if args.force or load_Self_Score(args.kmerset, args.kmerset_freq, model=model) is None:
+        d2Score = calculate_D2S_Self_Score(
+            args.kmerset, args.kmerset_freq, logger, use_cache=False, canonical=canonical)
+
+        if not save_Self_Score(args.kmerset, args.kmerset_freq, d2Score, model=model):
+            logger.error('Could not write the self score cache for %s',
+                         args.kmerset)  # ERROR
+            sys.exit(1)
+    else:
+        d2Score = load_Self_Score(args.kmerset, args.kmerset_freq, model=model)
+
+    logger.info('kmerset VS. kmerset d2Score:%s', d2Score)  # INFO
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python2
+DESCRIPTION = '''
+Convert a text kmer file created by Kmers_2_NumbericRepresentation.py into a binary kmer profile.
+
+The binary profile holds the sorted 2-bit packed kmer codes and their counts, and is
+memory-mapped by Calculate_D2S.py instead of being decompressed and parsed for every pair.
+
+With --sketch_scale only the kmers in the FracMinHash sketch of the kmer file are kept
+(about 1 in sketch_scale), for screening with Sketch_D2S.py. The input can also be a binary
+kmer profile when making a sketch.
+
+With --canonical each kmer is collapsed with its reverse complement into the smaller of the
+two codes, summing their counts, and the profile is marked as canonical. This is also needed
+to mark text kmer files from jellyfish count -C as canonical. The whole kmer file is held in
+memory while it is collapsed.
+
+With --min_count and --max_count the kmers counted fewer or more times are dropped (after
+collapsing them with --canonical). The thresholds and the number and total count of the removed
+kmers are recorded in the profile metadata, and carried over when the input is a filtered profile.
+
+Input kmer file: kmer_value<\\t>kmer_seq<\\t>kmer_count
+Output kmer profile: KmerSet.21mer.nkp (or KmerSet.21mer.sketch.nkp)
+'''
+from D2S_tools import *
+import logging
+import argparse
+import sys
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('-i', '--in_kmers', metavar='KmerSet.21mer.nkc.gz', type=lambda x: check_file_exists(x),
+                        required=True, help='Input kmer file (sorted), can be gziped or a binary kmer profile (.nkp)')
+    parser.add_argument('-o', '--out_profile', metavar='KmerSet.21mer.nkp', type=str,
+                        required=True, help='Output binary kmer profile')
+    parser.add_argument('--sketch_scale', metavar='S', type=int, required=False, default=None,
+                        help='Only keep the kmers of a FracMinHash sketch, about 1 in S (e.g. %s) (default: keep all kmers)' % SKETCH_SCALE)
+    parser.add_argument('--sketch_seed', metavar='SEED', type=int, required=False, default=0,
+                        help='Seed of the sketch hash, sketches are only comparable with the same seed (default: %(default)s)')
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='Collapse each kmer with its reverse complement (default: %(default)s)')
+    parser.add_argument('--min_count', metavar='N', type=int, required=False, default=1,
+                        help='Drop kmers counted fewer than N times (default: %(default)s)')
+    parser.add_argument('--max_count', metavar='N', type=int, required=False, default=None,
+                        help='Drop kmers counted more than N times (default: no limit)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    if args.sketch_scale is not None and args.sketch_scale < 1:
+        logger.error('--sketch_scale has to be at least 1: %s',
+                     args.sketch_scale)  # ERROR
+        sys.exit(1)
+
+    if args.min_count < 1 or (args.max_count is not None and args.max_count < args.min_count):
+        logger.error('--min_count has to be at least 1 and at most --max_count: %s, %s',
+                     args.min_count, args.max_count)  # ERROR
+        sys.exit(1)
+
+    convert_Kmer_file(args.in_kmers, args.out_profile, logger,
+                      sketch_scale=args.sketch_scale, sketch_seed=args.sketch_seed, canonical=args.canonical,
+                      min_count=args.min_count, max_count=args.max_count)
+
+
+def convert_Kmer_file(in_kmers_fileName, out_profile_fileName, logger, sketch_scale=None, sketch_seed=0,
+                      canonical=False, min_count=1, max_count=None):
+    '''
+    Stream a text kmer file (or binary kmer profile) into a binary kmer profile,
+    or only its sketch if sketch_scale is given. With canonical the kmers are
+    collapsed with their reverse complements first. Kmers counted fewer than
+    min_count or more than max_count times are dropped.
+    '''
+    # The kmer size of a text file is taken from its first kmer_seq.
+    k, Kmer_chunks = open_Kmer_set(in_kmers_fileName)
+    logger.info('k-mer:%s', k)  # INFO
+
+    flags = 0
+    metadata = {'source': os.path.basename(in_kmers_fileName)}
+
+    # Canonical codes are not in the same order as the kmers, so collapse them in memory.
+    if canonical or is_canonical_Kmer_set(in_kmers_fileName):
+        Kmer_chunks = list(Kmer_chunks)
+        codes, counts = canonical_Kmer_profile(np.concatenate([codes for codes, counts in Kmer_chunks] or [[]]),
+                                               np.concatenate([counts for codes, counts in Kmer_chunks] or [[]]), k)
+        logger.info('Collapsed %s kmers into %s canonical kmers',
+                    sum(len(chunk[0]) for chunk in Kmer_chunks), len(codes))  # INFO
+
+        Kmer_chunks = iter([(codes, counts)])
+        flags |= FLAG_CANONICAL
+        metadata['canonical'] = True
+
+    # A filtered input profile keeps its thresholds and removed kmers.
+    removed = {'num_kmers': 0, 'total_count': 0}
+    if is_Kmer_profile(in_kmers_fileName):
+        in_metadata = load_Kmer_profile(in_kmers_fileName).metadata
+        if 'removed_num_kmers' in in_metadata:
+            min_count = max(min_count, in_metadata['min_count'])
+            if in_metadata['max_count'] is not None:
+                max_count = in_metadata['max_count'] if max_count is None else min(max_count, in_metadata['max_count'])
+            removed = {'num_kmers': in_metadata['removed_num_kmers'],
+                       'total_count': in_metadata['removed_total_count']}
+
+    if min_count > 1 or max_count is not None:
+        Kmer_chunks = filter_Kmer_chunks(Kmer_chunks, min_count, max_count, removed)
+
+    num_source_kmers = [0]
+
+    def count_Kmer_chunks(Kmer_chunks):
+        for codes, counts in Kmer_chunks:
+            num_source_kmers[0] += len(codes)
+            yield codes, counts
+
+    Kmer_chunks = count_Kmer_chunks(Kmer_chunks)
+
+    if sketch_scale is None:
+        profile = KmerProfileWriter(out_profile_fileName, k, flags=flags)
+    else:
+        profile = KmerProfileWriter(out_profile_fileName, k, flags=flags | FLAG_SKETCH)
+        Kmer_chunks = sketch_Kmer_chunks(Kmer_chunks, sketch_scale, sketch_seed)
+        metadata.update({'sketch_scale': sketch_scale, 'sketch_seed': sketch_seed,
+                         'sketch_hash': SKETCH_HASH})
+
+    for codes, counts in Kmer_chunks:
+        profile.write(codes, counts)
+
+    if sketch_scale is not None:
+        metadata['source_num_kmers'] = num_source_kmers[0]
+    if min_count > 1 or max_count is not None:
+        metadata.update({'min_count': min_count, 'max_count': max_count,
+                         'removed_num_kmers': removed['num_kmers'], 'removed_total_count': removed['total_count']})
+        logger.info('Removed %s kmers (total count %s) outside the count range [%s, %s]',
+                    removed['num_kmers'], removed['total_count'], min_count, max_count)  # INFO
+    profile.close(metadata=metadata)
+
+    logger.info('Wrote %s kmers (total count %s) to %s', profile.num_kmers,
+                profile.total_count, out_profile_fileName)  # INFO
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python2
+DESCRIPTION = '''
+Count the kmers of a fasta file and write them straight to a sorted binary kmer profile, instead
+of jellyfish count, jellyfish dump, sort, Kmers_2_NumbericRepresentation.py and
+Convert_Kmer_Profile.py.
+
+Each sequence is 2-bit encoded in chunks, and the kmer codes of up to --memory GB of sequence
+are sorted and counted in memory. For larger genomes each counted run is spilled to a
+temporary folder and the runs are merged, one range of kmer prefixes at a time, into the
+profile. Kmers with any base other than ACGT are skipped, like jellyfish does.
+
+With --canonical each kmer is counted together with its reverse complement (like jellyfish
+count -C), and with --min_count/--max_count the kmers counted fewer or more times are dropped
+(see Convert_Kmer_Profile.py).
+
+With --freq the character frequencies of the same read of the fasta file are written as well,
+in the format of Composition_of_InputSeqs.py, and with --done an empty marker file is written
+once every output is complete. Preprocessing a genome then reads its fasta file only once.
+
+With --cache_dir the outputs are looked up in a cache keyed by the content of the fasta file, the
+kmer size and the counting options. On a hit they are copied from the cache instead of being
+counted again, otherwise they are counted and copies are added to the cache.
+
+Input fasta file: genome.fasta (can be gziped)
+Output kmer profile: genome.fasta.21mer.nkp
+Output character frequencies (optional): genome.fasta.CharFreq
+Output marker (optional): genome.fasta.done
+'''
+from D2S_tools import *
+import logging
+import argparse
+import sys
+
+# Bytes of memory used per buffered kmer (the codes, their sort order and the counted run).
+KMER_BUFFER_BYTES = 32
+
+# Bases of sequence 2-bit encoded at a time.
+FASTA_CHUNK_SIZE = 1 << 24
+
+# Largest number of prefix bases the spilled runs are merged by (4^10 ~ 1M ranges).
+MAX_MERGE_PREFIX_BASES = 10
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--fasta', metavar='genome.fasta', type=lambda x: check_file_exists(x),
+                        required=True, help='Input fasta file, can be gziped')
+    parser.add_argument('-o', '--out_profile', metavar='genome.fasta.21mer.nkp', type=str,
+                        required=True, help='Output binary kmer profile')
+    parser.add_argument('--freq', metavar='genome.fasta.CharFreq', type=str, required=False, default=None,
+                        help='Also write the character frequencies of the fasta file (default: %(default)s)')
+    parser.add_argument('--done', metavar='genome.fasta.done', type=str, required=False, default=None,
+                        help='Write this marker file once every output is complete (default: %(default)s)')
+    parser.add_argument('-k', '--kmer_size', metavar='K', type=int, required=False, default=21,
+                        help='Kmer size, at most %s (default: %%(default)s)' % PROFILE_MAX_K)
+    parser.add_argument('--canonical', action='store_true', required=False, default=False,
+                        help='Count each kmer together with its reverse complement (default: %(default)s)')
+    parser.add_argument('--memory', metavar='GB', type=float, required=False, default=2,
+                        help='Memory for counting kmers before spilling them to disk (default: %(default)s)')
+    parser.add_argument('--tmp_dir', metavar='tmp/', type=str, required=False, default=None,
+                        help='Folder for the spilled kmer runs (default: next to the output)')
+    parser.add_argument('--min_count', metavar='N', type=int, required=False, default=1,
+                        help='Drop kmers counted fewer than N times (default: %(default)s)')
+    parser.add_argument('--max_count', metavar='N', type=int, required=False, default=None,
+                        help='Drop kmers counted more than N times (default: no limit)')
+    parser.add_argument('--cache_dir', metavar='kmer_cache/', type=str, required=False, default=None,
+                        help='Reuse (or add) the outputs for identical fasta files in this cache (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    if not 0 < args.kmer_size <= PROFILE_MAX_K:
+        logger.error('--kmer_size has to be between 1 and %s: %s',
+                     PROFILE_MAX_K, args.kmer_size)  # ERROR
+        sys.exit(1)
+
+    if args.min_count < 1 or (args.max_count is not None and args.max_count < args.min_count):
+        logger.error('--min_count has to be at least 1 and at most --max_count: %s, %s',
+                     args.min_count, args.max_count)  # ERROR
+        sys.exit(1)
+
+    artifacts = None
+    if args.cache_dir is not None:
+        key = Kmer_count_cache_key(args.fasta, args.kmer_size, canonical=args.canonical,
+                                   min_count=args.min_count, max_count=args.max_count)
+        artifacts = {ARTIFACT_PROFILE: args.out_profile}
+        if args.freq is not None:
+            artifacts[ARTIFACT_FREQ + ('.gz' if args.freq.endswith('.gz') else '')] = args.freq
+
+    if artifacts is not None and fetch_cached_artifacts(args.cache_dir, key, artifacts):
+        logger.info('Copied %s from the cache entry %s', ', '.join(sorted(artifacts.values())), key)  # INFO
+    else:
+        count_Kmers(args.fasta, args.out_profile, args.kmer_size, logger, canonical=args.canonical,
+                    buffer_kmers=max(int(args.memory * 1e9 / KMER_BUFFER_BYTES), 1 << 16), tmp_dir=args.tmp_dir,
+                    min_count=args.min_count, max_count=args.max_count, freq_fileName=args.freq)
+
+        if artifacts is not None:
+            store_cached_artifacts(args.cache_dir, key, artifacts)
+            logger.info('Stored the outputs in the cache entry %s', key)  # INFO
+
+    if args.done is not None:
+        open(args.done, 'w').close()
+
+
+class KmerCounter(object):
+    '''
+    Counts kmer codes added in any order, optionally with a count for each code.
+    Up to buffer_kmers codes are sorted and counted in memory at a time, and each full run of counted kmers is spilled to
+    tmp_dir. The runs are merged into sorted (codes, counts) chunks at the end.
+    '''
+
+    def __init__(self, k, buffer_kmers, tmp_dir):
+        self.k = k
+        self.buffer_kmers = buffer_kmers
+        self.tmp_dir = tmp_dir
+
+        self.buffer = []
+        self.buffer_counts = []
+        self.buffered = 0
+        self.runs = []
+        self.num_spilled = 0
+
+    def add(self, codes, counts=None):
+        '''
+        Add an array of kmer codes, each counted once or counts times.
+        '''
+        self.buffer.append(codes)
+        if counts is not None or self.buffer_counts:
+            if not self.buffer_counts:
+                self.buffer_counts = [np.ones(len(buffered), dtype=np.int64) for buffered in self.buffer[:-1]]
+            self.buffer_counts.append(np.ones(len(codes), dtype=np.int64) if counts is None else counts)
+        self.buffered += len(codes)
+
+        if self.buffered >= self.buffer_kmers:
+            self.spill(self.count_buffer())
+
+    def count_buffer(self):
+        '''
+        Sort and count the buffered codes.
+        '''
+        codes = np.concatenate(self.buffer) if self.buffer else np.zeros(0, dtype=np.uint64)
+        counts = np.concatenate(self.buffer_counts) if self.buffer_counts else None
+        self.buffer = []
+        self.buffer_counts = []
+        self.buffered = 0
+
+        if counts is not None:
+            return sum_Kmer_counts(codes, counts)
+
+        codes.sort()
+        if not len(codes):
+            return codes, np.zeros(0, dtype=np.uint32)
+
+        starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+        counts = np.diff(np.concatenate((starts, [len(codes)]))).astype(np.uint32)
+
+        return codes[starts], counts
+
+    def spill(self, run):
+        '''
+        Write a counted run to disk and keep it memory-mapped.
+        '''
+        fileNames = [os.path.join(self.tmp_dir, 'run_%s.%s.npy' % (len(self.runs), name))
+                     for name in ('codes', 'counts')]
+        for fileName, values in zip(fileNames, run):
+            np.save(fileName, values)
+
+        self.runs.append(tuple(np.load(fileName, mmap_mode='r') for fileName in fileNames))
+        self.num_spilled += len(run[0])
+
+    def Kmer_chunks(self):
+        '''
+        Yields the sorted (codes, counts) chunks of every kmer added.
+        '''
+        runs = self.runs + [self.count_buffer()]
+        runs = [run for run in runs if len(run[0])]
+
+        if len(runs) <= 1:
+            for codes, counts in runs:
+                for start in range(0, len(codes), self.buffer_kmers):
+                    yield codes[start:start + self.buffer_kmers], counts[start:start + self.buffer_kmers]
+            return
+
+        # Merge the runs one range of kmer prefixes at a time, with about
+        # buffer_kmers kmers in each range.
+        num_kmers = sum(len(codes) for codes, counts in runs)
+        prefix_bases = 0
+        while 4 ** prefix_bases * self.buffer_kmers < num_kmers and prefix_bases < min(self.k, MAX_MERGE_PREFIX_BASES):
+            prefix_bases += 1
+
+        bounds = [Kmer_prefix_bounds(codes, self.k, prefix_bases) for codes, counts in runs]
+        for prefix in range(4 ** prefix_bases):
+            slices = [(codes[run_bounds[prefix]:run_bounds[prefix + 1]], counts[run_bounds[prefix]:run_bounds[prefix + 1]])
+                      for (codes, counts), run_bounds in zip(runs, bounds)]
+
+            yield sum_Kmer_counts(np.concatenate([codes for codes, counts in slices]),
+                                  np.concatenate([counts for codes, counts in slices]))
+
+
+def count_Kmers(fasta_fileName, out_profile_fileName, k, logger, canonical=False, buffer_kmers=1 << 26,
+                tmp_dir=None, min_count=1, max_count=None, freq_fileName=None):
+    '''
+    Count the kmers of a fasta file into a binary kmer profile, and optionally
+    write its character frequencies to freq_fileName.
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='.Count_Kmers.', dir=tmp_dir or os.path.dirname(
+        os.path.abspath(out_profile_fileName)))
+    try:
+        counter = KmerCounter(k, buffer_kmers, tmp_dir)
+
+        num_kmers = 0
+        stats = {}
+        for seq in read_Fasta_chunks(fasta_fileName, max(min(FASTA_CHUNK_SIZE, buffer_kmers), k), overlap=k - 1,
+                                     stats=stats):
+            codes = encode_Fasta_Kmers(seq, k, canonical)
+            num_kmers += len(codes)
+            counter.add(codes)
+
+        logger.info('k-mer:%s\tkmers:%s\tspilled:%s in %s runs', k, num_kmers,
+                    counter.num_spilled, len(counter.runs))  # INFO
+
+        if freq_fileName is not None:
+            write_Character_Frequency(freq_fileName, stats['byte_counts'], stats['num_sequences'], logger)
+
+        write_Counted_Kmers(counter, out_profile_fileName, os.path.basename(fasta_fileName), logger,
+                            canonical=canonical, min_count=min_count, max_count=max_count)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def write_Counted_Kmers(counter, out_profile_fileName, source, logger, canonical=False, min_count=1, max_count=None):
+    '''
+    Write the kmers of a KmerCounter to a binary kmer profile, dropping the kmers
+    counted fewer than min_count or more than max_count times.
+    '''
+    flags = 0
+    metadata = {'source': source}
+    if canonical:
+        flags |= FLAG_CANONICAL
+        metadata['canonical'] = True
+
+    Kmer_chunks = counter.Kmer_chunks()
+
+    removed = {'num_kmers': 0, 'total_count': 0}
+    if min_count > 1 or max_count is not None:
+        Kmer_chunks = filter_Kmer_chunks(Kmer_chunks, min_count, max_count, removed)
+
+    profile = KmerProfileWriter(out_profile_fileName, counter.k, flags=flags)
+    for codes, counts in Kmer_chunks:
+        profile.write(codes, counts)
+
+    if min_count > 1 or max_count is not None:
+        metadata.update({'min_count': min_count, 'max_count': max_count,
+                         'removed_num_kmers': removed['num_kmers'], 'removed_total_count': removed['total_count']})
+        logger.info('Removed %s kmers (total count %s) outside the count range [%s, %s]',
+                    removed['num_kmers'], removed['total_count'], min_count, max_count)  # INFO
+    profile.close(metadata=metadata)
+
+    logger.info('Wrote %s kmers (total count %s) to %s', profile.num_kmers,
+                profile.total_count, out_profile_fileName)  # INFO
+
+
+def write_Character_Frequency(freq_fileName, byte_counts, num_sequences, logger):
+    '''
+    Write the ACGT frequencies, the number of sequences and the number of ACGT
+    characters in the format of Composition_of_InputSeqs.py. Lower case bases
+    are counted with the upper case ones.
+    '''
+    base_counts = [int(byte_counts[ord(base)] + byte_counts[ord(base.lower())]) for base in CODE_BASES]
+
+    total = float(sum(base_counts))
+    if not total:
+        logger.error('No ACGT characters to write the frequencies of: %s',
+                     freq_fileName)  # ERROR
+        sys.exit(1)
+
+    freq_fh = write_file_check_compression(freq_fileName)
+    for base, count in zip(CODE_BASES, base_counts):
+        freq_fh.write(base + '\t' + str(count / total) + '\n')
+    freq_fh.write('NUM_SEQUENCES\t' + str(num_sequences) + '\n')
+    freq_fh.write('NUM_CHARACTERS\t' + str(total) + '\n')
+    freq_fh.close()
+
+    logger.info('Wrote the frequencies of %s characters in %s sequences to %s',
+                int(total), num_sequences, freq_fileName)  # INFO
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,96 @@
 '''
 Functions used by multiple scripts.
 '''
+import io
 import os
 import sys
+import zlib
 import gzip
+import json
+import bisect
+import hashlib
+import shutil
+import struct
+import tempfile
+import multiprocessing
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# Binary k-mer profile (*.nkp) layout, all values little-endian:
+#   header   : magic, version, flags, k, number of k-mers, total count, metadata length
+#   codes    : number of k-mers x uint64, sorted 2-bit packed k-mers (A=0, C=1, G=2, T=3)
+#   counts   : number of k-mers x uint32, parallel to codes
+#   metadata : JSON dictionary (metadata length bytes)
+PROFILE_MAGIC = b'NKP1'
+PROFILE_VERSION = 1
+PROFILE_HEADER = struct.Struct('<4sHHIQQI')
+PROFILE_EXT = '.nkp'
+PROFILE_MAX_K = 32
+PROFILE_MAX_COUNT = np.iinfo(np.uint32).max
+
+# Profile flags.
+FLAG_CANONICAL = 1 << 0
+FLAG_SKETCH = 1 << 1
+
+# Canonical profiles (FLAG_CANONICAL) hold each kmer and its reverse complement as one entry,
+# the smaller of the two codes, with the sum of both counts (as counted by jellyfish count -C).
+
+# Sketches (KmerSet.21mer.sketch.nkp) are binary kmer profiles holding only the kmers whose
+# splitmix64 hash of the code is below 2^64 / sketch_scale (FracMinHash), so every sketch with
+# the same scale and seed keeps the same kmers. Their metadata records the scale and seed.
+SKETCH_EXT = '.sketch.nkp'
+SKETCH_SCALE = 1000
+SKETCH_HASH = 'splitmix64'
+MASK_64 = (1 << 64) - 1
+
+# Precomputed residuals (KmerSet<RESIDUAL_EXT>), all values little-endian:
+#   header    : magic, version, k, number of k-mers, metadata length
+#   residuals : number of k-mers x float64, kmer_count - NumKmers*Pw for each sorted k-mer
+#   metadata  : JSON dictionary with the content hash of the Kmer set and character frequency files
+RESIDUAL_MAGIC = b'NKR1'
+RESIDUAL_VERSION = 1
+RESIDUAL_HEADER = struct.Struct('<4sHHQI4x')
+RESIDUAL_EXT = '.Residuals'
+
+# Cached self scores (e.g. d2(X,X)) are stored next to the Kmer set as KmerSet<SELF_SCORE_EXT>.
+SELF_SCORE_EXT = '.SelfScore'
+
+# Content-addressed cache of counted kmers (Count_Kmers.py --cache_dir). Each entry is a folder
+# cache_dir/<key[:2]>/<key> named by the sha1 of the fasta file's content hash and the counting
+# options, holding read-only copies of the outputs made from it (ARTIFACT_PROFILE, ARTIFACT_FREQ).
+# Outputs are copied into and out of the cache, never linked, so writing over an output can not
+# change the cache entry (or the outputs of other folders).
+ARTIFACT_CACHE_VERSION = 1
+ARTIFACT_PROFILE = 'profile' + PROFILE_EXT
+ARTIFACT_FREQ = 'CharFreq'
+
+# jellyfish 2 count files (*.jf) start with the length of a JSON header as JELLYFISH_HEADER_DIGITS
+# decimal digits, followed by the header. In the binary/sorted format (the output of jellyfish count)
+# each entry is a kmer (key_len bits, 2-bit packed like the profile codes) and its count (counter_len
+# bytes), both little-endian. The entries are in hash order, not sorted by code.
+JELLYFISH_EXT = '.jf'
+JELLYFISH_HEADER_DIGITS = 9
+JELLYFISH_FORMAT = 'binary/sorted'
+
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+CODE_BASES = 'ACGT'
+
+# Block gzip files are concatenated gzip members holding up to BLOCK_GZIP_SIZE bytes each,
+# so zcat and gzip.open read them like any other gzip file. The members are compressed and
+# decompressed in parallel using the block index (file<BLOCK_INDEX_EXT>), little-endian:
+#   header : magic, version, number of blocks, size of the gzip file
+#   blocks : number of blocks x uint64 (compressed offset, uncompressed offset)
+BLOCK_GZIP_SIZE = 1 << 22
+BLOCK_INDEX_MAGIC = b'BGZI'
+BLOCK_INDEX_VERSION = 1
+BLOCK_INDEX_HEADER = struct.Struct('<4sHHQQ')
+BLOCK_INDEX_ENTRY = struct.Struct('<QQ')
+BLOCK_INDEX_EXT = '.bgzi'
+
+KmerProfile = namedtuple('KmerProfile', ['name', 'k', 'flags', 'num_kmers',
+                                         'total_count', 'codes', 'counts', 'metadata'])
 
 
 def read_file_check_compression(arg):
@@ -15,6 +102,10 @@ def read_file_check_compression(arg):
     else:
         # open with gzip if it has the *.gz extension
         if arg.endswith(".gz"):
+            # Block gzip files (see BlockGzipWriter) are decompressed in parallel.
+            block_index = load_block_index(arg)
+            if block_index is not None:
+                return BlockGzipReader(arg, block_index)
             return gzip.open(arg, 'rb')
         else:
             return open(arg, 'r')
@@ -36,11 +127,318 @@ def write_file_check_compression(arg):
     '''
     # open with gzip if it has the *.gz extension
     if arg.endswith(".gz"):
-        return gzip.open(arg, 'wb')
+        return BlockGzipWriter(arg)
     else:
         return open(arg, 'w')
 
 
+def codec_threads():
+    '''
+    Number of threads used to (de)compress block gzip files. The job scripts set
+    OMP_NUM_THREADS to the number of CPUs reserved, otherwise all CPUs are used.
+    '''
+    try:
+        return max(1, int(os.environ.get('OMP_NUM_THREADS', '')))
+    except ValueError:
+        return multiprocessing.cpu_count()
+
+
+def compress_gzip_block(data, level=6):
+    '''
+    Compresses data into one complete gzip member.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_gzip_block(fileName, offset, length):
+    '''
+    Reads and decompresses the gzip member at offset. Every call uses its own
+    file handle so blocks can be decompressed by several threads at once.
+    '''
+    with open(fileName, 'rb') as fh:
+        fh.seek(offset)
+        data = fh.read(length)
+
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def write_block_index(fileName, blocks, compressed_size):
+    '''
+    Writes the (compressed offset, uncompressed offset) of each block of a block
+    gzip file to file<BLOCK_INDEX_EXT>.
+    '''
+    index_fileName = fileName + BLOCK_INDEX_EXT
+    tmp_fileName = '%s.%s.tmp' % (index_fileName, os.getpid())
+
+    with open(tmp_fileName, 'wb') as fh:
+        fh.write(BLOCK_INDEX_HEADER.pack(BLOCK_INDEX_MAGIC, BLOCK_INDEX_VERSION, 0,
+                                         len(blocks), compressed_size))
+        for compressed_offset, uncompressed_offset in blocks:
+            fh.write(BLOCK_INDEX_ENTRY.pack(compressed_offset, uncompressed_offset))
+
+    os.rename(tmp_fileName, index_fileName)
+
+
+def load_block_index(fileName):
+    '''
+    Loads the block index of a block gzip file.
+
+    Returns a list of (compressed offset, compressed length, uncompressed offset) for
+    each block, or None if there is no index or the gzip file was changed after it.
+    '''
+    index_fileName = fileName + BLOCK_INDEX_EXT
+    if not os.path.exists(index_fileName):
+        return None
+
+    # The index is written after the gzip file is closed.
+    if os.path.getmtime(index_fileName) < os.path.getmtime(fileName):
+        return None
+
+    with open(index_fileName, 'rb') as fh:
+        header = fh.read(BLOCK_INDEX_HEADER.size)
+        if len(header) != BLOCK_INDEX_HEADER.size or not header.startswith(BLOCK_INDEX_MAGIC):
+            return None
+
+        magic, version, reserved, num_blocks, compressed_size = BLOCK_INDEX_HEADER.unpack(
+            header)
+        if version > BLOCK_INDEX_VERSION or compressed_size != os.path.getsize(fileName):
+            return None
+
+        entries = fh.read(BLOCK_INDEX_ENTRY.size * num_blocks)
+        if len(entries) != BLOCK_INDEX_ENTRY.size * num_blocks:
+            return None
+
+    offsets = [BLOCK_INDEX_ENTRY.unpack_from(entries, BLOCK_INDEX_ENTRY.size * i)
+               for i in range(num_blocks)]
+    ends = [compressed_offset for compressed_offset, uncompressed_offset in offsets[1:]]
+    ends.append(compressed_size)
+
+    return [(compressed_offset, end - compressed_offset, uncompressed_offset)
+            for (compressed_offset, uncompressed_offset), end in zip(offsets, ends)]
+
+
+class BlockGzipWriter(object):
+    '''
+    Writes a gzip file as independently compressed blocks (gzip members) using a
+    pool of threads, plus a block index so the file can be read back in parallel.
+
+    The blocks are written in order, and at most 2 blocks per thread are held in
+    memory. The caller has to close the writer (or use it in a with statement),
+    which writes the last block and the block index.
+    '''
+
+    def __init__(self, fileName, block_size=BLOCK_GZIP_SIZE, threads=None, level=6):
+        self.name = fileName
+        self.mode = 'wb'
+        self.closed = False
+
+        self.block_size = block_size
+        self.level = level
+        self.threads = threads or codec_threads()
+
+        self.buffer = []
+        self.buffer_size = 0
+        self.pending = deque()
+        self.blocks = []
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+
+        self.fh = open(fileName, 'wb')
+        self.pool = ThreadPool(self.threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+
+        if self.buffer_size >= self.block_size:
+            self.submit_blocks()
+
+    def submit_blocks(self):
+        '''
+        Hands the buffered data to the thread pool in blocks of block_size.
+        '''
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+
+        for start in range(0, len(data), self.block_size):
+            block = data[start:start + self.block_size]
+            self.pending.append((len(block), self.pool.apply_async(
+                compress_gzip_block, (block, self.level))))
+
+            while len(self.pending) > 2 * self.threads:
+                self.write_block()
+
+    def write_block(self):
+        '''
+        Waits for the oldest pending block and appends it to the file.
+        '''
+        block_size, result = self.pending.popleft()
+        member = result.get()
+
+        self.fh.write(member)
+        self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+        self.compressed_offset += len(member)
+        self.uncompressed_offset += block_size
+
+    def flush(self):
+        self.submit_blocks()
+        while self.pending:
+            self.write_block()
+        self.fh.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.flush()
+
+        # An empty file still needs one gzip member to be a valid gzip file.
+        if not self.blocks:
+            self.pending.append((0, self.pool.apply_async(compress_gzip_block, (b'', self.level))))
+            self.write_block()
+
+        self.closed = True
+        self.pool.close()
+        self.pool.join()
+        self.fh.close()
+
+        write_block_index(self.name, self.blocks, self.compressed_offset)
+
+
+class BlockGzipReader(object):
+    '''
+    Reads a block gzip file (see BlockGzipWriter). A pool of threads decompresses
+    up to read_ahead blocks ahead of the reader, in order. Supports read, readline,
+    iterating over lines, seek (using the block index) and tell, like gzip.open(..., 'rb').
+    '''
+
+    def __init__(self, fileName, block_index, threads=None, read_ahead=None):
+        self.name = fileName
+        self.mode = 'rb'
+        self.closed = False
+
+        self.block_index = block_index
+        self.block_starts = [uncompressed_offset for compressed_offset,
+                             compressed_length, uncompressed_offset in block_index]
+
+        self.threads = threads or codec_threads()
+        self.read_ahead = read_ahead or 2 * self.threads
+        self.pool = ThreadPool(self.threads)
+
+        self.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def fill_read_ahead(self):
+        while len(self.pending) < self.read_ahead and self.next_block < len(self.block_index):
+            compressed_offset, compressed_length, uncompressed_offset = self.block_index[self.next_block]
+            self.pending.append(self.pool.apply_async(
+                decompress_gzip_block, (self.name, compressed_offset, compressed_length)))
+            self.next_block += 1
+
+    def read_block(self):
+        '''
+        Moves the next decompressed block into the buffer. Returns False at the end of the file.
+        '''
+        if not self.pending:
+            return False
+
+        block = self.pending.popleft().get()
+        self.fill_read_ahead()
+
+        # Only a partial line (see readline) is carried over into the new block.
+        if self.buffer_pos < len(self.buffer):
+            block = self.buffer[self.buffer_pos:] + block
+        self.buffer = block
+        self.buffer_pos = 0
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence != 0:
+            raise ValueError('Block gzip files can only seek from the start or current position')
+
+        # Restart the read ahead from the block holding offset.
+        block = max(bisect.bisect_right(self.block_starts, offset) - 1, 0)
+
+        self.pending = deque()
+        self.next_block = block
+        self.buffer = b''
+        self.buffer_pos = 0
+        self.position = self.block_starts[block] if self.block_starts else 0
+        self.fill_read_ahead()
+
+        if offset > self.position:
+            self.read(offset - self.position)
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        pieces = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            available = len(self.buffer) - self.buffer_pos
+            if not available:
+                if not self.read_block():
+                    break
+                continue
+
+            piece_size = available if size < 0 else min(available, remaining)
+            pieces.append(self.buffer[self.buffer_pos:self.buffer_pos + piece_size])
+            self.buffer_pos += piece_size
+            remaining -= piece_size
+
+        data = b''.join(pieces)
+        self.position += len(data)
+
+        return data
+
+    def readline(self):
+        end = self.buffer.find(b'\n', self.buffer_pos)
+        while end < 0:
+            searched = len(self.buffer) - self.buffer_pos
+            if not self.read_block():
+                break
+            end = self.buffer.find(b'\n', searched)
+
+        return self.read(end + 1 - self.buffer_pos if end >= 0 else -1)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.pending = deque()
+        self.pool.terminate()
+        self.pool.join()
+
+
 def pass_column_file(fh, sep='\t'):
     '''
     Takes a file with columns seperated by 'sep' and yields each line:
@@ -64,6 +462,957 @@ def pass_column_file(fh, sep='\t'):
         yield line.split(sep)
 
 
+def read_Kmer_chunks(fh, chunk_size=1 << 20, block_size=1 << 26):
+    '''
+    Reads a text kmer file created by Kmers_2_NumbericRepresentation.py and yields
+    (codes, counts) numpy arrays of up to chunk_size kmers.
+
+    The file is read block_size bytes at a time and each block is split into its
+    columns with numpy instead of line by line. The codes are packed from the
+    kmer_seq column (the kmer_value column holds the same base 4 digits, but
+    without leading zeros), so the value column is never parsed.
+    '''
+    rest = b''
+    k = None
+    while True:
+        block = fh.read(block_size)
+        if not isinstance(block, bytes):
+            block = block.encode('utf-8')
+
+        if block:
+            # Only parse up to the last complete line, keep the rest for the next block.
+            end = block.rfind(b'\n') + 1
+            if not end:
+                rest += block
+                continue
+            lines, rest = rest + block[:end], block[end:]
+        elif rest:
+            lines, rest = rest + b'\n', b''
+        else:
+            break
+
+        if k is None:
+            k = first_Kmer_size(lines)
+            if k is None:
+                continue
+
+        codes, counts = parse_Kmer_block(lines, k, getattr(fh, 'name', 'kmer file'))
+
+        for start in range(0, len(codes), chunk_size):
+            yield codes[start:start + chunk_size], counts[start:start + chunk_size]
+
+
+def first_Kmer_size(lines):
+    '''
+    Length of the kmer_seq column of the first kmer line in a block of lines.
+    '''
+    for columns in pass_column_file(io.BytesIO(lines)):
+        return len(columns[1])
+
+    return None
+
+
+# Maps the bases of a kmer_seq (either case) to their 2 bit codes, anything else to 255.
+BASE_CODE_TABLE = np.full(256, 255, dtype=np.uint8)
+for base, base_code in BASE_CODES.items():
+    BASE_CODE_TABLE[ord(base)] = BASE_CODE_TABLE[ord(base.lower())] = base_code
+
+
+def column_bytes(buf, column_starts, width):
+    '''
+    Copies the width bytes starting at each of column_starts out of buf as a
+    (len(column_starts), width) array, using a view whose row i starts at buf[i].
+    '''
+    windows = np.lib.stride_tricks.as_strided(
+        buf, shape=(len(buf) - width + 1, width), strides=(1, 1))
+    return windows[column_starts]
+
+
+def parse_Kmer_block(lines, k, fileName):
+    '''
+    Splits a block of complete kmer_value<\t>kmer_seq<\t>kmer_count lines into
+    codes and counts arrays. Blank and comment lines are skipped.
+    '''
+    if k > PROFILE_MAX_K:
+        sys.exit('ERROR: Kmers longer than %s do not fit into 64 bit codes (k=%s in %s)!' %
+                 (PROFILE_MAX_K, k, fileName))
+
+    buf = np.frombuffer(lines, dtype=np.uint8)
+
+    ends = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+
+    # Drop the '\r' of Windows line endings.
+    ends = ends - (buf[np.maximum(ends - 1, 0)] == ord('\r')) * (ends > starts)
+
+    # Ignore blank and comment lines (and the tabs they hold).
+    keep = (ends > starts) & (buf[np.minimum(starts, len(buf) - 1)] != ord('#'))
+    tabs = np.flatnonzero(buf == ord('\t'))
+    if not keep.all():
+        tabs = tabs[keep[np.searchsorted(ends, tabs)]]
+        starts, ends = starts[keep], ends[keep]
+
+    if len(tabs) != 2 * len(starts):
+        sys.exit('ERROR: Kmer lines in %s do not have 3 tab separated columns!' % fileName)
+
+    tabs = tabs.reshape(-1, 2)
+    if np.any(tabs[:, 1] - tabs[:, 0] - 1 != k) or np.any(tabs[:, 1] + 1 >= ends):
+        sys.exit('ERROR: Kmer lines in %s do not all have a kmer_seq of length %s!' %
+                 (fileName, k))
+
+    if not len(starts):
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+
+    # Pack the kmer_seq column one base at a time (transposed so each base is contiguous).
+    base_codes = BASE_CODE_TABLE[column_bytes(buf, tabs[:, 0] + 1, k).T]
+    if np.any(base_codes == 255):
+        sys.exit('ERROR: Kmers in %s contain bases other than %s!' %
+                 (fileName, CODE_BASES))
+
+    codes = np.zeros(len(starts), dtype=np.uint64)
+    for i in range(k):
+        codes <<= np.uint64(2)
+        codes |= base_codes[i]
+
+    # Right align the kmer_count digits and add them up by their place value.
+    num_digits = ends - tabs[:, 1] - 1
+    max_digits = int(num_digits.max()) if len(num_digits) else 0
+    if max_digits > 18:
+        sys.exit('ERROR: Kmer counts in %s are too large!' % fileName)
+
+    digits = column_bytes(buf, ends - max_digits, max_digits).astype(np.int64) - ord('0')
+    has_digit = np.arange(max_digits, 0, -1) <= num_digits[:, None]
+    if np.any(has_digit & ((digits < 0) | (digits > 9))):
+        sys.exit('ERROR: Kmer counts in %s are not integers!' % fileName)
+
+    counts = np.where(has_digit, digits, 0).dot(10 ** np.arange(max_digits - 1, -1, -1, dtype=np.int64))
+
+    return codes, counts
+
+
+def encode_Kmer_seq(Kmer_seq):
+    '''
+    Packs a kmer sequence into an integer using 2 bits per base.
+    '''
+    code = 0
+    for base in Kmer_seq:
+        code = (code << 2) | BASE_CODES[base]
+    return code
+
+
+def decode_Kmer_code(code, k):
+    '''
+    Unpacks a 2-bit packed kmer code back into its sequence.
+    '''
+    return ''.join(CODE_BASES[(code >> (2 * (k - i - 1))) & 3] for i in range(k))
+
+
+def read_Fasta_chunks(fileName, chunk_size=1 << 24, overlap=0, stats=None):
+    '''
+    Yields the sequences of a fasta file (can be gziped) as uint8 arrays of up to
+    about chunk_size bases. Long sequences are split into chunks that overlap by
+    overlap bases (k - 1 for kmers), so no kmer is lost or counted twice.
+
+    If a stats dict is given, the number of sequences ('num_sequences') and how
+    often each byte value occurs in them ('byte_counts') are added up in it.
+    '''
+    fh = read_file_check_compression(fileName) if fileName.endswith('.gz') else open(fileName, 'rb')
+
+    if stats is not None:
+        stats.setdefault('num_sequences', 0)
+        stats.setdefault('byte_counts', np.zeros(256, dtype=np.int64))
+
+    def sequence_chunk(parts, carried):
+        chunk = np.frombuffer(b''.join(parts), dtype=np.uint8)
+        # The bases carried over from the chunk before have been counted already.
+        if stats is not None:
+            stats['byte_counts'] += np.bincount(chunk[carried:], minlength=256)
+        return chunk
+
+    parts = []
+    length = 0
+    new_bases = 0
+    carried = 0
+    try:
+        for line in fh:
+            if line.startswith(b'>'):
+                if new_bases:
+                    yield sequence_chunk(parts, carried)
+                parts, length, new_bases, carried = [], 0, 0, 0
+                if stats is not None:
+                    stats['num_sequences'] += 1
+                continue
+
+            line = line.rstrip()
+            parts.append(line)
+            length += len(line)
+            new_bases += len(line)
+
+            if length >= chunk_size:
+                chunk = sequence_chunk(parts, carried)
+                yield chunk
+                parts = [chunk[len(chunk) - overlap:].tobytes()] if overlap else []
+                length = carried = len(parts[0]) if parts else 0
+                new_bases = 0
+
+        if new_bases:
+            yield sequence_chunk(parts, carried)
+    finally:
+        fh.close()
+
+
+def encode_Fasta_Kmers(seq, k, canonical=False):
+    '''
+    Rolls a 2-bit encoding over a sequence (uint8 array, either case) and returns the
+    code of every kmer in it, in order. Kmers with any base other than ACGT are
+    skipped. With canonical each kmer is collapsed with its reverse complement.
+    '''
+    num_kmers = len(seq) - k + 1
+    if num_kmers <= 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    bases = BASE_CODE_TABLE[seq]
+
+    # A kmer is valid if there is no invalid base among its k bases.
+    invalid = np.concatenate(([0], np.cumsum(bases == 255)))
+    valid = invalid[k:] == invalid[:-k]
+
+    bases = (bases & 3).astype(np.uint64)
+    codes = np.zeros(num_kmers, dtype=np.uint64)
+    for i in range(k):
+        codes = (codes << np.uint64(2)) | bases[i:i + num_kmers]
+
+    if canonical:
+        reverse = np.zeros(num_kmers, dtype=np.uint64)
+        for i in range(k):
+            reverse |= (np.uint64(3) - bases[i:i + num_kmers]) << np.uint64(2 * i)
+        codes = np.minimum(codes, reverse)
+
+    return codes[valid]
+
+
+def read_Jellyfish_header(fh):
+    '''
+    Reads the JSON header at the start of an open jellyfish count file. The file
+    is left at the first entry.
+    '''
+    length = fh.read(JELLYFISH_HEADER_DIGITS)
+    if len(length) != JELLYFISH_HEADER_DIGITS or not length.isdigit():
+        sys.exit('ERROR: Not a jellyfish count file: %s' % fh.name)
+
+    text = fh.read(int(length)).decode('utf-8')
+    try:
+        # The header can be padded after the JSON object.
+        header, end = json.JSONDecoder().raw_decode(text.strip())
+    except ValueError:
+        sys.exit('ERROR: Can not read the header of the jellyfish count file: %s' % fh.name)
+
+    return header
+
+
+def open_Jellyfish_counts(fileName, chunk_size=1 << 22):
+    '''
+    Opens a jellyfish count file (binary/sorted format). Returns the kmer size, the
+    header and a generator of (codes, counts) chunks, in the order of the file.
+    '''
+    fh = open(fileName, 'rb')
+    header = read_Jellyfish_header(fh)
+
+    if header.get('format') != JELLYFISH_FORMAT:
+        fh.close()
+        sys.exit('ERROR: Only the %s jellyfish format can be read, not %s: %s' %
+                 (JELLYFISH_FORMAT, header.get('format'), fileName))
+
+    key_len, counter_len = header['key_len'], header['counter_len']
+    k = key_len // 2
+    if not 0 < k <= PROFILE_MAX_K or not 0 < counter_len <= 8:
+        fh.close()
+        sys.exit('ERROR: Unsupported jellyfish key_len or counter_len (%s, %s): %s' %
+                 (key_len, counter_len, fileName))
+
+    key_bytes = (key_len + 7) // 8
+    entry_bytes = key_bytes + counter_len
+
+    def little_endian_values(columns):
+        padded = np.zeros((len(columns), 8), dtype=np.uint8)
+        padded[:, :columns.shape[1]] = columns
+        return padded.view('<u8').ravel()
+
+    def Kmer_chunks():
+        try:
+            while True:
+                data = fh.read(chunk_size * entry_bytes)
+                if not data:
+                    break
+                if len(data) % entry_bytes:
+                    sys.exit('ERROR: Truncated jellyfish count file: %s' % fileName)
+
+                entries = np.frombuffer(data, dtype=np.uint8).reshape(-1, entry_bytes)
+                codes = little_endian_values(entries[:, :key_bytes]).astype(np.uint64)
+                counts = little_endian_values(entries[:, key_bytes:]).astype(np.int64)
+                yield codes, counts
+        finally:
+            fh.close()
+
+    return k, header, Kmer_chunks()
+
+
+def is_Kmer_profile(fileName):
+    '''
+    Check if the file is a binary kmer profile (rather than a text nkc file).
+    '''
+    with open(fileName, 'rb') as fh:
+        return fh.read(len(PROFILE_MAGIC)) == PROFILE_MAGIC
+
+
+def load_Kmer_profile(fileName):
+    '''
+    Opens a binary kmer profile. The codes and counts are memory-mapped, so
+    nothing is read from disk until it is used.
+    '''
+    with open(fileName, 'rb') as fh:
+        header = fh.read(PROFILE_HEADER.size)
+
+        if len(header) != PROFILE_HEADER.size or not header.startswith(PROFILE_MAGIC):
+            sys.exit('ERROR: The file %s is not a binary kmer profile!' % fileName)
+
+        magic, version, flags, k, num_kmers, total_count, meta_len = PROFILE_HEADER.unpack(
+            header)
+
+        if version > PROFILE_VERSION:
+            sys.exit('ERROR: The kmer profile %s has unsupported version %s!' %
+                     (fileName, version))
+
+        codes_offset = PROFILE_HEADER.size
+        counts_offset = codes_offset + 8 * num_kmers
+        meta_offset = counts_offset + 4 * num_kmers
+
+        metadata = {}
+        if meta_len:
+            fh.seek(meta_offset)
+            metadata = json.loads(fh.read(meta_len).decode('utf-8'))
+
+    # np.memmap can not map zero bytes.
+    if num_kmers:
+        codes = np.memmap(fileName, dtype='<u8', mode='r',
+                          offset=codes_offset, shape=(num_kmers,))
+        counts = np.memmap(fileName, dtype='<u4', mode='r',
+                           offset=counts_offset, shape=(num_kmers,))
+    else:
+        codes = np.zeros(0, dtype='<u8')
+        counts = np.zeros(0, dtype='<u4')
+
+    return KmerProfile(fileName, k, flags, num_kmers, total_count, codes, counts, metadata)
+
+
+class KmerProfileWriter(object):
+    '''
+    Writes a binary kmer profile one block of sorted codes and counts at a time.
+
+    The counts are spooled to a temporary file next to the output and appended
+    after the last block, so the number of kmers does not need to be known
+    up front.
+
+    Counts above PROFILE_MAX_COUNT are stored as PROFILE_MAX_COUNT, and the
+    total count in the header is the sum of the stored counts.
+    '''
+
+    def __init__(self, fileName, k, flags=0):
+        if not 0 < k <= PROFILE_MAX_K:
+            sys.exit('ERROR: Binary kmer profiles support k <= %s (got %s)!' %
+                     (PROFILE_MAX_K, k))
+
+        self.name = fileName
+        self.k = k
+        self.flags = flags
+        self.num_kmers = 0
+        self.total_count = 0
+        self.last_code = None
+
+        self.fh = open(fileName, 'wb')
+        self.fh.write(b'\0' * PROFILE_HEADER.size)
+        self.counts_fh = tempfile.TemporaryFile(
+            dir=os.path.dirname(os.path.abspath(fileName)))
+
+    def write(self, codes, counts):
+        '''
+        Append a block of codes (sorted, strictly increasing) and their counts.
+        '''
+        codes = np.asarray(codes, dtype='<u8')
+        counts = np.asarray(counts)
+
+        if not len(codes):
+            return
+
+        # Check that every code is > the one before it, thus sorted correctly.
+        if np.any(codes[1:] <= codes[:-1]) or (self.last_code is not None and codes[0] <= self.last_code):
+            sys.exit('ERROR: Kmers written to %s are not sorted!' % self.name)
+        self.last_code = codes[-1]
+
+        self.fh.write(codes.tobytes())
+        counts = np.minimum(counts, PROFILE_MAX_COUNT).astype('<u4')
+        self.counts_fh.write(counts.tobytes())
+
+        self.num_kmers += len(codes)
+        self.total_count += int(counts.sum(dtype=np.uint64))
+
+    def close(self, metadata=None):
+        '''
+        Append the counts and metadata, then fill in the header.
+        '''
+        self.counts_fh.seek(0)
+        shutil.copyfileobj(self.counts_fh, self.fh, 1 << 24)
+        self.counts_fh.close()
+
+        meta = json.dumps(metadata or {}, sort_keys=True).encode('utf-8')
+        self.fh.write(meta)
+
+        self.fh.seek(0)
+        self.fh.write(PROFILE_HEADER.pack(PROFILE_MAGIC, PROFILE_VERSION, self.flags, self.k,
+                                          self.num_kmers, self.total_count, len(meta)))
+        self.fh.close()
+
+
+def profile_Kmer_chunks(profile, chunk_size=1 << 22, start=0, stop=None):
+    '''
+    Yields (codes, counts) slices of up to chunk_size kmers from a binary kmer
+    profile, optionally limited to the kmers [start, stop).
+    '''
+    if stop is None:
+        stop = profile.num_kmers
+
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        yield profile.codes[chunk_start:chunk_stop], profile.counts[chunk_start:chunk_stop]
+
+
+def Kmer_prefix_bounds(codes, k, prefix_bases):
+    '''
+    Splits sorted codes by their leading prefix_bases bases. The kmers starting
+    with the prefix whose code is i are codes[bounds[i]:bounds[i + 1]].
+    '''
+    shift = np.uint64(2 * (k - prefix_bases))
+    prefixes = np.arange(1, 4 ** prefix_bases, dtype=np.uint64) << shift
+
+    return np.concatenate(([0], np.searchsorted(codes, prefixes), [len(codes)])).astype(np.int64)
+
+
+def text_Kmer_chunks(fh, chunk_size=1 << 22):
+    '''
+    Yields (codes, counts) chunks from an open text kmer file and closes it once done.
+    '''
+    try:
+        for codes, counts in read_Kmer_chunks(fh, chunk_size):
+            yield codes, counts
+    finally:
+        fh.close()
+
+
+def open_Kmer_set(fileName, chunk_size=1 << 22):
+    '''
+    Opens a text kmer file or a binary kmer profile.
+
+    Returns the kmer size and a generator of sorted (codes, counts) chunks.
+    '''
+    if is_Kmer_profile(fileName):
+        profile = load_Kmer_profile(fileName)
+        return profile.k, profile_Kmer_chunks(profile, chunk_size)
+
+    fh = read_file_check_compression(fileName)
+
+    # The kmer size of a text file is the length of its first kmer_seq.
+    first_line = next(pass_column_file(fh), None)
+    if first_line is None:
+        sys.exit('ERROR: The file %s does not contain any kmers!' % fileName)
+    fh.seek(0)
+
+    return len(first_line[1]), text_Kmer_chunks(fh, chunk_size)
+
+
+def merge_Kmer_chunks(KmerSet1_chunks, KmerSet2_chunks):
+    '''
+    Merges two generators of sorted (codes, counts) chunks into aligned pieces:
+            KmerSet1_codes, KmerSet1_counts, KmerSet2_codes, KmerSet2_counts
+
+    Each yielded piece covers the same range of codes in both sets, so every
+    kmer of either set is yielded exactly once and shared kmers always end up
+    in the same piece.
+    '''
+    empty = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+    KmerSet1_codes, KmerSet1_counts = next(KmerSet1_chunks, empty)
+    KmerSet2_codes, KmerSet2_counts = next(KmerSet2_chunks, empty)
+
+    while len(KmerSet1_codes) or len(KmerSet2_codes):
+
+        # If one set is done the rest of the other set has nothing to pair with.
+        if not len(KmerSet2_codes):
+            yield KmerSet1_codes, KmerSet1_counts, empty[0], empty[1]
+            KmerSet1_codes, KmerSet1_counts = next(KmerSet1_chunks, empty)
+            continue
+
+        if not len(KmerSet1_codes):
+            yield empty[0], empty[1], KmerSet2_codes, KmerSet2_counts
+            KmerSet2_codes, KmerSet2_counts = next(KmerSet2_chunks, empty)
+            continue
+
+        # Everything up to the smaller of the two last codes can be compared now,
+        # which uses up at least one of the chunks.
+        bound = min(KmerSet1_codes[-1], KmerSet2_codes[-1])
+        KmerSet1_end = np.searchsorted(KmerSet1_codes, bound, side='right')
+        KmerSet2_end = np.searchsorted(KmerSet2_codes, bound, side='right')
+
+        yield (KmerSet1_codes[:KmerSet1_end], KmerSet1_counts[:KmerSet1_end],
+               KmerSet2_codes[:KmerSet2_end], KmerSet2_counts[:KmerSet2_end])
+
+        KmerSet1_codes, KmerSet1_counts = KmerSet1_codes[KmerSet1_end:], KmerSet1_counts[KmerSet1_end:]
+        KmerSet2_codes, KmerSet2_counts = KmerSet2_codes[KmerSet2_end:], KmerSet2_counts[KmerSet2_end:]
+
+        if not len(KmerSet1_codes):
+            KmerSet1_codes, KmerSet1_counts = next(KmerSet1_chunks, empty)
+        if not len(KmerSet2_codes):
+            KmerSet2_codes, KmerSet2_counts = next(KmerSet2_chunks, empty)
+
+
+def intersect_Kmer_codes(KmerSet1_codes, KmerSet2_codes):
+    '''
+    Finds the kmers shared by two sorted code arrays.
+
+    Returns the indices of the shared kmers in KmerSet1_codes and KmerSet2_codes.
+    '''
+    if not len(KmerSet1_codes) or not len(KmerSet2_codes):
+        no_kmers = np.zeros(0, dtype=np.intp)
+        return no_kmers, no_kmers
+
+    KmerSet2_index = np.searchsorted(KmerSet2_codes, KmerSet1_codes)
+    np.minimum(KmerSet2_index, len(KmerSet2_codes) - 1, out=KmerSet2_index)
+    shared = KmerSet2_codes[KmerSet2_index] == KmerSet1_codes
+
+    return np.flatnonzero(shared), KmerSet2_index[shared]
+
+
+def Kmer_base_counts(codes, k):
+    '''
+    Counts the number of A, C, G and T's (columns) in each 2-bit packed kmer code (rows).
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+    base_counts = np.zeros((len(codes), len(CODE_BASES)), dtype=np.uint8)
+    bases = np.arange(len(CODE_BASES), dtype=np.uint64)
+
+    for i in range(k):
+        base = (codes >> np.uint64(2 * i)) & np.uint64(3)
+        base_counts += base[:, None] == bases
+
+    return base_counts
+
+
+def reverse_complement_Kmer_codes(codes, k):
+    '''
+    Reverse complements 2-bit packed kmer codes (the complement of a base is 3 - base).
+    '''
+    codes = np.asarray(codes, dtype=np.uint64) ^ np.uint64((1 << (2 * k)) - 1)
+    reverse = np.zeros(len(codes), dtype=np.uint64)
+
+    for i in range(k):
+        reverse = (reverse << np.uint64(2)) | ((codes >> np.uint64(2 * i)) & np.uint64(3))
+
+    return reverse
+
+
+def canonical_Kmer_profile(codes, counts, k):
+    '''
+    Collapses each kmer with its reverse complement into the smaller of the two codes.
+    Kmers already collapsed (e.g. by jellyfish count -C) are left as they are.
+
+    Returns the sorted canonical codes and their summed counts.
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+
+    return sum_Kmer_counts(np.minimum(codes, reverse_complement_Kmer_codes(codes, k)), counts)
+
+
+def sum_Kmer_counts(codes, counts):
+    '''
+    Sorts (unsorted, repeated) kmer codes and sums the counts of each code.
+
+    Returns the sorted unique codes and their summed counts.
+    '''
+    codes = np.asarray(codes, dtype=np.uint64)
+    order = np.argsort(codes, kind='mergesort')
+    codes = codes[order]
+
+    if not len(codes):
+        return codes, np.zeros(0, dtype=np.int64)
+
+    starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+
+    return codes[starts], np.add.reduceat(np.asarray(counts, dtype=np.int64)[order], starts)
+
+
+def is_canonical_Kmer_set(fileName, canonical=False):
+    '''
+    Checks if a Kmer set holds canonical kmers. Binary kmer profiles record it in their
+    flags, text kmer files are canonical when the caller says so (canonical=True).
+    '''
+    if not is_Kmer_profile(fileName):
+        return canonical
+
+    flagged = bool(load_Kmer_profile(fileName).flags & FLAG_CANONICAL)
+    if canonical and not flagged:
+        sys.exit('ERROR: The kmer profile %s is not canonical, convert it with '
+                 'Convert_Kmer_Profile.py --canonical!' % fileName)
+
+    return flagged
+
+
+def hash_Kmer_codes(codes, seed=0):
+    '''
+    splitmix64 hash of 2-bit packed kmer codes (wraps around like 64 bit integers).
+    '''
+    z = np.asarray(codes, dtype=np.uint64) + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & MASK_64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def sketch_threshold(sketch_scale):
+    '''
+    Kmers whose hash is below the threshold are kept in a sketch.
+    '''
+    return (1 << 64) // sketch_scale
+
+
+def sketch_Kmer_chunks(Kmer_chunks, sketch_scale=SKETCH_SCALE, seed=0):
+    '''
+    Keeps the kmers of (codes, counts) chunks that belong in a sketch.
+    '''
+    threshold = np.uint64(sketch_threshold(sketch_scale))
+    for codes, counts in Kmer_chunks:
+        keep = hash_Kmer_codes(codes, seed) < threshold
+        yield codes[keep], counts[keep]
+
+
+def filter_Kmer_chunks(Kmer_chunks, min_count=1, max_count=None, removed=None):
+    '''
+    Keeps the kmers of (codes, counts) chunks counted at least min_count and at most
+    max_count times. The number and total count of the dropped kmers are added to
+    removed['num_kmers'] and removed['total_count'] if a dict is given.
+    '''
+    for codes, counts in Kmer_chunks:
+        keep = counts >= min_count
+        if max_count is not None:
+            keep &= counts <= max_count
+
+        if removed is not None:
+            removed['num_kmers'] = removed.get('num_kmers', 0) + int(len(keep) - np.count_nonzero(keep))
+            removed['total_count'] = removed.get('total_count', 0) + int(counts[~keep].sum())
+        yield codes[keep], counts[keep]
+
+
+def hash_files(*fileNames):
+    '''
+    Content hash (sha1) of one or more files.
+    '''
+    digest = hashlib.sha1()
+    for fileName in fileNames:
+        with open(fileName, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 24), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def file_stamps(*fileNames):
+    '''
+    Size and modification time of one or more files. Used to skip rehashing
+    files that have not been touched.
+    '''
+    return [[os.path.getsize(fileName), os.path.getmtime(fileName)] for fileName in fileNames]
+
+
+def check_cache_entry(entry, *fileNames):
+    '''
+    Checks the files still match the content hash ('digest') of a cache entry.
+    The files are only rehashed if their size or modification time differ from
+    the entry's 'stamps', in which case the entry's stamps are refreshed (the
+    caller writes the entry back).
+
+    Returns a tuple of:
+        True if the files match, True if the stamps were refreshed
+    '''
+    stamps = file_stamps(*fileNames)
+    if entry.get('stamps') == stamps:
+        return True, False
+
+    if entry.get('digest') != hash_files(*fileNames):
+        return False, False
+
+    entry['stamps'] = stamps
+    return True, True
+
+
+def Kmer_count_cache_key(fasta_fileName, k, canonical=False, min_count=1, max_count=None):
+    '''
+    Key of the artifact cache entry holding the kmers of a fasta file counted
+    with these options.
+    '''
+    key = {'version': ARTIFACT_CACHE_VERSION, 'fasta': hash_files(fasta_fileName), 'k': k,
+           'canonical': bool(canonical), 'min_count': min_count, 'max_count': max_count}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def copy_file(source, target):
+    '''
+    Copies source to target, replacing target. The copy is made next to target
+    and renamed over it, so target is never partly written.
+    '''
+    fd, tmp_fileName = tempfile.mkstemp(prefix='.' + os.path.basename(target) + '.',
+                                        dir=os.path.dirname(os.path.abspath(target)))
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp_fileName)
+        os.chmod(tmp_fileName, 0o644)
+        os.rename(tmp_fileName, target)
+    except BaseException:
+        os.remove(tmp_fileName)
+        raise
+
+
+def fetch_cached_artifacts(cache_dir, key, artifacts):
+    '''
+    Copies the files of a cache entry to their outputs. artifacts maps the
+    name of each file in the entry to its output.
+
+    Returns True if the entry held every file, False otherwise (nothing is copied).
+    '''
+    entry = os.path.join(cache_dir, key[:2], key)
+    if not all(os.path.exists(os.path.join(entry, name)) for name in artifacts):
+        return False
+
+    for name, fileName in artifacts.items():
+        copy_file(os.path.join(entry, name), fileName)
+
+    return True
+
+
+def store_cached_artifacts(cache_dir, key, artifacts):
+    '''
+    Adds copies of output files to a cache entry, read-only so the entry is
+    never changed. artifacts maps the name of each file in the entry to its output.
+    '''
+    entry = os.path.join(cache_dir, key[:2], key)
+    if not os.path.exists(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            # Made by another job at the same time.
+            pass
+
+    # The files are staged next to the entry and renamed into it, so an entry
+    # never holds a partly written file.
+    tmp_dir = tempfile.mkdtemp(prefix='.' + key + '.', dir=os.path.dirname(entry))
+    try:
+        os.chmod(tmp_dir, 0o755)
+        for name, fileName in artifacts.items():
+            shutil.copyfile(fileName, os.path.join(tmp_dir, name))
+            os.chmod(os.path.join(tmp_dir, name), 0o444)
+
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # The entry already exists, add the files it is missing.
+            for name in artifacts:
+                if not os.path.exists(os.path.join(entry, name)):
+                    os.rename(os.path.join(tmp_dir, name), os.path.join(entry, name))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_Self_Score_entry(KmerSet_fileName):
+    '''
+    Reads the self score cache entry of a Kmer set. Returns an empty entry if
+    there is none or it can not be read.
+    '''
+    try:
+        with open(KmerSet_fileName + SELF_SCORE_EXT, 'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_Self_Score_entry(KmerSet_fileName, entry):
+    '''
+    Writes the self score cache entry of a Kmer set. The entry is written to a
+    temporary file first so concurrent jobs never see a half written entry.
+
+    Returns False if the entry could not be written (e.g. read only data).
+    '''
+    cache_fileName = KmerSet_fileName + SELF_SCORE_EXT
+    tmp_fileName = '%s.%s.tmp' % (cache_fileName, os.getpid())
+    try:
+        with open(tmp_fileName, 'w') as fh:
+            json.dump(entry, fh, sort_keys=True)
+        os.rename(tmp_fileName, cache_fileName)
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def Self_Score_model(canonical=False):
+    '''
+    The self score cache key of the D2S model. The canonical model has its own key, as a
+    text kmer file can be scored with either model.
+    '''
+    return 'D2S_canonical' if canonical else 'D2S'
+
+
+def load_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, model='D2S'):
+    '''
+    Looks up the cached self score of a Kmer set and its character frequencies.
+
+    Returns None if there is no cached score for the model, or if the Kmer set
+    or character frequency file has changed since the score was cached.
+    '''
+    entry = read_Self_Score_entry(KmerSet_fileName)
+    if model not in entry.get('scores', {}):
+        return None
+
+    valid, touched = check_cache_entry(
+        entry, KmerSet_fileName, KmerSet_freq_fileName)
+    if not valid:
+        return None
+    if touched:
+        write_Self_Score_entry(KmerSet_fileName, entry)
+
+    return entry['scores'][model]
+
+
+def save_Self_Score(KmerSet_fileName, KmerSet_freq_fileName, score, model='D2S'):
+    '''
+    Caches the self score of a Kmer set and its character frequencies. Scores of
+    other models are kept as long as they were cached for the same files.
+
+    Returns False if the score could not be cached.
+    '''
+    digest = hash_files(KmerSet_fileName, KmerSet_freq_fileName)
+
+    entry = read_Self_Score_entry(KmerSet_fileName)
+    if entry.get('digest') != digest:
+        entry = {'digest': digest, 'scores': {}}
+
+    entry['stamps'] = file_stamps(KmerSet_fileName, KmerSet_freq_fileName)
+    entry['scores'][model] = score
+
+    return write_Self_Score_entry(KmerSet_fileName, entry)
+
+
+def write_Kmer_residuals(KmerSet_fileName, KmerSet_freq_fileName, k, residual_chunks, canonical=False):
+    '''
+    Writes the residuals of a Kmer set (an iterable of float arrays aligned with the
+    sorted Kmers) to KmerSet<RESIDUAL_EXT>. The file is only moved into place once
+    complete, so concurrent jobs never read a half written file. canonical records
+    which probability model the residuals were calculated with.
+    '''
+    residual_fileName = KmerSet_fileName + RESIDUAL_EXT
+    tmp_fileName = '%s.%s.tmp' % (residual_fileName, os.getpid())
+
+    num_kmers = 0
+    with open(tmp_fileName, 'wb') as fh:
+        fh.write(b'\0' * RESIDUAL_HEADER.size)
+
+        for residuals in residual_chunks:
+            fh.write(np.asarray(residuals, dtype='<f8').tobytes())
+            num_kmers += len(residuals)
+
+        meta = json.dumps({'digest': hash_files(KmerSet_fileName, KmerSet_freq_fileName),
+                           'stamps': file_stamps(KmerSet_fileName, KmerSet_freq_fileName),
+                           'canonical': bool(canonical)},
+                          sort_keys=True).encode('utf-8')
+        fh.write(meta)
+
+        fh.seek(0)
+        fh.write(RESIDUAL_HEADER.pack(RESIDUAL_MAGIC,
+                                      RESIDUAL_VERSION, k, num_kmers, len(meta)))
+
+    os.rename(tmp_fileName, residual_fileName)
+
+    return num_kmers
+
+
+def load_Kmer_residuals(KmerSet_fileName, KmerSet_freq_fileName, canonical=False, validate=True):
+    '''
+    Memory-maps the precomputed residuals of a Kmer set.
+
+    Returns None if there are no residuals, if they were calculated with the other
+    (canonical or not) probability model, or if the Kmer set or character
+    frequency file has changed since they were written. validate=False skips the
+    last check, for callers that already made it (see calculate_D2S_Sharded).
+    '''
+    residual_fileName = KmerSet_fileName + RESIDUAL_EXT
+    if not os.path.exists(residual_fileName):
+        return None
+
+    with open(residual_fileName, 'rb') as fh:
+        header = fh.read(RESIDUAL_HEADER.size)
+        if len(header) != RESIDUAL_HEADER.size or not header.startswith(RESIDUAL_MAGIC):
+            return None
+
+        magic, version, k, num_kmers, meta_len = RESIDUAL_HEADER.unpack(header)
+        if version > RESIDUAL_VERSION:
+            return None
+
+        meta_offset = RESIDUAL_HEADER.size + 8 * num_kmers
+        fh.seek(meta_offset)
+        try:
+            entry = json.loads(fh.read(meta_len).decode('utf-8'))
+        except ValueError:
+            return None
+
+    if entry.get('canonical', False) != bool(canonical):
+        return None
+
+    if validate:
+        valid, touched = check_cache_entry(
+            entry, KmerSet_fileName, KmerSet_freq_fileName)
+        if not valid:
+            return None
+
+        if touched:
+            # Refresh the stamps so the files are not rehashed next time. Other
+            # jobs may be reading the residuals, so the refreshed file is written
+            # next to them and moved into place.
+            meta = json.dumps(entry, sort_keys=True).encode('utf-8')
+            tmp_fileName = '%s.%s.tmp' % (residual_fileName, os.getpid())
+            try:
+                shutil.copyfile(residual_fileName, tmp_fileName)
+                with open(tmp_fileName, 'r+b') as fh:
+                    fh.write(RESIDUAL_HEADER.pack(RESIDUAL_MAGIC,
+                                                  version, k, num_kmers, len(meta)))
+                    fh.seek(meta_offset)
+                    fh.write(meta)
+                    fh.truncate()
+                os.rename(tmp_fileName, residual_fileName)
+            except (IOError, OSError):
+                if os.path.exists(tmp_fileName):
+                    os.remove(tmp_fileName)
+
+    if not num_kmers:
+        return np.zeros(0, dtype='<f8')
+
+    return np.memmap(residual_fileName, dtype='<f8', mode='r',
+                     offset=RESIDUAL_HEADER.size, shape=(num_kmers,))
+
+
+def residual_Kmer_chunks(Kmer_chunks, residuals):
+    '''
+    Swaps the counts of (codes, counts) chunks for the matching slice of the
+    precomputed residuals.
+    '''
+    start = 0
+    for codes, counts in Kmer_chunks:
+        yield codes, residuals[start:start + len(codes)]
+        start += len(codes)
+
+
 def Next_Kmer(Kmer_iter):
     '''
     Iterate and return the next Kmer in the set. 
@@ -91,17 +1440,23 @@ def iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger, Both_KmerSets=True, Kmer
 
     Assumes files are sorted lexicographically and the file was created by Kmers_2_NumbericRepresentation.py.
     '''
-    report_interval = 10000000
-
     KmerSet1_fh.seek(0)
     KmerSet2_fh.seek(0)
 
+    return merge_Kmer_iterators(pass_column_file(KmerSet1_fh), pass_column_file(KmerSet2_fh), logger,
+                                Both_KmerSets=Both_KmerSets, KmerSet1_Only=KmerSet1_Only, KmerSet2_Only=KmerSet2_Only)
+
+
+def merge_Kmer_iterators(KmerSet1, KmerSet2, logger, Both_KmerSets=True, KmerSet1_Only=True, KmerSet2_Only=True):
+    '''
+    Merges two sorted iterators of (kmer_value, kmer_seq, kmer_count) and yields
+    kmer_seq and kmer_count pairs selected as described in iterate_Kmer_sets.
+    '''
+    report_interval = 10000000
+
     KmerSet1_notDone = True
     KmerSet2_notDone = True
 
-    KmerSet1 = pass_column_file(KmerSet1_fh)
-    KmerSet2 = pass_column_file(KmerSet2_fh)
-
     KmerSet1_value, KmerSet1_seq, KmerSet1_count, KmerSet1_notDone = Next_Kmer(
         KmerSet1)
     KmerSet2_value, KmerSet2_seq, KmerSet2_count, KmerSet2_notDone = Next_Kmer(
@@ -112,7 +1467,7 @@ def iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger, Both_KmerSets=True, Kmer
         #logger.debug('Iteration %s: %s\t%s\t%s\t%s\t%s\t%s', i, KmerSet1_value, KmerSet1_seq, KmerSet1_count, KmerSet2_value, KmerSet2_seq, KmerSet2_count)
 
         # If Kmer is in BOTH datasets
-        if KmerSet1_value == KmerSet2_value and KmerSet1_notDone and KmerSet2_notDone:
+        if KmerSet1_notDone and KmerSet2_notDone and KmerSet1_value == KmerSet2_value:
             logger.debug('%s\t%s\t%s\t%s\t%s\t%s', KmerSet1_value, KmerSet1_seq,
                          KmerSet1_count, KmerSet2_value, KmerSet2_seq, KmerSet2_count)
 
@@ -125,7 +1480,7 @@ def iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger, Both_KmerSets=True, Kmer
                 KmerSet2)
 
         # If Kmer is in Dataset 1 ONLY
-        elif KmerSet1_value < KmerSet2_value and KmerSet1_notDone:
+        elif KmerSet1_notDone and KmerSet2_notDone and KmerSet1_value < KmerSet2_value:
             logger.debug('%s\t%s\t%s\t%s\t%s\t%s', KmerSet1_value,
                          KmerSet1_seq, KmerSet1_count, None, None, None)
 
@@ -136,7 +1491,7 @@ def iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger, Both_KmerSets=True, Kmer
                 KmerSet1)
 
         # If Kmer is in Dataset 2 ONLY
-        elif KmerSet1_value > KmerSet2_value and KmerSet2_notDone:
+        elif KmerSet1_notDone and KmerSet2_notDone and KmerSet1_value > KmerSet2_value:
             logger.debug('%s\t%s\t%s\t%s\t%s\t%s', None, None, None,
                          KmerSet2_value, KmerSet2_seq, KmerSet2_count)
 
@@ -0,0 +1,95 @@
+#!/usr/bin/python2
+DESCRIPTION = '''
+Convert a jellyfish count file (genome.fasta.21.jf) straight into a sorted binary kmer profile,
+instead of jellyfish dump, sort, Kmers_2_NumbericRepresentation.py and Convert_Kmer_Profile.py.
+
+The binary entries of the jellyfish file are read in blocks and sorted by their 2-bit kmer
+code in memory, up to --memory GB at a time. For larger files each sorted run is spilled to a
+temporary folder and the runs are merged into the profile (see Count_Kmers.py).
+
+Only the binary/sorted format written by jellyfish count (jellyfish 2) can be read, with kmers of
+up to 32 bases. Files counted with jellyfish count -C are marked as canonical. With --min_count
+and --max_count the kmers counted fewer or more times are dropped (see Convert_Kmer_Profile.py).
+
+Input jellyfish file: genome.fasta.21.jf
+Output kmer profile: genome.fasta.21mer.nkp
+'''
+from D2S_tools import *
+from Count_Kmers import KMER_BUFFER_BYTES, KmerCounter, write_Counted_Kmers
+import logging
+import argparse
+import sys
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--jf', metavar='genome.fasta.21.jf', type=lambda x: check_file_exists(x),
+                        required=True, help='Input jellyfish count file')
+    parser.add_argument('-o', '--out_profile', metavar='genome.fasta.21mer.nkp', type=str,
+                        required=True, help='Output binary kmer profile')
+    parser.add_argument('--memory', metavar='GB', type=float, required=False, default=2,
+                        help='Memory for sorting kmers before spilling them to disk (default: %(default)s)')
+    parser.add_argument('--tmp_dir', metavar='tmp/', type=str, required=False, default=None,
+                        help='Folder for the spilled kmer runs (default: next to the output)')
+    parser.add_argument('--min_count', metavar='N', type=int, required=False, default=1,
+                        help='Drop kmers counted fewer than N times (default: %(default)s)')
+    parser.add_argument('--max_count', metavar='N', type=int, required=False, default=None,
+                        help='Drop kmers counted more than N times (default: no limit)')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    if args.min_count < 1 or (args.max_count is not None and args.max_count < args.min_count):
+        logger.error('--min_count has to be at least 1 and at most --max_count: %s, %s',
+                     args.min_count, args.max_count)  # ERROR
+        sys.exit(1)
+
+    convert_Jellyfish_counts(args.jf, args.out_profile, logger,
+                             buffer_kmers=max(int(args.memory * 1e9 / KMER_BUFFER_BYTES), 1 << 16),
+                             tmp_dir=args.tmp_dir, min_count=args.min_count, max_count=args.max_count)
+
+
+def convert_Jellyfish_counts(jf_fileName, out_profile_fileName, logger, buffer_kmers=1 << 26,
+                             tmp_dir=None, min_count=1, max_count=None):
+    '''
+    Sort the kmers of a jellyfish count file into a binary kmer profile.
+    '''
+    k, header, Kmer_chunks = open_Jellyfish_counts(jf_fileName, min(buffer_kmers, 1 << 22))
+    canonical = bool(header.get('canonical', False))
+
+    tmp_dir = tempfile.mkdtemp(prefix='.Jellyfish_2_Profile.', dir=tmp_dir or os.path.dirname(
+        os.path.abspath(out_profile_fileName)))
+    try:
+        counter = KmerCounter(k, buffer_kmers, tmp_dir)
+
+        num_kmers = 0
+        for codes, counts in Kmer_chunks:
+            num_kmers += len(codes)
+            counter.add(codes, counts)
+
+        logger.info('k-mer:%s\tcanonical:%s\tkmers:%s\tspilled:%s in %s runs', k, canonical, num_kmers,
+                    counter.num_spilled, len(counter.runs))  # INFO
+
+        write_Counted_Kmers(counter, out_profile_fileName, os.path.basename(jf_fileName), logger,
+                            canonical=canonical, min_count=min_count, max_count=max_count)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
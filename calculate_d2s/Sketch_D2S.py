@@ -0,0 +1,240 @@
+#!/usr/bin/python2
+from D2S_tools import *
+from Calculate_D2S import (calculate_D2S, calculate_D2S_Self, calculate_D2S_Self_Score, calculate_D2S_Shared,
+                           d2ScoreNormalization, open_Kmer_Residuals, read_Kmer_Residuals)
+from collections import namedtuple
+from glob import glob
+import itertools
+import logging
+import argparse
+import random
+import sys
+DESCRIPTION = '''
+Estimate the D2S distance between every pair of genomes from their FracMinHash sketches
+(made by Kmers_2_NumericRepresentation.py --sketch or Convert_Kmer_Profile.py --sketch_scale).
+
+A sketch keeps the same random ~1 in sketch_scale of the possible kmers for every genome, so the
+D2S terms summed over a sketch are a sample of the terms summed over the full Kmer sets. The D2S
+distance only depends on the ratio of these sums, so it is estimated by calculating it on the
+sketches. The residuals (kmer_count - NumKmers*Pw) of each sketch use the character frequencies
+of the full genome and are stored next to the sketch.
+
+Expects the sketches and CharFreq files next to the fasta files:
+    genome.fasta, genome.fasta.21mer.sketch.nkp, genome.fasta.CharFreq
+
+Writes one genome1-genome2.txt file per pair to the output folder, in the same format as
+Calculate_D2S.py, so the results can be put into a matrix with phylip_amalg.py.
+
+With --validate N, the estimates of N random pairs are compared with the exact D2S distances
+calculated from the full Kmer sets (genome.fasta.21mer.nkp or genome.fasta.21mer.nkc.gz).
+'''
+
+# A valid fasta file extension
+FASTA_EXT = (".fasta", ".fna", ".ffn", ".faa", ".frn", ".fas")
+
+Sketch = namedtuple('Sketch', ['name', 'fileName', 'freq_fileName',
+                               'k', 'canonical', 'sketch_scale', 'sketch_seed', 'codes', 'residuals'])
+
+# Pass arguments.
+
+
+def main():
+    # Pass command line arguments.
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
+    parser.add_argument('--data_input_path', metavar='genomes/', type=str, required=True,
+                        help='Folder holding the fasta, sketch and CharFreq files')
+    parser.add_argument('--data_output_path', metavar='genomes_sketch_D2S/', type=str, required=True,
+                        help='Output folder for the estimated D2S distances')
+    parser.add_argument('--kmer_ext', metavar='.21mer', type=str, required=False, default='.21mer',
+                        help='Added to the fasta file names to get the Kmer and sketch files (default: %(default)s)')
+    parser.add_argument('--validate', metavar='N', type=int, required=False, default=0,
+                        help='Compare the estimates of N random pairs against the exact D2S (default: %(default)s)')
+    parser.add_argument('--validate_seed', metavar='SEED', type=int, required=False, default=0,
+                        help='Seed for choosing the pairs to validate (default: %(default)s)')
+    parser.add_argument('--validate_out', metavar='validation.txt', type=lambda x: write_file_check_compression(x),
+                        required=False, default=None, help='Output for the estimated and exact D2S of each validated pair')
+    parser.add_argument('--debug', action='store_true', required=False, default=False,
+                        help='Print DEBUG info (default: %(default)s)')
+    args = parser.parse_args()
+
+    # Set up basic debugger
+    if args.debug:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.DEBUG)
+    else:
+        logging.basicConfig(format='#%(levelname)s :: %(asctime)s :: %(message)s',
+                            stream=sys.stdout, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    logger.debug('%s', args)  # DEBUG
+
+    fasta_files = []
+    for ext in FASTA_EXT:
+        fasta_files.extend(glob(os.path.join(args.data_input_path, '*' + ext)))
+
+    sketches = []
+    for fasta_file in sorted(fasta_files):
+        sketch_fileName = fasta_file + args.kmer_ext + SKETCH_EXT
+        freq_fileName = fasta_file + '.CharFreq'
+
+        if not (os.path.exists(sketch_fileName) and os.path.exists(freq_fileName)):
+            logger.warning('No sketch or CharFreq file for %s, skipping',
+                           fasta_file)  # WARNING
+            continue
+
+        sketches.append(load_Sketch(os.path.basename(fasta_file).rsplit('.', 1)[0],
+                                    sketch_fileName, freq_fileName, logger))
+
+    if len(sketches) < 2:
+        logger.error('Need at least two sketches in %s',
+                     args.data_input_path)  # ERROR
+        sys.exit(1)
+
+    sketches = match_Sketches(sketches, logger)
+
+    if not os.path.exists(args.data_output_path):
+        os.makedirs(args.data_output_path)
+
+    # The self scores only depend on one sketch.
+    d2Score_self = [calculate_D2S_Self(sketch.residuals) for sketch in sketches]
+
+    estimates = {}
+    for i, j in itertools.combinations(range(len(sketches)), 2):
+        d2Score = calculate_D2S_Shared(sketches[i].codes, sketches[i].residuals,
+                                       sketches[j].codes, sketches[j].residuals)
+        D2S_distance = d2ScoreNormalization(
+            d2Score, d2Score_self[i], d2Score_self[j])
+        estimates[i, j] = D2S_distance
+
+        D2S_out = open(os.path.join(args.data_output_path, '%s-%s.txt' %
+                                    (sketches[i].name, sketches[j].name)), 'w')
+        D2S_out.write(sketches[i].fileName + ';' + sketches[j].fileName + ';' + str(D2S_distance) + '\n')
+        D2S_out.close()
+
+    logger.info('Estimated the D2S distance of %s pairs from %s sketches',
+                len(estimates), len(sketches))  # INFO
+
+    if args.validate:
+        validate_Sketches(sketches, estimates, args.validate, args.validate_seed,
+                          args.kmer_ext, args.validate_out, logger)
+
+
+def load_Sketch(name, sketch_fileName, freq_fileName, logger):
+    '''
+    Loads the codes and residuals of a sketch. The residuals are stored next to the
+    sketch (see Calculate_Residuals.py) the first time it is loaded.
+    '''
+    profile = load_Kmer_profile(sketch_fileName)
+    if not profile.flags & FLAG_SKETCH:
+        logger.warning('%s is not a sketch, using all of its kmers',
+                       sketch_fileName)  # WARNING
+
+    canonical = bool(profile.flags & FLAG_CANONICAL)
+
+    if load_Kmer_residuals(sketch_fileName, freq_fileName, canonical=canonical) is None:
+        k, Kmer_chunks = open_Kmer_Residuals(sketch_fileName, freq_fileName, logger, canonical=canonical)
+        write_Kmer_residuals(sketch_fileName, freq_fileName, k,
+                             (residuals for codes, residuals in Kmer_chunks), canonical=canonical)
+
+    k, codes, residuals = read_Kmer_Residuals(sketch_fileName, freq_fileName, logger, canonical=canonical)
+
+    logger.debug('%s: %s kmers', sketch_fileName, len(codes))  # DEBUG
+
+    return Sketch(name, sketch_fileName, freq_fileName, k, canonical,
+                  profile.metadata.get('sketch_scale', 1), profile.metadata.get('sketch_seed', 0),
+                  codes, residuals)
+
+
+def match_Sketches(sketches, logger):
+    '''
+    Checks that the sketches can be compared and cuts them down to the coarsest
+    sketch_scale, so every sketch keeps the same kmers.
+    '''
+    for attribute in ('k', 'canonical', 'sketch_seed'):
+        values = set(getattr(sketch, attribute) for sketch in sketches)
+        if len(values) > 1:
+            logger.error('The sketches have different %s values: %s',
+                         attribute, sorted(values))  # ERROR
+            sys.exit(1)
+
+    sketch_scale = max(sketch.sketch_scale for sketch in sketches)
+    logger.info('k-mer:%s\tsketch_scale:%s', sketches[0].k, sketch_scale)  # INFO
+
+    threshold = np.uint64(sketch_threshold(sketch_scale))
+    matched = []
+    for sketch in sketches:
+        if sketch.sketch_scale != sketch_scale:
+            keep = hash_Kmer_codes(sketch.codes, sketch.sketch_seed) < threshold
+            sketch = sketch._replace(sketch_scale=sketch_scale, codes=sketch.codes[keep],
+                                     residuals=sketch.residuals[keep])
+        matched.append(sketch)
+
+    return matched
+
+
+def validate_Sketches(sketches, estimates, num_pairs, seed, kmer_ext, validate_out, logger):
+    '''
+    Compares the estimated D2S distance of num_pairs random pairs against the exact
+    D2S distance from the full Kmer sets and reports the errors.
+    '''
+    pairs = sorted(estimates)
+    pairs = sorted(random.Random(seed).sample(pairs, min(num_pairs, len(pairs))))
+
+    if validate_out is not None:
+        validate_out.write('#genome1\tgenome2\testimated_D2S\texact_D2S\terror\n')
+
+    errors = []
+    relative_errors = []
+    for i, j in pairs:
+        kmersets = [get_Kmer_set(sketches[index].fileName, kmer_ext) for index in (i, j)]
+        if None in kmersets:
+            logger.warning('No full Kmer set for %s-%s, can not validate it',
+                           sketches[i].name, sketches[j].name)  # WARNING
+            continue
+
+        # The full Kmer sets are canonical if the sketches are.
+        canonical = sketches[i].canonical
+        d2Score = calculate_D2S(kmersets[0], sketches[i].freq_fileName,
+                                kmersets[1], sketches[j].freq_fileName, logger, canonical=canonical)
+        d2Score_self = [calculate_D2S_Self_Score(kmerset, sketches[index].freq_fileName, logger, canonical=canonical)
+                        for kmerset, index in zip(kmersets, (i, j))]
+        exact = d2ScoreNormalization(d2Score, d2Score_self[0], d2Score_self[1])
+
+        error = estimates[i, j] - exact
+        errors.append(abs(error))
+        if exact:
+            relative_errors.append(abs(error) / exact)
+
+        logger.info('%s-%s\testimated:%s\texact:%s\terror:%s', sketches[i].name,
+                    sketches[j].name, estimates[i, j], exact, error)  # INFO
+        if validate_out is not None:
+            validate_out.write('%s\t%s\t%s\t%s\t%s\n' % (sketches[i].name, sketches[j].name,
+                                                         estimates[i, j], exact, error))
+
+    if validate_out is not None:
+        validate_out.close()
+
+    if not errors:
+        logger.warning('No pairs could be validated')  # WARNING
+        return
+
+    logger.info('Validated %s pairs\tmean_abs_error:%s\tmax_abs_error:%s\tmean_rel_error:%s',
+                len(errors), np.mean(errors), np.max(errors),
+                np.mean(relative_errors) if relative_errors else float('nan'))  # INFO
+
+
+def get_Kmer_set(sketch_fileName, kmer_ext):
+    '''
+    Gets the full Kmer set of a sketch, preferring the binary kmer profile.
+    '''
+    fasta_fileName = sketch_fileName[:-len(kmer_ext + SKETCH_EXT)]
+    for ext in (PROFILE_EXT, '.nkc.gz'):
+        if os.path.exists(fasta_fileName + kmer_ext + ext):
+            return fasta_fileName + kmer_ext + ext
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,9 @@ import csv
 import time
 import shutil
 import socket
+import subprocess
 import itertools
+import math
 import argparse
 
 from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
@@ -18,6 +20,10 @@ from pprint import pprint
 from string import Formatter
 from datetime import timedelta
 
+from D2S_tools import (ARTIFACT_FREQ, ARTIFACT_PROFILE, PROFILE_EXT, Kmer_count_cache_key, Self_Score_model,
+                       fetch_cached_artifacts, is_canonical_Kmer_set, load_Kmer_profile, load_Kmer_residuals,
+                       load_Self_Score)
+
 """
 Example Usage:
     (Unix)
@@ -47,6 +53,29 @@ NCPUS = 4
 
 PYTHON_VERSION = "2.7"
 
+# A list of all valid fasta file extensions
+FASTA_EXT = (".fasta", ".fna", ".ffn", ".faa", ".frn", ".fas")
+
+# The removed stretches of a virtual jackknife replicate, which has a k-mer
+# profile and CharFreq file but no fasta file (see jackknife.py --virtual)
+REMOVED_EXT = ".removed.bed"
+
+# The most job IDs in one qsub -W depend list
+MAX_DEPEND_JOBS = 50
+
+# Bytes of memory each k-mer takes up in a tile (a 64 bit code and a 64 bit
+# residual), and the rough size of each k-mer in a gzipped text k-mer file
+TILE_BYTES_PER_KMER = 16
+TEXT_BYTES_PER_KMER = 12
+
+# Each tile job runs one tile, whose two blocks fill the tile memory. Reading
+# a k-mer set holds its chunks and their concatenation at once, so a tile job
+# peaks at about TILE_PEAK_FACTOR times the tile memory, plus TILE_BASE_MEM GB
+# for python and numpy. A tile job has to fit on one node of NODE_MEM GB.
+TILE_PEAK_FACTOR = 2
+TILE_BASE_MEM = 1
+NODE_MEM = 128
+
 if 'gadi' in socket.gethostname().lower():
     JOB_TEMPLATE = """#!/bin/bash
     #PBS -N {file_name}
@@ -204,11 +233,166 @@ def strfdelta(tdelta, fmt='{H:02}:{M:02}:{S:02}', inputtype='timedelta'):
     return f.format(fmt, **values)
 
 
+def get_fasta_files(data_input_path: str) -> List[str]:
+    """
+    Gets the fasta files in a data folder. A finished virtual jackknife
+    replicate (with its .done file) is listed under the name its fasta file
+    would have.
+
+    Parameters:
+        data_input_path:
+            A path to a folder holding fasta files.
+
+    Return:
+        The paths of the fasta files, grouped by file extension.
+    """
+
+    fasta_files: List[str] = []
+
+    for ext in FASTA_EXT:
+        fasta_files.extend(
+            glob(os.path.join(data_input_path, '**' + ext)))
+        fasta_files.extend(
+            removed_path[:-len(REMOVED_EXT)]
+            for removed_path in glob(os.path.join(data_input_path, '**' + ext + REMOVED_EXT))
+            if not os.path.exists(removed_path[:-len(REMOVED_EXT)])
+            and os.path.exists(removed_path[:-len(REMOVED_EXT)] + ".done"))
+
+    return fasta_files
+
+
+def get_kmerset_path(fasta_path: str, kmer_size: int = 21) -> str:
+    """
+    Gets the k-mer file for a fasta file. The binary k-mer profile (see
+    Convert_Kmer_Profile.py) is preferred over the text nkc.gz file when both
+    exist.
+
+    Parameters:
+        fasta_path:
+            A path to a fasta file that has been run through jellyfish.
+        kmer_size:
+            The k-mer size the fasta file was counted with.
+
+    Return:
+        A path to the k-mer file of the fasta file.
+    """
+
+    profile_path = fasta_path + ".{}mer.nkp".format(kmer_size)
+
+    if os.path.exists(profile_path):
+        return profile_path
+
+    return fasta_path + ".{}mer.nkc.gz".format(kmer_size)
+
+
+def get_kmerset_name(kmerset_path: str, kmer_size: int = 21) -> str:
+    """
+    Gets the name used in the output file names for a k-mer file.
+
+    Parameters:
+        kmerset_path:
+            A path to the k-mer file of a fasta file (see get_kmerset_path).
+        kmer_size:
+            The k-mer size the fasta file was counted with.
+
+    Return:
+        The name of the fasta file without its extension.
+    """
+
+    fasta_name = os.path.basename(kmerset_path).split(".{}mer.".format(kmer_size), maxsplit=1)[0]
+
+    return fasta_name.rsplit('.', maxsplit=1)[0]
+
+
+def resolve_cached_inputs(fasta_path: str, cache_dir: str, canonical: bool = False, kmer_size: int = 21) -> bool:
+    """
+    Copies the k-mer profile and CharFreq file of a fasta file from the k-mer
+    cache (see Count_Kmers.py --cache_dir) if either is missing. Only entries
+    counted with the default k-mer filter (no --min_count/--max_count) are used.
+
+    Parameters:
+        fasta_path:
+            A path to a fasta file.
+        cache_dir:
+            A path to the k-mer cache.
+        canonical:
+            If True, look for the canonical k-mer profile of the fasta file.
+        kmer_size:
+            The k-mer size of the profile to look for.
+
+    Return:
+        True if the files were copied from the cache.
+    """
+
+    profile_path = fasta_path + ".{}mer.nkp".format(kmer_size)
+    freq_path = fasta_path + ".CharFreq"
+
+    if os.path.exists(get_kmerset_path(fasta_path, kmer_size)) and os.path.exists(freq_path):
+        return False
+
+    # A virtual jackknife replicate has no fasta file to look up
+    if not os.path.exists(fasta_path):
+        return False
+
+    key = Kmer_count_cache_key(fasta_path, kmer_size, canonical=canonical)
+
+    return fetch_cached_artifacts(cache_dir, key, {ARTIFACT_PROFILE: profile_path, ARTIFACT_FREQ: freq_path})
+
+
+def read_phylip_names(matrix_path: str) -> Set[str]:
+    """
+    Reads the gene names of a PHYLIP matrix (see distance_tree/phylip_amalg.py).
+
+    Parameters:
+        matrix_path:
+            A path to a PHYLIP distance matrix.
+
+    Return:
+        The gene names of the matrix rows.
+    """
+
+    with open(matrix_path, 'r') as matrix_file:
+        # Skip the number of rows/cols
+        matrix_file.readline()
+
+        return {line.split('\t', maxsplit=1)[0].strip() for line in matrix_file if line.strip()}
+
+
+def has_result(result_path: str) -> bool:
+    """
+    Checks if a distance file holds a distance value.
+
+    Parameters:
+        result_path:
+            A path to the output file of a pairwise job.
+
+    Return:
+        True if the file exists and ends in a distance value.
+    """
+
+    if not os.path.exists(result_path):
+        return False
+
+    with open(result_path, 'r') as result_file:
+        value = result_file.read().rsplit(';', maxsplit=1)[-1]
+
+    try:
+        float(value)
+    except ValueError:
+        return False
+
+    return True
+
+
 class JobCreator:
     "Creates (and possibly runs) job scripts for creating annotated images."
 
     def __init__(self, slurm_dir: str, data_input_path: str, data_output_path: str,
-                 groups: int = 50, index: int = 0, submit: bool = False, temp: bool = False, dry_run: bool = False):
+                 groups: int = 50, index: int = 0, submit: bool = False, temp: bool = False, dry_run: bool = False,
+                 self_cache: bool = True, residuals: bool = False, tile_memory: float = 0,
+                 incremental: bool = False, base_matrix: Optional[str] = None,
+                 measures: Optional[str] = None, canonical: bool = False, cache_dir: Optional[str] = None,
+                 kmer_size: int = 21):
         """
         Initializes a job creator.
 
@@ -227,6 +411,47 @@ class JobCreator:
             dry_run (bool):
                 If True, creates the batch files for the jobs and simulates
                 job submission.
+
+            self_cache (bool):
+                If True, self scores missing from the self score cache are
+                computed by separate jobs and reused by every pairwise job.
+
+            residuals (bool):
+                If True, the separate jobs also precompute the residuals of
+                each k-mer set (see Calculate_Residuals.py), so the pairwise
+                jobs only have to intersect the k-mers.
+
+            tile_memory (float):
+                If above 0, the k-mer sets are split into blocks and each job
+                scores every pair of a tile (two blocks), reading each k-mer
+                set once per tile instead of once per pair. This is the memory
+                (in GB) one tile may use.
+
+            incremental (bool):
+                If True, pairs whose distance file already exists in the
+                output folder are skipped.
+
+            base_matrix (str):
+                A path to an existing PHYLIP matrix. Pairs of genomes that are
+                both in the matrix are skipped.
+
+            measures (str):
+                A comma separated list of distances for the pairwise jobs to
+                calculate (see Calculate_D2S.py --measures). Not supported by
+                the tiles.
+
+            canonical (bool):
+                If True, the text k-mer sets hold canonical k-mers (binary
+                k-mer profiles record this themselves).
+
+            cache_dir (str):
+                A path to a k-mer cache (see Count_Kmers.py --cache_dir). The
+                k-mer profiles and CharFreq files missing from the input folder
+                are copied from it when the cache holds them.
+
+            kmer_size (int):
+                The k-mer size the fasta files were counted with, which names
+                their k-mer files (e.g. genome.fasta.21mer.nkp).
         """
 
         self.slurm_dir = slurm_dir
@@ -254,10 +479,43 @@ class JobCreator:
         self.submit = submit
         self.temp = temp
         self.dry_run = dry_run
+        self.self_cache = self_cache
+        self.residuals = residuals
+        self.tile_memory = tile_memory
+        self.incremental = incremental
+        self.measures = measures
+        self.canonical = canonical
+        self.cache_dir = cache_dir
+        self.kmer_size = kmer_size
+
+        if self.measures is not None and self.tile_memory > 0:
+            sys.exit("ERROR: --measures can not be used with --tile_memory.")
+
+        if get_tile_job_mem(self.tile_memory) > NODE_MEM:
+            sys.exit(f"ERROR: --tile_memory can be at most {(NODE_MEM - TILE_BASE_MEM) / TILE_PEAK_FACTOR:g} GB, "
+                     f"a tile job needs about {TILE_PEAK_FACTOR} times it on a node of {NODE_MEM} GB.")
+
+        # The genomes whose pairwise distances are already known
+        self.base_names: Set[str] = read_phylip_names(
+            base_matrix) if base_matrix is not None else set()
+
+        # The (name1, name2) pairs the jobs compute
+        self.job_pairs: Set[Tuple[str, str]] = set()
+
+        # A full path to a directory that will hold the k-mer set blocks.
+        self.tile_dir = os.path.join(self.slurm_dir, "tile_blocks")
 
         # Get all the different job argument combinations
         self.job_args = self.get_job_arg_combinations()
 
+        # Get the k-mer sets whose self score (or residuals) still need to be cached
+        self.self_args = self.get_self_score_args() if self.self_cache or self.residuals else []
+
+        # The tiles compute the self scores from the k-mer sets they read, so
+        # only the residuals are worth precomputing
+        if self.tile_memory > 0 and not self.residuals:
+            self.self_args = []
+
         self.begin_job_procession()
 
     def get_job_arg_combinations(self):
@@ -268,22 +526,26 @@ class JobCreator:
         job_args: List[Dict[str, str]] = []
 
         # Get all the fasta files from the data path
-        fasta_files: List[str] = []
+        fasta_files = get_fasta_files(self.data_input_path)
+
+        if self.cache_dir is not None:
+            copied = sum(resolve_cached_inputs(fasta_file, self.cache_dir, self.canonical, self.kmer_size)
+                         for fasta_file in fasta_files)
+            print(f"Copied the k-mer files of {copied} fasta files from the cache")
 
-        # A list of all valid fasta file extensions
-        fasta_ext = (".fasta", ".fna", ".ffn", ".faa", ".frn", ".fas")
+        # The order of the k-mer sets, each pair is named in this order
+        self.kmerset_order: Dict[str, int] = {
+            get_kmerset_path(fasta_file, self.kmer_size): order for order, fasta_file in enumerate(fasta_files)}
 
-        for ext in fasta_ext:
-            fasta_files.extend(
-                glob(os.path.join(self.data_input_path, '**' + ext)))
+        skipped = 0
 
         # Create combinations for each different pair
         for kmerset1, kmerset2 in itertools.combinations(fasta_files, 2):
 
             new_arg_dict = dict()
 
-            new_arg_dict["kmerset1"] = kmerset1 + ".21mer.nkc.gz"
-            new_arg_dict["kmerset2"] = kmerset2 + ".21mer.nkc.gz"
+            new_arg_dict["kmerset1"] = get_kmerset_path(kmerset1, self.kmer_size)
+            new_arg_dict["kmerset2"] = get_kmerset_path(kmerset2, self.kmer_size)
 
             new_arg_dict["kmerset1_freq"] = kmerset1 + ".CharFreq"
             new_arg_dict["kmerset2_freq"] = kmerset2 + ".CharFreq"
@@ -301,12 +563,150 @@ class JobCreator:
                 output_path = kmerset1_name + '-' + kmerset2_name + '.txt'
                 output_path = os.path.join(self.data_output_path, output_path)
 
+                # Skip the pairs computed by an earlier run
+                if (kmerset1_name in self.base_names and kmerset2_name in self.base_names) or \
+                        (self.incremental and has_result(output_path)):
+                    skipped += 1
+                    continue
+
                 new_arg_dict["D2S_out"] = output_path
 
                 job_args.append(new_arg_dict)
+                self.job_pairs.add((kmerset1_name, kmerset2_name))
+
+        if skipped:
+            print(f"Skipped {skipped} pairs that have already been computed")
 
         return job_args
 
+    def get_self_score_args(self):
+        """
+        Finds the k-mer sets used by the jobs that have no valid (missing or
+        stale) self score cached, or no valid residuals if they were requested.
+        """
+
+        self_args: List[Dict[str, str]] = []
+        seen: Set[str] = set()
+
+        for job_arg in self.job_args:
+            for kmerset, kmerset_freq in ((job_arg["kmerset1"], job_arg["kmerset1_freq"]),
+                                          (job_arg["kmerset2"], job_arg["kmerset2_freq"])):
+
+                if kmerset in seen:
+                    continue
+                seen.add(kmerset)
+
+                canonical = is_canonical_Kmer_set(kmerset, self.canonical)
+
+                if (self.self_cache and load_Self_Score(kmerset, kmerset_freq,
+                                                        model=Self_Score_model(canonical)) is None) or \
+                        (self.residuals and load_Kmer_residuals(kmerset, kmerset_freq, canonical=canonical) is None):
+                    self_args.append(
+                        {"kmerset": kmerset, "kmerset_freq": kmerset_freq})
+
+        return self_args
+
+    def get_kmerset_blocks(self):
+        """
+        Splits the k-mer sets used by the jobs into blocks, in order, so that
+        the k-mer sets of two blocks fit into the tile memory.
+        """
+
+        kmersets: List[Tuple[str, str, str]] = []
+        seen: Set[str] = set()
+
+        for job_arg in self.job_args:
+            for kmerset, kmerset_freq in ((job_arg["kmerset1"], job_arg["kmerset1_freq"]),
+                                          (job_arg["kmerset2"], job_arg["kmerset2_freq"])):
+
+                if kmerset in seen:
+                    continue
+                seen.add(kmerset)
+
+                kmersets.append(
+                    (get_kmerset_name(kmerset, self.kmer_size), kmerset, kmerset_freq))
+
+        # Keep the k-mer sets in pair order, so the tiles name the pairs the
+        # same way as the pairwise jobs
+        kmersets.sort(key=lambda kmerset: self.kmerset_order[kmerset[1]])
+
+        block_memory = self.tile_memory * (1 << 30) / 2
+
+        blocks: List[List[Tuple[str, str, str]]] = []
+        used_memory = 0
+
+        for kmerset in kmersets:
+
+            kmerset_memory = get_kmerset_memory(kmerset[1])
+
+            # A k-mer set bigger than a block gets a block to itself
+            if not blocks or used_memory + kmerset_memory > block_memory:
+                blocks.append([])
+                used_memory = 0
+
+            blocks[-1].append(kmerset)
+            used_memory += kmerset_memory
+
+        return blocks
+
+    def get_tile_args(self):
+        """
+        Writes the k-mer set blocks to the tile folder and pairs the blocks
+        up into tiles (including each block with itself).
+        """
+
+        if not os.path.exists(self.tile_dir):
+            os.makedirs(self.tile_dir)
+
+        blocks = self.get_kmerset_blocks()
+        block_paths: List[str] = []
+
+        for block_id, block in enumerate(blocks):
+
+            block_path = os.path.join(
+                self.tile_dir, f"block_{self.index}_{block_id}.txt")
+
+            with open(block_path, "w") as block_file:
+                writer = csv.writer(block_file, delimiter='\t', lineterminator='\n')
+                writer.writerows(block)
+
+            block_paths.append(block_path)
+
+        tile_args: List[Dict[str, str]] = []
+
+        for i, j in itertools.combinations_with_replacement(range(len(blocks)), 2):
+
+            if i == j:
+                tile_pairs = [(blocks[i][a][0], blocks[i][b][0]) for a in range(len(blocks[i]))
+                              for b in range(a + 1, len(blocks[i]))]
+            else:
+                tile_pairs = [(kmerset1[0], kmerset2[0])
+                              for kmerset1 in blocks[i] for kmerset2 in blocks[j]]
+
+            job_pairs = [pair for pair in tile_pairs if pair in self.job_pairs]
+
+            # Nothing left to compute in this tile
+            if not job_pairs:
+                continue
+
+            tile_arg = {"block1": block_paths[i], "block2": block_paths[j],
+                        "data_output_path": self.data_output_path}
+
+            # Only compute the pairs that were not skipped
+            if len(job_pairs) < len(tile_pairs):
+                pairs_path = os.path.join(
+                    self.tile_dir, f"pairs_{self.index}_{i}_{j}.txt")
+
+                with open(pairs_path, "w") as pairs_file:
+                    writer = csv.writer(pairs_file, delimiter='\t', lineterminator='\n')
+                    writer.writerows(job_pairs)
+
+                tile_arg["pairs"] = pairs_path
+
+            tile_args.append(tile_arg)
+
+        return tile_args
+
     def begin_job_procession(self):
         """
         Creates, submits (if requested) and removes (if requested) jobs for
@@ -331,36 +731,108 @@ class JobCreator:
         Creates a job files for each tile within the project folder.
         """
 
+        # Create a list of all the commands that need to be run to cache the
+        # self scores (the residual script caches the self scores as well)
+        self_script = "Calculate_Residuals.py" if self.residuals else "Calculate_Self_D2S.py"
+
+        self_cmds = [' '.join(f'--{param_name} {param_value}' for param_name, param_value in self_arg.items())
+                     for self_arg in self.self_args]
+        if self.canonical:
+            self_cmds = [param_str + ' --canonical' for param_str in self_cmds]
+
+        self_cmds = [self.get_python_cmd(self_script, param_str)
+                     for param_str in self_cmds]
+
+        self.write_job_files(self_cmds, f"d2s_self_{self.index}")
+
+        if self.tile_memory > 0:
+            tile_cmds = [' '.join(f'--{param_name} {param_value}' for param_name, param_value in tile_arg.items())
+                         for tile_arg in self.get_tile_args()]
+
+            if not self.self_cache:
+                tile_cmds = [param_str + ' --no_self_cache' for param_str in tile_cmds]
+
+            if self.canonical:
+                tile_cmds = [param_str + ' --canonical' for param_str in tile_cmds]
+
+            tile_cmds = [self.get_python_cmd("Calculate_D2S_Tile.py", param_str)
+                         for param_str in tile_cmds]
+
+            # Each tile scores many pairs and fills the tile memory, so each
+            # gets a job of its own, with the memory it needs
+            self.write_job_files(tile_cmds, f"d2s_tile_{self.index}", groups=1,
+                                 job_time=len(self.job_args) * JOB_TIME / max(len(tile_cmds), 1),
+                                 job_mem=f"{math.ceil(get_tile_job_mem(self.tile_memory))}GB", ncpus=1)
+
+            return
+
         # Create a list of all the commands that need to be run to compute the
         # distances
         d2s_cmds = [' '.join(f'--{param_name} {param_value}' for param_name, param_value in job_arg.items())
                     for job_arg in self.job_args]
-        d2s_cmds = [
-            "python{py_ver_short} -W ignore {python_filepath!r} {param_str}".format(
-                py_ver_short=PYTHON_VERSION.rsplit(".", maxsplit=1)[0],
-                python_filepath=os.path.join(
-                    ROOT_DIR, "calc_d2s", "Calculate_D2S.py"),
-                param_str=param_str) for param_str in d2s_cmds
-        ]
 
-        d2s_cmds = [d2s_cmds[i:i + self.groups]
-                    for i in range(0, len(d2s_cmds), self.groups)]
+        # Without the cache each job needs its own self scores, which are
+        # cheapest to get from a single pass over both k-mer sets
+        if not self.self_cache:
+            d2s_cmds = [param_str + ' --no_self_cache --single_pass' for param_str in d2s_cmds]
+
+        if self.measures is not None:
+            d2s_cmds = [param_str + f' --measures {self.measures}' for param_str in d2s_cmds]
+
+        if self.canonical:
+            d2s_cmds = [param_str + ' --canonical' for param_str in d2s_cmds]
+
+        d2s_cmds = [self.get_python_cmd("Calculate_D2S.py", param_str)
+                    for param_str in d2s_cmds]
+
+        self.write_job_files(d2s_cmds, f"d2s_{self.index}")
+
+        return
+
+    def get_python_cmd(self, script_name: str, param_str: str) -> str:
+        """
+        Creates the command to run one of the d2s python scripts.
+        """
+
+        return "python{py_ver_short} -W ignore {python_filepath!r} {param_str}".format(
+            py_ver_short=PYTHON_VERSION.rsplit(".", maxsplit=1)[0],
+            python_filepath=os.path.join(
+                ROOT_DIR, "calc_d2s", script_name),
+            param_str=param_str)
+
+    def write_job_files(self, d2s_cmds: List[str], name_prefix: str,
+                        groups: Optional[int] = None, job_time: float = JOB_TIME,
+                        job_mem: str = JOB_MEM, ncpus: int = NCPUS):
+        """
+        Splits commands into groups and writes a job file for each group.
+        job_time is the time in minutes to run each command, and each job
+        runs ncpus of its commands at a time within job_mem.
+        """
+
+        groups = groups or self.groups
+        cmd_time = job_time
+
+        d2s_cmds = [d2s_cmds[i:i + groups]
+                    for i in range(0, len(d2s_cmds), groups)]
 
         for param_id, d2s_cmd in enumerate(d2s_cmds, 0):
 
             # Create a timedelta object to format the amount of time we
             # for this job
-            job_time: timedelta = timedelta(minutes=JOB_TIME * len(d2s_cmd))
+            job_time: timedelta = timedelta(minutes=cmd_time * len(d2s_cmd))
 
             # Create a string of all the parameter names with their
             # corresponding parameter values.
-            d2s_cmd: List[str] = [d2s_cmd[i:i + NCPUS]
-                                  for i in range(0, len(d2s_cmd), NCPUS)]
-            d2s_cmd = map(' & \n'.join, d2s_cmd)
-            d2s_cmd: str = ' & \nwait\n'.join(d2s_cmd)
-            d2s_cmd += ' & \nwait'
+            if ncpus == 1:
+                d2s_cmd: str = '\n'.join(d2s_cmd)
+            else:
+                d2s_cmd: List[str] = [d2s_cmd[i:i + ncpus]
+                                      for i in range(0, len(d2s_cmd), ncpus)]
+                d2s_cmd = map(' & \n'.join, d2s_cmd)
+                d2s_cmd: str = ' & \nwait\n'.join(d2s_cmd)
+                d2s_cmd += ' & \nwait'
 
-            file_name: str = f"d2s_{self.index}_{param_id}"
+            file_name: str = f"{name_prefix}_{param_id}"
 
             stdout_path = os.path.join(
                 self.slurm_out, f"{file_name}_out.txt")
@@ -373,9 +845,9 @@ class JobCreator:
                 stderr_file=stderr_path,
                 d2s_cmd=d2s_cmd,
                 job_time=strfdelta(job_time),
-                job_mem=JOB_MEM,
+                job_mem=job_mem,
                 job_nodes=JOB_NODES,
-                ncpus=NCPUS
+                ncpus=ncpus
             )
 
             job_filename = f"{file_name}_job.sh"
@@ -399,19 +871,81 @@ class JobCreator:
         job_file_list = list(map(lambda filename: os.path.join(
             self.output_dir, filename), job_file_list))
 
-        job_file_list = sorted(job_file_list)
+        # The self score jobs are submitted first, and every pairwise job only
+        # starts once they have all ended, so it reuses their cached scores
+        # rather than computing them itself. The jobs compute any missing
+        # score themselves, so a self score job that fails only costs time
+        # (afterany), it never holds the pairwise jobs.
+        self_job_files = sorted(job_file for job_file in job_file_list
+                                if os.path.basename(job_file).startswith("d2s_self_"))
+        pair_job_files = sorted(job_file for job_file in job_file_list
+                                if not os.path.basename(job_file).startswith("d2s_self_"))
 
-        # Submit each of the jobs within the job file list
-        for job_file in job_file_list:
+        self_job_ids: List[str] = []
 
-            if self.dry_run:
-                print(f"[DRY RUN] qsub {job_file}")
-            else:
-                os.system(f"qsub {job_file}")
-                time.sleep(0.5)
+        for job_file in self_job_files:
+            self_job_ids.append(self.submit_job(job_file))
+
+        # qsub limits the length of the dependency list, so long lists are
+        # first gathered by barrier jobs
+        barrier_index = 0
+
+        while len(self_job_ids) > MAX_DEPEND_JOBS:
+            barrier_job_ids: List[str] = []
+
+            for i in range(0, len(self_job_ids), MAX_DEPEND_JOBS):
+                barrier_name = f"d2s_barrier_{self.index}_{barrier_index}"
+                barrier_index += 1
+
+                self.write_job_files(["true"], barrier_name, groups=1, job_time=1, job_mem="1GB", ncpus=1)
+                barrier_job_ids.append(self.submit_job(
+                    os.path.join(self.output_dir, f"{barrier_name}_0_job.sh"),
+                    ["-W", "depend=afterany:" + ":".join(self_job_ids[i:i + MAX_DEPEND_JOBS])]))
+
+            self_job_ids = barrier_job_ids
+
+        depend_args: List[str] = []
+
+        if self_job_ids:
+            depend_args = ["-W", "depend=afterany:" + ":".join(self_job_ids)]
+
+        for job_file in pair_job_files:
+            self.submit_job(job_file, depend_args)
 
         return
 
+    def submit_job(self, job_file: str, qsub_args: Optional[List[str]] = None) -> str:
+        """
+        Submits a single job file with qsub.
+
+        Parameters:
+            job_file:
+                A path to the job file.
+            qsub_args:
+                Extra arguments for qsub, e.g. a job dependency.
+
+        Return:
+            The ID of the submitted job (a placeholder in a dry run).
+        """
+
+        cmd = ["qsub"] + (qsub_args or []) + [job_file]
+
+        if self.dry_run:
+            print(f"[DRY RUN] {' '.join(cmd)}")
+            return os.path.splitext(os.path.basename(job_file))[0]
+
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        except OSError as error:
+            sys.exit(f"ERROR: Could not run qsub: {error}")
+
+        if result.returncode:
+            sys.exit(f"ERROR: qsub failed to submit {job_file}")
+
+        time.sleep(0.5)
+
+        return result.stdout.strip()
+
     def delete_jobs(self):
         """
         Deletes all the job files within the output directory.
@@ -422,6 +956,39 @@ class JobCreator:
         return
 
 
+def get_tile_job_mem(tile_memory: float) -> float:
+    """
+    Estimates the peak memory (in GB) of a job running one tile.
+
+    Parameters:
+        tile_memory:
+            The memory (in GB) the k-mer sets of a tile take up.
+
+    Return:
+        The memory the tile job should request.
+    """
+
+    return tile_memory * TILE_PEAK_FACTOR + TILE_BASE_MEM
+
+
+def get_kmerset_memory(kmerset_path: str) -> int:
+    """
+    Estimates the memory (in bytes) a k-mer set takes up in a tile.
+
+    Parameters:
+        kmerset_path:
+            A path to a binary k-mer profile or a gzipped text k-mer file.
+
+    Return:
+        The estimated memory of the k-mer codes and residuals.
+    """
+
+    if kmerset_path.endswith(PROFILE_EXT):
+        return load_Kmer_profile(kmerset_path).num_kmers * TILE_BYTES_PER_KMER
+
+    return os.path.getsize(kmerset_path) // TEXT_BYTES_PER_KMER * TILE_BYTES_PER_KMER
+
+
 def main():
 
     parser = argparse.ArgumentParser(description="Creates (and possibly runs) "
@@ -430,7 +997,7 @@ def main():
     parser.add_argument('--slurm_dir', type=str, default=os.path.join(ROOT_DIR, "batch", "d2s_jobs"),
                         help='A full path to a directory to create slurm and batch files.')
     parser.add_argument('--data_input_path', type=str, required=True,
-                        help='A full path to the nkc.gz and CharFreq files.')
+                        help='A full path to the nkc.gz (or nkp) and CharFreq files.')
     parser.add_argument('--data_output_path', type=str, required=True,
                         help='An output folder for the d2s script.')
     parser.add_argument('--group', type=int, required=False, default=500,
@@ -444,11 +1011,32 @@ def main():
                         help='If True the created job folder will be deleted immediately after submitting the jobs.')
     parser.add_argument('-d', '--dry_run', type=convert_bool_arg, default=False, const=False, nargs='?',
                         help='If True the program will simulate job submission output text but will not submit the jobs.')
+    parser.add_argument('-c', '--self_cache', type=convert_bool_arg, default=True, const=True, nargs='?',
+                        help='If True the self scores of each k-mer set are cached and reused by every pairwise job.')
+    parser.add_argument('-r', '--residuals', type=convert_bool_arg, default=False, const=True, nargs='?',
+                        help='If True the residuals of each k-mer set are precomputed and reused by every pairwise job.')
+    parser.add_argument('--tile_memory', type=float, required=False, default=0,
+                        help='If above 0, each job scores a tile of k-mer set pairs using up to this much memory (GB).')
+    parser.add_argument('-i', '--incremental', type=convert_bool_arg, default=False, const=True, nargs='?',
+                        help='If True pairs that already have a distance file in the output folder are skipped.')
+    parser.add_argument('--base_matrix', type=str, required=False, default=None,
+                        help='A path to an existing PHYLIP matrix, pairs of genomes already in it are skipped.')
+    parser.add_argument('-m', '--measures', type=str, required=False, default=None,
+                        help='Comma separated distances for each pairwise job to calculate, e.g. D2S,D2star,Mash.')
+    parser.add_argument('--canonical', type=convert_bool_arg, default=False, const=True, nargs='?',
+                        help='If True the text k-mer sets hold canonical k-mers (binary k-mer profiles record this themselves).')
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help='A path to a k-mer cache (see Count_Kmers.py --cache_dir) to copy missing k-mer files from.')
+    parser.add_argument('-k', '--kmer_size', type=int, required=False, default=21,
+                        help='The k-mer size the fasta files were counted with (names their k-mer files).')
 
     args = parser.parse_args()
 
     JobCreator(args.slurm_dir, args.data_input_path, args.data_output_path,
-               index=args.index, groups=args.group, submit=args.submit, temp=args.temp, dry_run=args.dry_run)
+               index=args.index, groups=args.group, submit=args.submit, temp=args.temp, dry_run=args.dry_run,
+               self_cache=args.self_cache, residuals=args.residuals, tile_memory=args.tile_memory,
+               incremental=args.incremental, base_matrix=args.base_matrix, measures=args.measures,
+               canonical=args.canonical, cache_dir=args.cache_dir, kmer_size=args.kmer_size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from typing import Dict, List, NamedTuple, Optional
+from datetime import timedelta
+
+from Count_Kmers import KMER_BUFFER_BYTES
+from create_d2s_jobs import convert_bool_arg, get_fasta_files, strfdelta
+
+"""
+Runs the per-genome preprocessing (Count_Kmers.py --freq --done, which writes the
+k-mer profile, the CharFreq file and the .done marker from one read of the fasta
+file) for every fasta file in a folder on the local machine. Instead of a fixed
+amount of memory per genome (see jellyfish/run_jellyfish.sh), the peak memory of
+each genome is estimated from its size, and as many genomes are run at once as
+fit in the memory and CPU budget. Genomes with a .done file are skipped, so an
+interrupted run can simply be restarted. With --cache_dir, genomes already counted
+(in any folder) are copied from the k-mer cache instead (see Count_Kmers.py).
+
+Example Usage:
+    (Unix)
+python3 calculate_d2s/run_preprocessing.py --data_input_path /30days/s4430291/Genomes_for_AFphylogeny_red_40 --memory 120 --cpus 24
+"""
+
+# Memory (in bytes) of a preprocessing job besides its k-mer buffer: python,
+# numpy and the 2-bit encoding of one chunk of the fasta file
+JOB_BASE_MEMORY = 1 << 30
+
+# Rough compression ratio of gzipped fasta files, to estimate their number of bases
+FASTA_GZIP_RATIO = 4
+
+# Seconds between checks for finished jobs
+POLL_INTERVAL = 1
+
+
+class PreprocessJob(NamedTuple):
+    fasta_path: str
+    memory: int
+    cmd: List[str]
+
+
+def estimate_job_memory(fasta_path: str, max_buffer_memory: int) -> int:
+    """
+    Estimates the peak memory (in bytes) of preprocessing a fasta file. Each base
+    of the fasta file adds a k-mer to the buffer of Count_Kmers.py, up to
+    max_buffer_memory, after which the buffer is spilled to disk.
+
+    Parameters:
+        fasta_path:
+            A path to a (possibly gzipped) fasta file.
+        max_buffer_memory:
+            The most memory the k-mer buffer of a job may use (in bytes).
+
+    Return:
+        The estimated peak memory of the job.
+    """
+
+    num_bases = os.path.getsize(fasta_path)
+
+    if fasta_path.endswith('.gz'):
+        num_bases *= FASTA_GZIP_RATIO
+
+    return JOB_BASE_MEMORY + min(num_bases * KMER_BUFFER_BYTES, max_buffer_memory)
+
+
+def get_preprocess_jobs(data_input_path: str, memory: int, job_memory: int, kmer_size: int,
+                        canonical: bool, min_count: int, python: str,
+                        cache_dir: Optional[str] = None) -> List[PreprocessJob]:
+    """
+    Creates the preprocessing job of every fasta file without a .done file.
+
+    Parameters:
+        data_input_path:
+            A path to a folder holding fasta files.
+        memory:
+            The memory budget of all the jobs (in bytes).
+        job_memory:
+            The most memory the k-mer buffer of a single job may use (in bytes).
+        kmer_size:
+            The k-mer size.
+        canonical:
+            If True each k-mer is counted together with its reverse complement.
+        min_count:
+            k-mers counted fewer times than this are dropped.
+        python:
+            The python interpreter to run Count_Kmers.py with.
+        cache_dir:
+            A path to a k-mer cache to copy the outputs from (or add them to).
+
+    Return:
+        The preprocessing jobs, largest first.
+    """
+
+    count_kmers_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "Count_Kmers.py")
+
+    # No single job may use more than the whole budget
+    max_buffer_memory = min(job_memory, memory - JOB_BASE_MEMORY)
+
+    jobs: List[PreprocessJob] = []
+    done = 0
+
+    for fasta_path in get_fasta_files(data_input_path):
+
+        if os.path.exists(fasta_path + ".done"):
+            done += 1
+            continue
+
+        job_memory_needed = estimate_job_memory(fasta_path, max_buffer_memory)
+
+        cmd = [python, count_kmers_path, "--fasta", fasta_path,
+               "-k", str(kmer_size), "-o", fasta_path + ".{}mer.nkp".format(kmer_size),
+               "--freq", fasta_path + ".CharFreq", "--done", fasta_path + ".done",
+               "--memory", str((job_memory_needed - JOB_BASE_MEMORY) / 1e9),
+               "--min_count", str(min_count)]
+
+        if canonical:
+            cmd.append("--canonical")
+
+        if cache_dir is not None:
+            cmd.extend(["--cache_dir", cache_dir])
+
+        jobs.append(PreprocessJob(fasta_path, job_memory_needed, cmd))
+
+    print("Found {} fasta files, {} already preprocessed".format(len(jobs) + done, done))
+
+    return sorted(jobs, key=lambda job: job.memory, reverse=True)
+
+
+def run_preprocess_jobs(jobs: List[PreprocessJob], memory: int, cpus: int) -> List[PreprocessJob]:
+    """
+    Runs the jobs concurrently, starting the largest pending job that fits in the
+    free memory and CPUs whenever a job finishes. The output of each job is
+    written to a .preprocess.log file next to its fasta file.
+
+    Parameters:
+        jobs:
+            The preprocessing jobs, largest first.
+        memory:
+            The memory budget of all the running jobs (in bytes).
+        cpus:
+            The most jobs that run at once (each job uses one CPU).
+
+    Return:
+        The jobs that failed.
+    """
+
+    pending = list(jobs)
+    running: Dict[subprocess.Popen, PreprocessJob] = {}
+    started: Dict[subprocess.Popen, float] = {}
+    failed: List[PreprocessJob] = []
+    used_memory = 0
+
+    while pending or running:
+
+        # Start the largest pending jobs that fit in the free memory and CPUs
+        for job in list(pending):
+            if len(running) >= cpus:
+                break
+
+            if used_memory + job.memory > memory:
+                continue
+
+            log_file = open(job.fasta_path + ".preprocess.log", 'w')
+            process = subprocess.Popen(job.cmd, stdout=log_file, stderr=subprocess.STDOUT)
+            log_file.close()
+
+            running[process] = job
+            started[process] = time.time()
+            used_memory += job.memory
+            pending.remove(job)
+
+            print("Started {} ({:.1f} GB estimated, {:.1f} GB in use)".format(
+                job.fasta_path, job.memory / 1e9, used_memory / 1e9))
+
+        time.sleep(POLL_INTERVAL)
+
+        for process in [process for process in running if process.poll() is not None]:
+            job = running.pop(process)
+            used_memory -= job.memory
+
+            elapsed = strfdelta(timedelta(seconds=time.time() - started.pop(process)))
+
+            if process.returncode:
+                failed.append(job)
+                print("FAILED {} after {} (exit code {}, see {})".format(
+                    job.fasta_path, elapsed, process.returncode, job.fasta_path + ".preprocess.log"))
+            else:
+                print("Finished {} in {}".format(job.fasta_path, elapsed))
+
+    return failed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Runs the per-genome preprocessing of every fasta "
+                                     "file in a folder locally, within a memory and CPU budget.")
+
+    parser.add_argument('--data_input_path', type=str, required=True,
+                        help='A full path to the fasta files.')
+    parser.add_argument('--memory', type=float, required=True,
+                        help='The memory (GB) all the running jobs may use together.')
+    parser.add_argument('--cpus', type=int, required=False, default=os.cpu_count(),
+                        help='The most jobs that run at once, one CPU each.')
+    parser.add_argument('--job_memory', type=float, required=False, default=8,
+                        help='The most memory (GB) one job counts k-mers in before spilling them to disk.')
+    parser.add_argument('-k', '--kmer_size', type=int, required=False, default=21,
+                        help='The k-mer size.')
+    parser.add_argument('--canonical', type=convert_bool_arg, default=False, const=True, nargs='?',
+                        help='If True each k-mer is counted together with its reverse complement.')
+    parser.add_argument('--min_count', type=int, required=False, default=1,
+                        help='k-mers counted fewer times than this are dropped.')
+    parser.add_argument('--python', type=str, required=False, default=sys.executable,
+                        help='The python interpreter to run Count_Kmers.py with.')
+    parser.add_argument('--cache_dir', type=str, required=False, default=None,
+                        help='A path to a k-mer cache, identical fasta files are copied from it instead of recounted.')
+    parser.add_argument('-d', '--dry_run', type=convert_bool_arg, default=False, const=True, nargs='?',
+                        help='If True the jobs are printed but not run.')
+
+    args = parser.parse_args()
+
+    memory = int(args.memory * 1e9)
+
+    if memory <= JOB_BASE_MEMORY:
+        sys.exit("ERROR: --memory has to be above {:.1f} GB".format(JOB_BASE_MEMORY / 1e9))
+
+    jobs = get_preprocess_jobs(args.data_input_path, memory, int(args.job_memory * 1e9), args.kmer_size,
+                               args.canonical, args.min_count, args.python, cache_dir=args.cache_dir)
+
+    if args.dry_run:
+        for job in jobs:
+            print("{:.1f} GB\t{}".format(job.memory / 1e9, ' '.join(job.cmd)))
+        return
+
+    failed = run_preprocess_jobs(jobs, memory, max(args.cpus, 1))
+
+    if failed:
+        sys.exit("ERROR: {} of {} fasta files failed, rerun to retry them".format(len(failed), len(jobs)))
+
+    print("Preprocessed {} fasta files".format(len(jobs)))
+
+
+if __name__ == "__main__":
+
+    main()
+
+    exit(0)
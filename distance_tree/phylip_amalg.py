@@ -88,7 +88,58 @@ def setup_df(name_list):
     return blank_df
 
 
-def extract_result(result_path: str):
+def read_phylip(matrix_path: str) -> pd.DataFrame:
+    """
+    Reads a PHYLIP matrix (as written by print_phylip) into a dataframe.
+
+    Parameters:
+        matrix_path:
+            A path to a PHYLIP distance matrix.
+
+    Returns:
+        A dataframe with the gene names as the rows and columns.
+    """
+
+    with open(matrix_path, 'r') as matrix_file:
+        rows = int(matrix_file.readline().strip())
+
+        names = []
+        values = []
+
+        for line in matrix_file:
+            if not line.strip():
+                continue
+
+            # The names are left justified and may be padded with spaces
+            name, *row = line.rstrip('\n').split('\t')
+            names.append(name.strip())
+            values.append([float(value) for value in row])
+
+    if len(names) != rows or any(len(row) != rows for row in values):
+        raise ValueError("%s is not a %d x %d PHYLIP matrix." %
+                         (matrix_path, rows, rows))
+
+    return pd.DataFrame(values, index=names, columns=names, dtype=float)
+
+
+def populate_base_matrix(phylip_df: pd.DataFrame, base_df: pd.DataFrame):
+    """
+    Populates the dataframe with all the distances of an existing matrix.
+
+    Parameters:
+        phylip_df:
+            A dataframe that will eventually contain all the distance results.
+
+        base_df:
+            A dataframe holding the distances of an existing matrix.
+    """
+
+    phylip_df.loc[base_df.index, base_df.columns] = base_df
+
+    return
+
+
+def extract_result(result_path: str, measure: Optional[str] = None):
     """
     Extracts a single result from the specified result path.
 
@@ -96,6 +147,11 @@ def extract_result(result_path: str):
         result_path:
             A path to a single file containing a distance value.
 
+        measure:
+            The name of the distance column to extract from a file with a
+            '#' header row (see Calculate_D2S.py --measures). If None, the
+            last column is extracted.
+
     Returns:
         Returns the distance value (as a float) from the specified result path.
     """
@@ -109,6 +165,18 @@ def extract_result(result_path: str):
     # on the semi-colon
     value = result_str.rsplit(';', maxsplit=1)[-1]
 
+    if measure is not None:
+        lines = [line for line in result_str.splitlines() if line.strip()]
+        header = [line for line in lines if line.startswith('#')]
+        rows = [line for line in lines if not line.startswith('#')]
+
+        columns = header[-1].lstrip('#').split(';') if header else []
+        row = rows[-1].split(';') if rows else []
+
+        # Leave the value unparsable if the measure is missing
+        value = row[columns.index(measure)] if measure in columns and len(
+            row) == len(columns) else ''
+
     try:
         return float(value)
     except ValueError:
@@ -119,7 +187,7 @@ def extract_result(result_path: str):
         return 0
 
 
-def poplate_single_result(phylip_df: pd.DataFrame, result_path: str):
+def poplate_single_result(phylip_df: pd.DataFrame, result_path: str, measure: Optional[str] = None):
     """
     Populates the dataframe with a single value from the results folder.
 
@@ -129,10 +197,13 @@ def poplate_single_result(phylip_df: pd.DataFrame, result_path: str):
 
         result_path:
             A path to a single file containing a distance value.
+
+        measure:
+            The name of the distance to use (see extract_result).
     """
 
     # Get the result value (as a float) from the specified result path
-    result_value = extract_result(result_path)
+    result_value = extract_result(result_path, measure)
 
     # Retrieve the gene ids from the file name
     gene_id_1, gene_id_2 = get_gene_ids_from_path(result_path)
@@ -143,7 +214,7 @@ def poplate_single_result(phylip_df: pd.DataFrame, result_path: str):
     return
 
 
-def populate_all_results(phylip_df: pd.DataFrame, result_dir: str):
+def populate_all_results(phylip_df: pd.DataFrame, result_dir: str, measure: Optional[str] = None):
     """
     Populates the dataframe with all results from a given result directory.
 
@@ -153,13 +224,16 @@ def populate_all_results(phylip_df: pd.DataFrame, result_dir: str):
 
         result_dir:
             A directory containing all the distance results.
+
+        measure:
+            The name of the distance to use (see extract_result).
     """
 
     # Get all the result files from the the result directory.
     target_files = glob(os.path.join(result_dir, "**"))
 
     for target_file in target_files:
-        poplate_single_result(phylip_df, target_file)
+        poplate_single_result(phylip_df, target_file, measure)
 
     if CORRUPT_FILES > 0:
         print("[WARN] %d corrupted file/s found in %s (skipped)." % (CORRUPT_FILES, result_dir), file=sys.stderr)
@@ -197,7 +271,7 @@ def print_phylip(phylip_df: pd.DataFrame, output_path: str):
     return
 
 
-def create_matrix(data_folder, output_file):
+def create_matrix(data_folder, output_file, base_matrix=None, measure=None):
 
     zipped = data_folder.endswith(".tz.gz")
     zipped_data_folder = None
@@ -216,8 +290,18 @@ def create_matrix(data_folder, output_file):
             tar.close()
 
     name_list = get_names(data_folder)
+
+    # Results in the data folder replace the distances of the base matrix
+    if base_matrix is not None:
+        base_df = read_phylip(base_matrix)
+        name_list = sorted(set(name_list) | set(base_df.index))
+
     blank_df = setup_df(name_list)
-    populate_all_results(blank_df, data_folder)
+
+    if base_matrix is not None:
+        populate_base_matrix(blank_df, base_df)
+
+    populate_all_results(blank_df, data_folder, measure)
     print_phylip(blank_df, output_file)
 
     if zipped:
@@ -235,10 +319,14 @@ def main():
                         help='A path to a directory or tarball that has the individual distances.')
     parser.add_argument('--matrix', type=str, required=True,
                         help='A path to a text file to dump the contents of the matrix.')
+    parser.add_argument('--base_matrix', type=str, required=False, default=None,
+                        help='A path to an existing PHYLIP matrix to update with the individual distances.')
+    parser.add_argument('--measure', type=str, required=False, default=None,
+                        help='The distance to use from files with several measures (e.g. D2S, Mash), defaults to the last one.')
 
     args = parser.parse_args()
 
-    create_matrix(args.data, args.matrix)
+    create_matrix(args.data, args.matrix, base_matrix=args.base_matrix, measure=args.measure)
 
 
 if __name__ == '__main__':
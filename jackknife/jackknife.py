@@ -5,18 +5,29 @@ __version__ = ''
 
 import argparse
 import itertools
+import logging
 import os
 import sys
+import zlib
 from concurrent import futures
 from functools import wraps
 from glob import glob
-from random import choices, randrange
+from multiprocessing import shared_memory
+from random import choices
 from threading import Lock
 from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import numpy as np
 from Bio import SeqIO, SeqRecord
 
+# The virtual replicates (see --virtual) are written with the k-mer profile
+# tools of calculate_d2s
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'calculate_d2s'))
+
+from Count_Kmers import write_Character_Frequency  # noqa: E402
+from D2S_tools import (BASE_CODE_TABLE, FLAG_SKETCH, FLAG_CANONICAL, KmerProfileWriter,  # noqa: E402
+                       encode_Fasta_Kmers, load_Kmer_profile)
+
 """
 Example usage:
     (Windows)
@@ -32,6 +43,14 @@ Example usage:
     python3 ./jackknife.py --input_path ./data/S.necroappetens_CCMP2469.genome.fasta --output_path ./data -v --threads=1
 """
 
+# The removed stretches of a virtual replicate, one "seq_id start end" BED line
+# each (see virtual_replicate_remover). It is written last, so a virtual
+# replicate is complete once it has this file.
+REMOVED_EXT = '.removed.bed'
+
+# The number of k-mers written to a virtual replicate profile at a time
+PROFILE_BLOCK_SIZE = 1 << 22
+
 
 def unpack(target_func: Callable):
     """
@@ -305,125 +324,279 @@ def generate_rm_dict(total_chunks_rm: int, portion_dictionary: Dict[str, float],
     return rm_dict
 
 
-@unpack
-def remove_chunks(str_portion: bytes, chunk_size: int, portion: float, reduced_portions: list, count: int, mutex: Lock):
+def draw_removed_runs(seq_len: int, chunk_size: int, num_chunks_rm: int,
+                      rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Removes a prescribed number of chunks from a sequence.
+    Draws which stretches of a sequence are removed by removing num_chunks_rm
+    chunks from it one at a time, each starting at a random position of what is
+    left of the sequence (randrange(0, len(seq) - chunk_size)), without copying
+    the sequence once per chunk.
+
+    NOTE:
+        Undoing the removals from the last to the first puts each chunk back in
+        front of a random base of the shorter sequence (never after its last
+        base). So every removed stretch is a run of whole chunks in front of a
+        kept base, and the chunks are shared out between the kept bases like a
+        Polya urn: a chunk lands in front of a kept base with one ball for the
+        base itself and one for each base of the chunks already in front of it.
+        Each chunk either picks a kept base or a base of an earlier chunk (and
+        joins that chunk), and the chains of earlier chunks are followed by
+        pointer jumping, which gives the same distribution as removing the
+        chunks one at a time. Only the kept bases with chunks in front of them
+        are looked at, so this takes O(num_chunks_rm) time and memory.
 
-    Parameter:
-        str_portion:
-            The portion of the chunk that needs to be reduced by this thread.
+    Parameters:
+        seq_len:
+            The length of the sequence.
 
         chunk_size:
-            The size of the chunk that need to be removed.
-
-        portion:
-            The amount of data (as a decimal) to be removed from str_portion.
+            The size of the chunks to remove.
 
-        reduced_portions:
-            A list that will hold all the reduced chunks.
+        num_chunks_rm:
+            The number of chunks to remove.
 
-        count:
-            The position of this portion in the final string.
+        rng:
+            The random number generator to draw the chunks with.
 
-        mutex:
-            A threading mutex to safely access the fasta dictionary (which
-            will be shared between multiple threads).
+    Returns:
+        The sorted start and end (exclusive) of each removed stretch.
     """
 
-    # Find the number of chunks that need to be removed from this string
-    # portion
-    num_chunks_rm = int(len(str_portion) * portion) // chunk_size
+    num_kept = seq_len - num_chunks_rm * chunk_size
 
-    if chunk_size * num_chunks_rm == len(str_portion):
+    if num_kept <= 0:
 
-        # The very unlikely event where the entire sequence should be removed.
-        str_portion = ""
+        # The whole sequence is removed (if there is anything to remove)
+        num_runs = 1 if seq_len else 0
+        return np.zeros(num_runs, dtype=np.int64), np.full(num_runs, seq_len, dtype=np.int64)
 
-    else:
+    # Put the chunks back in front of a random base, last removed first. The
+    # first num_kept bases are the kept ones, followed by the bases of the
+    # chunks in the order they were put back.
+    chunks = np.arange(num_chunks_rm, dtype=np.int64)
+    picks = rng.integers(0, num_kept + chunks * chunk_size)
 
-        for _ in range(num_chunks_rm):
+    # Each chunk points to itself if it picked a kept base, otherwise to the
+    # earlier chunk it picked a base of
+    pointers = np.where(picks < num_kept, chunks,
+                        (picks - num_kept) // chunk_size)
 
-            # Pick a starting value to remove the chunk
-            index_start = randrange(0, len(str_portion) - chunk_size)
+    while True:
+        jumped = pointers[pointers]
 
-            str_portion = str_portion[:index_start] + \
-                str_portion[index_start + chunk_size:]
+        if np.array_equal(jumped, pointers):
+            break
 
-    with mutex:
-        reduced_portions.append((count, str_portion))
+        pointers = jumped
 
-    return
+    # The kept bases with chunks in front of them, and the number of chunks.
+    # Each kept base is moved along by the chunks in front of it and in front
+    # of the kept bases before it.
+    bases, chunks_before = np.unique(picks[pointers], return_counts=True)
+    ends = bases + np.cumsum(chunks_before) * chunk_size
 
+    return ends - chunks_before * chunk_size, ends
 
-@unpack
-def remove_chunks2(fasta_dict, chunk_size, portion, seq_id, mutex):
+
+def kept_runs(starts: np.ndarray, ends: np.ndarray, seq_len: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gets the stretches of a sequence that are kept around its removed
+    stretches (see draw_removed_runs). Some of them may be empty.
+
+    Parameters:
+        starts, ends:
+            The sorted start and end (exclusive) of each removed stretch.
+
+        seq_len:
+            The length of the sequence.
+
+    Returns:
+        The start and end (exclusive) of each kept stretch.
     """
-    Removes a prescribed number of chunks from a sequence.
 
-    Parameter:
-        str_portion:
-            The portion of the chunk that needs to be reduced by this thread.
+    return np.concatenate(([0], ends)), np.concatenate((starts, [seq_len]))
+
+
+def count_chunks_rm(seq_len: int, chunk_size: int, portion: float) -> Tuple[int, int]:
+    """
+    Works out how many chunks are removed from a sequence, and how long the
+    reduced sequence is.
+
+    Parameters:
+        seq_len:
+            The length of the sequence.
 
         chunk_size:
-            The size of the chunk that need to be removed.
+            The size of the chunks to remove.
 
         portion:
-            The amount of data (as a decimal) to be removed from str_portion.
+            The amount of data (as a decimal) to be removed from the sequence.
+
+    Returns:
+        The number of chunks to remove and the length of the reduced sequence.
+    """
 
-        reduced_portions:
-            A list that will hold all the reduced chunks.
+    # Find the number of chunks that need to be removed from this sequence
+    num_chunks_rm = int(seq_len * portion) // chunk_size
 
-        count:
-            The position of this portion in the final string.
+    if chunk_size * num_chunks_rm >= seq_len:
 
-        mutex:
-            A threading mutex to safely access the fasta dictionary (which
-            will be shared between multiple threads).
+        # The very unlikely event where the entire sequence should be removed.
+        return num_chunks_rm, 0
+
+    return num_chunks_rm, seq_len - chunk_size * num_chunks_rm
+
+
+def replicate_seed_seq(seed_seq: np.random.SeedSequence, fasta_path: str, index: int) -> np.random.SeedSequence:
     """
+    Gets the seed sequence of one replicate of a fasta file. It only depends on
+    the root seed, the name of the fasta file and the replicate index, so a
+    replicate can be reproduced on its own, whatever else is in the run.
 
-    with mutex:
-        # Convert the BioPython sequence into an array
-        seq_array = fasta_dict[seq_id].seq._data
+    Parameters:
+        seed_seq:
+            The root seed sequence (see --seed).
 
-    # Find the number of chunks that need to be removed from this string
-    # portion
-    num_chunks_rm = int(len(seq_array) * portion) // chunk_size
+        fasta_path:
+            A path to the fasta file.
 
-    if chunk_size * num_chunks_rm >= len(seq_array):
+        index:
+            The index of the replicate.
 
-        # The very unlikely event where the entire sequence should be removed.
-        seq_array = ""
+    Returns:
+        The seed sequence of the replicate, whose children seed its sequences.
+    """
 
-    else:
+    name_key = zlib.crc32(os.path.basename(fasta_path).encode('utf-8'))
+
+    return np.random.SeedSequence(seed_seq.entropy, spawn_key=tuple(seed_seq.spawn_key) + (name_key, index))
+
+
+# The shared memory blocks holding the input and reduced sequences, attached
+# once in each worker process (see attach_shared_buffers)
+_shared_buffers: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def attach_shared_buffers(input_name: str, output_name: str):
+    """
+    Attaches a worker process to the shared memory blocks of the input and
+    reduced sequences.
+    """
 
-        for _ in range(num_chunks_rm):
+    _shared_buffers['input'] = shared_memory.SharedMemory(name=input_name)
+    _shared_buffers['output'] = shared_memory.SharedMemory(name=output_name)
 
-            # Pick a starting value to remove the chunk
-            index_start = randrange(0, len(seq_array) - chunk_size)
 
-            seq_array = seq_array[:index_start] + \
-                seq_array[index_start + chunk_size:]
+@unpack
+def reduce_shared_record(input_offset: int, seq_len: int, output_offset: int, chunk_size: int, portion: float,
+                         seed_seq: np.random.SeedSequence):
+    """
+    A helper process function that reduces one sequence held in shared memory
+    and writes the reduced sequence to its place in the shared output block.
+    """
+
+    num_chunks_rm, reduced_len = count_chunks_rm(seq_len, chunk_size, portion)
+
+    if reduced_len == 0:
+        return
+
+    seq = np.ndarray(seq_len, dtype=np.uint8,
+                     buffer=_shared_buffers['input'].buf, offset=input_offset)
+    reduced_seq = np.ndarray(reduced_len, dtype=np.uint8,
+                             buffer=_shared_buffers['output'].buf, offset=output_offset)
+
+    starts, ends = draw_removed_runs(seq_len, chunk_size, num_chunks_rm, np.random.default_rng(seed_seq))
+
+    kept_starts, kept_ends = kept_runs(starts, ends, seq_len)
+
+    offset = 0
+    for start, end in zip(kept_starts.tolist(), kept_ends.tolist()):
+        reduced_seq[offset:offset + end - start] = seq[start:end]
+        offset += end - start
+
+    return
+
 
-    with mutex:
-        fasta_dict[seq_id].seq._data = seq_array
+def reduce_shared_records(record_args: List[tuple]):
+    """
+    A helper process function that reduces a batch of sequences held in shared
+    memory (see reduce_shared_record).
+    """
+
+    for args in record_args:
+        reduce_shared_record(args)
 
     return
 
 
-def portion_remover(fasta_path: str, output_path: str = None,
-                    portion: float = 0.4, chunk_size: int = 100, threads: int = 1, verbose: bool = True):
+def read_fasta_records(fasta_path: str) -> List[Tuple[str, bytes]]:
     """
-    Randomly removes a certain portion of data from a fasta file and saves the
-    result in an output path.
+    Reads the sequences of a fasta file as compact byte buffers.
 
     Parameters:
         fasta_path:
-            A path to the fasta file to remove data.
+            A path to a fasta file.
+
+    Returns:
+        The (description, sequence) of each sequence in the fasta file.
+    """
+
+    return [(seq_rec.description, str(seq_rec.seq).encode('ASCII'))
+            for seq_rec in SeqIO.parse(fasta_path, "fasta")]
+
 
+def write_fasta_records(output_path: str, records: Iterable[Tuple[str, bytes]], line_width: int = 60):
+    """
+    Writes sequences to a fasta file, wrapped like SeqIO.write does.
+
+    Parameters:
         output_path:
-            The output path to save the resulting data. If no path in
-            specified than the output will be directed to stdout.
+            The path of the fasta file to write.
+
+        records:
+            The (description, sequence) of each sequence.
+
+        line_width:
+            The number of bases on each sequence line.
+    """
+
+    with open(output_path, 'wb') as output_file:
+
+        for description, seq in records:
+            output_file.write(b'>' + description.encode('ASCII') + b'\n')
+
+            if seq:
+                output_file.write(b'\n'.join(seq[start:start + line_width]
+                                              for start in range(0, len(seq), line_width)) + b'\n')
+
+
+def replicate_remover(fasta_path: str, output_paths: List[str], seed_seqs: List[np.random.SeedSequence],
+                      portion: float = 0.4, chunk_size: int = 100, threads: int = 1, verbose: bool = True):
+    """
+    Writes a jackknife replicate of a fasta file to each output path, reading
+    the fasta file only once. The sequences are reduced by a pool of processes,
+    which read them from (and write the reduced sequences to) shared memory.
+    Each sequence of a replicate has its own random number generator, spawned
+    from the seed sequence of the replicate, so the output does not depend on
+    the number of processes.
+
+    NOTE:
+        The replicates are reduced into slots of the shared output block, and
+        a replicate is written as soon as all its sequences are reduced. A
+        genome with at least as many sequences as processes keeps them busy
+        with a single slot. Only a genome with fewer sequences gets more slots,
+        just enough to keep the processes busy (and one more, so that a slot is
+        reduced while another is written).
+
+    Parameters:
+        fasta_path:
+            A path to the fasta file to remove data.
+
+        output_paths:
+            The output path of each replicate.
+
+        seed_seqs:
+            The seed sequence of each replicate (see replicate_seed_seq).
 
         portion:
             The portion of data to remove. The default is a 40% reduction
@@ -433,7 +606,7 @@ def portion_remover(fasta_path: str, output_path: str = None,
             The chunk size of the data to remove.
 
         threads:
-            The number of threads used to remove the data.
+            The number of processes used to remove the data.
 
         verbose:
             If true, runs the function in verbose mode.
@@ -442,100 +615,253 @@ def portion_remover(fasta_path: str, output_path: str = None,
     if threads == 0:
         threads = os.cpu_count()
 
-    if output_path is None:
-        output_path = sys.stdout
-
     if verbose:
         print()
         print('Running on ' + os.path.basename(fasta_path) + ' with:')
-        print('\t' + 'output_path=' + output_path)
+        print('\t' + 'replicates=' + str(len(output_paths)))
         print('\t' + 'portion=' + str(portion * 100))
         print('\t' + 'chunk_size=' + str(chunk_size))
         print('\t' + 'threads=' + str(threads))
         print()
+        print('Reading Data...')
 
-    # Create a lock for multi-threading later on
-    mutex = Lock()
+    records = read_fasta_records(fasta_path)
+    descriptions = [description for description, _ in records]
 
-    if verbose:
-        print('Reading Data...')
+    # The reduced length of each sequence is the same in every replicate, so
+    # every sequence has a fixed place in the input block and in each slot of
+    # the output block
+    seq_lens = [len(seq) for _, seq in records]
+    reduced_lens = [count_chunks_rm(seq_len, chunk_size, portion)[1] for seq_len in seq_lens]
 
-    # Open the fasta file as a dictionary
-    fasta_list: List[SeqRecord.SeqRecord] = list(
-        SeqIO.parse(fasta_path, "fasta"))
+    input_offsets = np.concatenate(([0], np.cumsum(seq_lens, dtype=np.int64)))
+    output_offsets = np.concatenate(([0], np.cumsum(reduced_lens, dtype=np.int64)))
+
+    # Each slot holds a whole reduced genome, so only use more than one slot
+    # when a replicate has too few sequences to keep the processes busy
+    if len(seq_lens) >= threads:
+        num_slots = 1
+    else:
+        num_slots = min(len(output_paths), -(-threads // max(len(seq_lens), 1)) + 1)
+    slot_size = int(output_offsets[-1])
 
-    # Get the header for the fasta file
-    header = str(fasta_list[0].id)
+    input_shm = shared_memory.SharedMemory(create=True, size=max(int(input_offsets[-1]), 1))
+    output_shm = shared_memory.SharedMemory(create=True, size=max(slot_size * num_slots, 1))
 
-    # Concatenate all the genes into a single string
-    full_str = ''.join(seq_rec.seq._data for seq_rec in fasta_list)
+    try:
+        for (_, seq), input_offset in zip(records, input_offsets):
+            input_shm.buf[input_offset:input_offset + len(seq)] = seq
 
-    # We don't need the biopython parser, remove it from memory
-    del fasta_list
+        # We don't need the parsed sequences anymore, remove them from memory
+        del records
 
-    # Split the string into approximately 'num_threads' equal components.
-    # Each component will then be reduced by a separate thread.
-    str_portion: List[bytes] = [bytes(full_str[index:index+len(full_str) // threads], 'ASCII')
-                                for index in range(0, len(full_str), len(full_str) // threads)]
-    # print("Orig len: ", len(str_portion[0]))
-    # We don't need the full string anymore, remove it from memory
-    del full_str
+        # Each replicate is split into batches of sequences, so many small
+        # sequences don't each make a round trip to a process
+        batch_size = max(len(seq_lens) // (4 * threads), 1)
 
-    # A list to keep all the reduced chunks, the first position of the tuple
-    # will denote the position of the chunk in the final output with 0 being
-    # the first chunk.
-    reduced_portions: List[Tuple[int, bytes]] = []
+        with futures.ProcessPoolExecutor(threads, initializer=attach_shared_buffers,
+                                         initargs=(input_shm.name, output_shm.name)) as executor:
 
-    thread_args = [(str_portion, chunk_size, portion, reduced_portions, count, mutex) for
-                   str_portion, chunk_size, portion, reduced_portions, count, mutex in
-                   zip(
-                       str_portion,
-                       itertools.repeat(chunk_size),
-                       itertools.repeat(portion),
-                       itertools.repeat(reduced_portions),
-                       itertools.count(0),
-                       itertools.repeat(mutex),
-    )]
+            replicates = iter(zip(output_paths, seed_seqs))
+            free_slots = list(range(num_slots))
 
-    with futures.ThreadPoolExecutor(threads) as executor:
-        submitted_results = executor.map(remove_chunks, thread_args)
+            # The output path and slot of the replicates being reduced, the
+            # replicate of each submitted batch and the batches left of each
+            # replicate
+            in_flight: Dict[str, int] = {}
+            pending: Dict[futures.Future, str] = {}
+            remaining: Dict[str, int] = {}
 
-        for result in submitted_results:
-            _ = result
+            while True:
 
-    #   Sort the resulting reduced_portions list
-    reduced_portions = sorted(reduced_portions, key=lambda tup: tup[0])
+                # Start the next replicates in the free slots
+                while free_slots:
+                    next_replicate = next(replicates, None)
 
-    # print("Red len: ", len(reduced_portions[0][1]))
+                    if next_replicate is None:
+                        break
 
-    # Open the output path
-    with open(output_path, 'w') as output_file:
+                    output_path, seed_seq = next_replicate
+                    slot = free_slots.pop()
 
-        # Write the header
-        print(header, file=output_file, flush=True)
+                    process_args = [(int(input_offset), seq_len, slot * slot_size + int(output_offset), chunk_size,
+                                     portion, record_seed_seq)
+                                    for input_offset, seq_len, output_offset, record_seed_seq in
+                                    zip(input_offsets, seq_lens, output_offsets, seed_seq.spawn(len(seq_lens)))]
 
-        # Write each of the reduce portions to the output file
-        for _, str_portion in reduced_portions:
-            output_file.buffer.write(str_portion)
+                    in_flight[output_path] = slot
+                    remaining[output_path] = 0
 
-        output_file.flush()
+                    for start in range(0, max(len(process_args), 1), batch_size):
+                        pending[executor.submit(reduce_shared_records,
+                                                process_args[start:start + batch_size])] = output_path
+                        remaining[output_path] += 1
+
+                if not pending:
+                    break
+
+                finished, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+
+                for future in finished:
+                    output_path = pending.pop(future)
+
+                    # Raise any error of the process
+                    future.result()
+
+                    remaining[output_path] -= 1
+
+                    if remaining[output_path]:
+                        continue
+
+                    slot = in_flight.pop(output_path)
+                    del remaining[output_path]
+
+                    write_fasta_records(output_path, zip(descriptions, (
+                        output_shm.buf[slot * slot_size + output_offset:
+                                       slot * slot_size + output_offset + reduced_len]
+                        for output_offset, reduced_len in zip(output_offsets, reduced_lens))))
+
+                    free_slots.append(slot)
+
+                    if verbose:
+                        print('Wrote ' + output_path, flush=True)
+
+    finally:
+        for shm in (input_shm, output_shm):
+            shm.close()
+            shm.unlink()
 
     return
 
 
-def portion_remover2(fasta_path: str, output_path: str = None,
-                     portion: float = 0.4, chunk_size: int = 100, threads: int = 1, verbose: bool = True):
+def window_Kmer_codes(seq: np.ndarray, window_starts: np.ndarray, window_stops: np.ndarray, k: int,
+                      canonical: bool) -> np.ndarray:
     """
-    Randomly removes a certain portion of data from a fasta file and saves the
-    result in an output path.
+    Encodes the k-mers starting in some ranges of a sequence. The ranges are
+    merged where they overlap, so no k-mer is encoded twice, and the bases of
+    each merged range are gathered into one buffer, separated by an N.
+
+    Parameters:
+        seq:
+            The sequence (uint8 array).
+
+        window_starts:
+            The sorted start of the first k-mer of each range.
+
+        window_stops:
+            The start after the last k-mer of each range (sorted as well).
+
+        k:
+            The k-mer size.
+
+        canonical:
+            If True each k-mer is collapsed with its reverse complement.
+
+    Returns:
+        The codes of the valid k-mers (see encode_Fasta_Kmers).
+    """
+
+    non_empty = window_stops > window_starts
+    window_starts, window_stops = window_starts[non_empty], window_stops[non_empty]
+
+    if not len(window_starts):
+        return np.zeros(0, dtype=np.uint64)
+
+    groups = np.flatnonzero(np.concatenate(
+        ([True], window_starts[1:] > np.maximum.accumulate(window_stops)[:-1])))
+    window_starts = window_starts[groups]
+    window_stops = np.maximum.reduceat(window_stops, groups)
+
+    # The bases of the k-mers of each range, followed by a separator
+    lengths = window_stops - window_starts + k
+    offsets = np.cumsum(lengths) - lengths
+    separators = offsets + lengths - 1
+
+    index = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(offsets - window_starts, lengths)
+    index[separators] = 0
+
+    buffer = seq[index]
+    buffer[separators] = ord('N')
+
+    return encode_Fasta_Kmers(buffer, k, canonical=canonical)
+
+
+def subtract_Kmer_counts(codes: np.ndarray, counts: np.ndarray, lost_codes: np.ndarray, lost_counts: np.ndarray,
+                         new_codes: np.ndarray, new_counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Removes the lost k-mers from a k-mer profile and adds the new ones.
+
+    Parameters:
+        codes, counts:
+            The sorted codes of the profile and their counts.
+
+        lost_codes, lost_counts:
+            The sorted unique codes to subtract and their counts.
+
+        new_codes, new_counts:
+            The sorted unique codes to add and their counts.
+
+    Returns:
+        The sorted codes and counts of the new profile, without the k-mers
+        whose count dropped to 0.
+    """
+
+    counts = np.array(counts, dtype=np.int64)
+
+    index = np.searchsorted(codes, lost_codes)
+    if np.any(index >= len(codes)) or np.any(codes[np.minimum(index, len(codes) - 1)] != lost_codes):
+        raise ValueError("The k-mer profile is missing k-mers of the fasta file.")
+
+    counts[index] -= lost_counts
+
+    if np.any(counts < 0):
+        raise ValueError("The k-mer profile has lower counts than the fasta file.")
+
+    index = np.searchsorted(codes, new_codes)
+    found = index < len(codes)
+    found[found] = codes[index[found]] == new_codes[found]
+
+    counts[index[found]] += new_counts[found]
+
+    codes = np.insert(codes, index[~found], new_codes[~found])
+    counts = np.insert(counts, index[~found], new_counts[~found])
+
+    kept = counts > 0
+
+    return codes[kept], counts[kept]
+
+
+def virtual_replicate_remover(fasta_path: str, profile_path: str, output_dirs: List[str],
+                              seed_seqs: List[np.random.SeedSequence], kmer_ext: str = '.21mer.nkp',
+                              portion: float = 0.4, chunk_size: int = 100, verbose: bool = True):
+    """
+    Writes the k-mer profile and CharFreq file of jackknife replicates of a
+    fasta file without writing (and recounting) the reduced fasta files. The
+    same chunks are removed as by replicate_remover, but instead of the reduced
+    sequences only the removed stretches are written (to a BED file). The
+    k-mers that overlap a removed base are subtracted from the k-mer profile of
+    the whole fasta file, and the k-mers that span the joins of the reduced
+    sequences are added, which gives exactly the profile of the reduced fasta
+    file (see Count_Kmers.py). The base counts of the removed stretches are
+    subtracted the same way for the CharFreq file.
 
     Parameters:
         fasta_path:
             A path to the fasta file to remove data.
 
-        output_path:
-            The output path to save the resulting data. If no path in
-            specified than the output will be directed to stdout.
+        profile_path:
+            A path to the binary k-mer profile of the whole fasta file (counted
+            without a --min_count/--max_count filter).
+
+        output_dirs:
+            The output folder of each replicate.
+
+        seed_seqs:
+            The seed sequence of each replicate (see replicate_seed_seq).
+
+        kmer_ext:
+            Added to the name of the fasta file to get the name of the replicate
+            k-mer profiles.
 
         portion:
             The portion of data to remove. The default is a 40% reduction
@@ -544,83 +870,113 @@ def portion_remover2(fasta_path: str, output_path: str = None,
         chunk_size:
             The chunk size of the data to remove.
 
-        threads:
-            The number of threads used to remove the data.
-
         verbose:
             If true, runs the function in verbose mode.
     """
 
-    if threads == 0:
-        threads = os.cpu_count()
+    profile = load_Kmer_profile(profile_path)
+
+    if profile.flags & FLAG_SKETCH or profile.metadata.get('min_count', 1) > 1 or \
+            profile.metadata.get('max_count') is not None:
+        raise ValueError("Virtual replicates need the unfiltered k-mer profile of the whole fasta file, "
+                         "not " + profile_path)
 
-    if output_path is None:
-        output_path = sys.stdout
+    k = profile.k
+    canonical = bool(profile.flags & FLAG_CANONICAL)
 
     if verbose:
         print()
         print('Running on ' + os.path.basename(fasta_path) + ' with:')
-        print('\t' + 'output_path=' + output_path)
+        print('\t' + 'profile=' + profile_path)
+        print('\t' + 'replicates=' + str(len(output_dirs)))
         print('\t' + 'portion=' + str(portion * 100))
         print('\t' + 'chunk_size=' + str(chunk_size))
-        print('\t' + 'threads=' + str(threads))
         print()
+        print('Reading Data...')
 
-    # Create a lock for multi-threading later on
-    mutex = Lock()
+    records = [(description, np.frombuffer(seq, dtype=np.uint8))
+               for description, seq in read_fasta_records(fasta_path)]
 
-    if verbose:
-        print('Reading Data...')
+    num_Kmers = 0
 
-    # Open the fasta file as a dictionary
-    fasta_dict: Dict[str, SeqRecord.SeqRecord] = SeqIO.to_dict(
-        SeqIO.parse(fasta_path, "fasta"))
-
-    thread_args = [(fasta_dict, chunk_size, portion, seq_id, mutex) for
-                   fasta_dict, chunk_size, portion, seq_id, mutex in
-                   zip(
-        itertools.repeat(fasta_dict),
-        itertools.repeat(chunk_size),
-        itertools.repeat(portion),
-        fasta_dict.keys(),
-        itertools.repeat(mutex),
-    )]
-
-    num_args: int = len(thread_args)
-    progress: int = 0
+    for _, seq in records:
+        if len(seq) >= k:
+            invalid = np.concatenate(([0], np.cumsum(BASE_CODE_TABLE[seq] == 255)))
+            num_Kmers += int(np.count_nonzero(invalid[k:] == invalid[:-k]))
 
-    progress_intervals: list = list(range(0, 100, 10))
+    if num_Kmers != profile.total_count:
+        raise ValueError("The k-mer profile " + profile_path + " was not counted from " + fasta_path + ".")
 
-    if verbose:
-        print('Progress: ', flush=True, end='')
-        print()
+    name = os.path.basename(fasta_path)
 
-    with futures.ThreadPoolExecutor(threads) as executor:
-        submitted_results = executor.map(remove_chunks2, thread_args)
+    for output_dir, seed_seq in zip(output_dirs, seed_seqs):
 
-        for result in submitted_results:
-            _ = result
+        lost_codes: List[np.ndarray] = [np.zeros(0, dtype=np.uint64)]
+        new_codes: List[np.ndarray] = [np.zeros(0, dtype=np.uint64)]
+        kept_byte_counts = np.zeros(256, dtype=np.int64)
 
-            if verbose:
-                progress += 1
+        removed_path = os.path.join(output_dir, name + REMOVED_EXT)
 
-                progress_per = progress / num_args * 100
+        with open(removed_path + '.tmp', 'w') as removed_file:
 
-                while len(progress_intervals) > 0 and progress_per > progress_intervals[0]:
-                    print(str(progress_intervals.pop(0)) +
-                          '..', flush=True, end='')
+            for (description, seq), record_seed_seq in zip(records, seed_seq.spawn(len(records))):
 
-    if verbose:
-        print('100', flush=True)
-        print()
+                seq_len = len(seq)
+                num_chunks_rm, reduced_len = count_chunks_rm(seq_len, chunk_size, portion)
+
+                starts, ends = draw_removed_runs(seq_len, chunk_size, num_chunks_rm,
+                                                 np.random.default_rng(record_seed_seq))
 
-    record_list = []
+                seq_id = description.split(None, 1)[0] if description else ''
+                removed_file.writelines('{}\t{}\t{}\n'.format(seq_id, start, end)
+                                        for start, end in zip(starts, ends))
 
-    for rec_id, rec_val in zip(fasta_dict.keys(), fasta_dict.values()):
-        rec_val.id = rec_id
-        record_list.append(rec_val)
+                kept_starts, kept_ends = kept_runs(starts, ends, seq_len)
+                reduced_seq = np.concatenate([seq[start:end] for start, end in
+                                              zip(kept_starts.tolist(), kept_ends.tolist())])
+                kept_byte_counts += np.bincount(reduced_seq, minlength=256)
 
-    SeqIO.write(record_list, output_path, 'fasta')
+                # The k-mers of the whole sequence with a removed base
+                lost_codes.append(window_Kmer_codes(seq, np.maximum(starts - k + 1, 0),
+                                                    np.minimum(ends, seq_len - k + 1), k, canonical))
+
+                # The k-mers of the reduced sequence across a join, where each
+                # removed stretch (but one at the start) used to be
+                removed_lens = ends - starts
+                joins = starts - (np.cumsum(removed_lens) - removed_lens)
+                joins = joins[joins > 0]
+                new_codes.append(window_Kmer_codes(reduced_seq, np.maximum(joins - k + 1, 0),
+                                                   np.minimum(joins, reduced_len - k + 1), k, canonical))
+
+        lost = np.unique(np.concatenate(lost_codes), return_counts=True)
+        new = np.unique(np.concatenate(new_codes), return_counts=True)
+        del lost_codes, new_codes
+
+        try:
+            codes, counts = subtract_Kmer_counts(profile.codes, profile.counts, *lost, *new)
+        except ValueError as error:
+            raise ValueError(str(error) + " (" + profile_path + ", " + fasta_path + ")")
+
+        writer = KmerProfileWriter(os.path.join(output_dir, name + kmer_ext), k, flags=profile.flags)
+
+        for start in range(0, len(codes), PROFILE_BLOCK_SIZE):
+            writer.write(codes[start:start + PROFILE_BLOCK_SIZE], counts[start:start + PROFILE_BLOCK_SIZE])
+
+        metadata = dict(profile.metadata, source=name, virtual_jackknife={
+            'profile': os.path.basename(profile_path), 'portion': portion, 'chunk_size': chunk_size})
+        writer.close(metadata=metadata)
+
+        write_Character_Frequency(os.path.join(output_dir, name + '.CharFreq'),
+                                  kept_byte_counts, len(records), logging.getLogger(__name__))
+
+        # Mark the replicate as preprocessed (see calculate_d2s/run_preprocessing.py)
+        open(os.path.join(output_dir, name + '.done'), 'w').close()
+
+        os.replace(removed_path + '.tmp', removed_path)
+
+        if verbose:
+            print('Wrote ' + os.path.join(output_dir, name + kmer_ext) + ' (' + str(len(codes)) + ' k-mers, ' +
+                  str(lost[1].sum()) + ' lost, ' + str(new[1].sum()) + ' new)', flush=True)
 
     return
 
@@ -634,6 +990,47 @@ def run_jackknife(args):
         raise ValueError(
             "The number of threads must be strictly greater than -1.")
 
+    # Every replicate is seeded from this root, see replicate_seed_seq
+    seed_seq = np.random.SeedSequence(args.seed)
+
+    if args.verbose:
+        print('Seed: ' + str(seed_seq.entropy))
+
+    if args.replicates is not None:
+
+        if args.replicates < 1:
+            raise ValueError("The number of replicates must be at least 1.")
+
+        if args.output_path is None:
+            raise ValueError("The replicates need an --output_path to name their folders after.")
+
+        # Each replicate gets its own folder, e.g. Genomes_red_40_1,
+        # Genomes_red_40_2, ...
+        replicate_dirs = [os.path.normpath(args.output_path) + '_red_{:g}_{}'.format(args.portion, index)
+                          for index in range(args.first_index, args.first_index + args.replicates)]
+
+        for replicate_dir in replicate_dirs:
+            if not os.path.exists(replicate_dir):
+                os.makedirs(replicate_dir)
+
+        for path_in in args.input_paths:
+
+            if args.virtual:
+                virtual_replicate_remover(path_in, path_in + args.kmer_ext, replicate_dirs,
+                                          [replicate_seed_seq(seed_seq, path_in, index)
+                                           for index in range(args.first_index, args.first_index + args.replicates)],
+                                          kmer_ext=args.kmer_ext, portion=args.portion / 100,
+                                          chunk_size=args.chunk_size, verbose=args.verbose)
+                continue
+
+            replicate_remover(path_in, [os.path.join(replicate_dir, os.path.basename(path_in))
+                                        for replicate_dir in replicate_dirs],
+                              [replicate_seed_seq(seed_seq, path_in, index)
+                               for index in range(args.first_index, args.first_index + args.replicates)],
+                              portion=args.portion / 100, chunk_size=args.chunk_size,
+                              threads=args.threads, verbose=args.verbose)
+        return
+
     # Hold a list of all the file that need to be processed with there
     # respective output files
     to_complete: List[Tuple[str, str]] = []
@@ -656,9 +1053,17 @@ def run_jackknife(args):
 
     for path_in, path_out in to_complete:
 
-        portion_remover2(path_in, output_path=path_out,
-                         portion=args.portion / 100, chunk_size=args.chunk_size,
-                         threads=args.threads, verbose=args.verbose)
+        if args.virtual:
+            virtual_replicate_remover(path_in, path_in + args.kmer_ext, [output_path_dir],
+                                      [replicate_seed_seq(seed_seq, path_in, args.first_index)],
+                                      kmer_ext=args.kmer_ext, portion=args.portion / 100,
+                                      chunk_size=args.chunk_size, verbose=args.verbose)
+            continue
+
+        # A single reduced file is replicate first_index of the fasta file
+        replicate_remover(path_in, [path_out], [replicate_seed_seq(seed_seq, path_in, args.first_index)],
+                          portion=args.portion / 100, chunk_size=args.chunk_size,
+                          threads=args.threads, verbose=args.verbose)
     return
 
 
@@ -682,8 +1087,23 @@ def main():
                         help='The size of the chunks that get randomly removed from sequences.'
                         ' Default is a chunk size of 100.')
     parser.add_argument('--threads', type=int, required=False, default=1,
-                        help='The number of threads used to run the jackknife algorithm. '
+                        help='The number of processes used to run the jackknife algorithm. '
                         'If 0 threads are specified then it will default to os.cpu_count().')
+    parser.add_argument('--replicates', type=int, required=False, default=None,
+                        help='Write this many replicates, reading each fasta file only once. The replicates '
+                        'are written to OUTPUT_PATH_red_PORTION_INDEX folders (e.g. genomes_red_40_1).')
+    parser.add_argument('--first_index', type=int, required=False, default=1,
+                        help='The index of the first replicate (folder). Default is 1.')
+    parser.add_argument('--seed', type=int, required=False, default=None,
+                        help='The seed of the random numbers. Each replicate only depends on the seed, the name '
+                        'of the fasta file and the replicate index. Default is a random seed (printed with -v).')
+    parser.add_argument('--virtual', action='store_true', default=False,
+                        help='Instead of the reduced fasta files, write the k-mer profile, CharFreq and .done files '
+                        'of each replicate (and the removed stretches in a ' + REMOVED_EXT + ' file), derived from '
+                        'the k-mer profile of the whole fasta file.')
+    parser.add_argument('--kmer_ext', type=str, required=False, default='.21mer.nkp',
+                        help='Added to the fasta file names to get the k-mer profiles of --virtual. '
+                        'Default is .21mer.nkp.')
 
     args = parser.parse_args()
     run_jackknife(args)
@@ -2,12 +2,14 @@
 DESCRIPTION = '''
 Get the frequency of each character (e.g. number of A, T, G and C's) in a fasta file. 
 These numbers are required for calculationg the D2S statistic.
+
+The fasta file is read --block_size bytes at a time, so whole chromosomes are never held in
+memory. Lower case (soft-masked) bases are counted with the upper case ones.
 '''
 import sys
 import argparse
 import logging
 from D2S_tools import *
-from itertools import groupby
 
 ## Pass arguments.
 def main():
@@ -15,6 +17,7 @@ def main():
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
 	parser.add_argument('--fasta', metavar='input.fasta', type=lambda x: read_file_check_compression(x), required=True, help='Input fasta file, can be gziped')
 	parser.add_argument('--freq', metavar='input.fasta.chrFreq', type=lambda x: write_file_check_compression(x), required=True, help='Output character frequecny file, can be gziped')
+	parser.add_argument('--block_size', metavar='BYTES', type=int, required=False, default=1 << 24, help='Bytes of the fasta file read at a time (default: %(default)s)')
 	parser.add_argument('--debug', action='store_true', required=False, help='Print DEBUG info (default: %(default)s)')
 	args = parser.parse_args()
 	
@@ -28,12 +31,13 @@ def main():
 	logger.debug('%s', args) ## DEBUG
 	
 	char_set = {'A':0, 'C':0, 'G':0, 'T':0}
-	charcter_freq_from_fasta(args.fasta, args.freq, char_set, logger)
+	charcter_freq_from_fasta(args.fasta, args.freq, char_set, logger, block_size=args.block_size)
+	args.freq.close()
 	
 	
 
 
-def charcter_freq_from_fasta(in_fasta_fh, out_freq_fh, char_set, logger):
+def charcter_freq_from_fasta(in_fasta_fh, out_freq_fh, char_set, logger, block_size=1 << 24):
 	'''
 	Count the number of times each character in char_set are observed in the fasta file.
 	Write the frequecny of each character (char_count / total_chars)
@@ -46,14 +50,11 @@ def charcter_freq_from_fasta(in_fasta_fh, out_freq_fh, char_set, logger):
 	'''
 	
 	# Count the number of sequences. Used later on for calculating the number of Kmers.
-	totalSeqCount = 0
+	totalSeqCount, byte_counts = count_fasta_bytes(in_fasta_fh, block_size)
 	
-	for header, seq in fasta_iter(in_fasta_fh):
-		totalSeqCount += 1
-		seq.upper() # Convert seq to upper case.
-		
-		for char in char_set.keys():
-			char_set[char] += seq.count(char)
+	# Upper and lower case bases are counted together.
+	for char in char_set.keys():
+		char_set[char] += int(byte_counts[ord(char.upper())] + byte_counts[ord(char.lower())])
 	
 	# Get total number of characters across all sequences. 
 	totalChars = float(sum(char_set.itervalues()))
@@ -65,27 +66,50 @@ def charcter_freq_from_fasta(in_fasta_fh, out_freq_fh, char_set, logger):
 
 
 
-def fasta_iter(fh):
-    	"""
-    	Given a fasta file. yield tuples of header, sequence
-	Clears description from seq name.
-	
-	From: https://www.biostars.org/p/710/
-	Updated: 11/09/2018
-	Version: 0.2
-	"""
-    	# ditch the boolean (x[0]) and just keep the header or sequence since
-    	# we know they alternate.
-    	faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    	for header in faiter:
-        	# drop the ">" and description
-        	header = header.next()[1:].strip().split(' ')[0]
-        	# join all sequence lines to one.
-        	seq = "".join(s.strip() for s in faiter.next())
-        	yield header, seq
+def count_fasta_bytes(fh, block_size=1 << 24):
+	'''
+	Reads a fasta file block_size bytes at a time and counts how often each byte
+	value occurs in its sequences (header lines are skipped).
 	
+	Returns the number of sequences and the 256 byte counts.
+	'''
+	num_seqs = 0
+	byte_counts = np.zeros(256, dtype=np.int64)
 	
+	in_header = False
+	line_start = True # The next byte starts a line.
+	while True:
+		block = fh.read(block_size)
+		if not block:
+			break
+		
+		pos = 0
+		while pos < len(block):
+			if in_header:
+				# Skip to the end of the header line, which can be in a later block.
+				end = block.find(b'\n', pos)
+				if end < 0:
+					pos = len(block)
+					break
+				in_header = False
+				pos = end + 1
+				continue
+			
+			if (line_start if pos == 0 else block[pos - 1:pos] == b'\n') and block[pos:pos + 1] == b'>':
+				num_seqs += 1
+				in_header = True
+				continue
+			
+			# Count the sequence up to the next header line.
+			end = block.find(b'\n>', pos)
+			end = len(block) if end < 0 else end + 1
+			byte_counts += np.bincount(np.frombuffer(block, dtype=np.uint8, count=end - pos, offset=pos), minlength=256)
+			pos = end
+		
+		line_start = block.endswith(b'\n')
 	
+	return num_seqs, byte_counts
+
 
 
 if __name__ == '__main__':
@@ -3,7 +3,53 @@ Functions used by multiple scripts.
 '''
 import os
 import sys
+import zlib
 import gzip
+import json
+import bisect
+import shutil
+import struct
+import tempfile
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+# Block gzip files are concatenated gzip members holding up to BLOCK_GZIP_SIZE bytes each,
+# so zcat and gzip.open read them like any other gzip file. The members are compressed and
+# decompressed in parallel using the block index (file<BLOCK_INDEX_EXT>), little-endian:
+#   header : magic, version, number of blocks, size of the gzip file
+#   blocks : number of blocks x uint64 (compressed offset, uncompressed offset)
+BLOCK_GZIP_SIZE = 1 << 22
+BLOCK_INDEX_MAGIC = b'BGZI'
+BLOCK_INDEX_VERSION = 1
+BLOCK_INDEX_HEADER = struct.Struct('<4sHHQQ')
+BLOCK_INDEX_ENTRY = struct.Struct('<QQ')
+BLOCK_INDEX_EXT = '.bgzi'
+
+# Binary k-mer profile (*.nkp) layout, see calculate_d2s/D2S_tools.py.
+PROFILE_MAGIC = b'NKP1'
+PROFILE_VERSION = 1
+PROFILE_HEADER = struct.Struct('<4sHHIQQI')
+PROFILE_MAX_K = 32
+PROFILE_MAX_COUNT = (1 << 32) - 1
+
+# Profile flags.
+FLAG_CANONICAL = 1 << 0
+FLAG_SKETCH = 1 << 1
+
+# Sketches keep the kmers whose splitmix64 hash of the 2-bit packed code is below
+# 2^64 / sketch_scale (FracMinHash), see calculate_d2s/D2S_tools.py.
+SKETCH_SCALE = 1000
+SKETCH_HASH = 'splitmix64'
+MASK_64 = (1 << 64) - 1
+
+# Maps the (upper case) bases of a kmer_seq to their 2 bit codes, anything else to 255.
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+BASE_CODE_TABLE = np.full(256, 255, dtype=np.uint8)
+for base, base_code in BASE_CODES.items():
+	BASE_CODE_TABLE[ord(base)] = base_code
 
 def read_file_check_compression(arg):
         '''
@@ -14,6 +60,10 @@ def read_file_check_compression(arg):
         else:
                 ## open with gzip if it has the *.gz extension
                 if arg.endswith(".gz"):
+                        ## Block gzip files (see BlockGzipWriter) are decompressed in parallel.
+                        block_index = load_block_index(arg)
+                        if block_index is not None:
+                                return BlockGzipReader(arg, block_index)
                         return gzip.open(arg, 'rb')
                 else:
                         return open(arg, 'r')
@@ -34,11 +84,318 @@ def write_file_check_compression(arg):
         '''
         ## open with gzip if it has the *.gz extension
         if arg.endswith(".gz"):
-                return gzip.open(arg, 'wb')
+                return BlockGzipWriter(arg)
         else:
                 return open(arg, 'w')
 
 
+def codec_threads():
+	'''
+	Number of threads used to (de)compress block gzip files. The job scripts set
+	OMP_NUM_THREADS to the number of CPUs reserved, otherwise all CPUs are used.
+	'''
+	try:
+		return max(1, int(os.environ.get('OMP_NUM_THREADS', '')))
+	except ValueError:
+		return multiprocessing.cpu_count()
+
+
+def compress_gzip_block(data, level=6):
+	'''
+	Compresses data into one complete gzip member.
+	'''
+	compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+def decompress_gzip_block(fileName, offset, length):
+	'''
+	Reads and decompresses the gzip member at offset. Every call uses its own
+	file handle so blocks can be decompressed by several threads at once.
+	'''
+	with open(fileName, 'rb') as fh:
+		fh.seek(offset)
+		data = fh.read(length)
+
+	return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def write_block_index(fileName, blocks, compressed_size):
+	'''
+	Writes the (compressed offset, uncompressed offset) of each block of a block
+	gzip file to file<BLOCK_INDEX_EXT>.
+	'''
+	index_fileName = fileName + BLOCK_INDEX_EXT
+	tmp_fileName = '%s.%s.tmp' % (index_fileName, os.getpid())
+
+	with open(tmp_fileName, 'wb') as fh:
+		fh.write(BLOCK_INDEX_HEADER.pack(BLOCK_INDEX_MAGIC, BLOCK_INDEX_VERSION, 0,
+										 len(blocks), compressed_size))
+		for compressed_offset, uncompressed_offset in blocks:
+			fh.write(BLOCK_INDEX_ENTRY.pack(compressed_offset, uncompressed_offset))
+
+	os.rename(tmp_fileName, index_fileName)
+
+
+def load_block_index(fileName):
+	'''
+	Loads the block index of a block gzip file.
+
+	Returns a list of (compressed offset, compressed length, uncompressed offset) for
+	each block, or None if there is no index or the gzip file was changed after it.
+	'''
+	index_fileName = fileName + BLOCK_INDEX_EXT
+	if not os.path.exists(index_fileName):
+		return None
+
+	# The index is written after the gzip file is closed.
+	if os.path.getmtime(index_fileName) < os.path.getmtime(fileName):
+		return None
+
+	with open(index_fileName, 'rb') as fh:
+		header = fh.read(BLOCK_INDEX_HEADER.size)
+		if len(header) != BLOCK_INDEX_HEADER.size or not header.startswith(BLOCK_INDEX_MAGIC):
+			return None
+
+		magic, version, reserved, num_blocks, compressed_size = BLOCK_INDEX_HEADER.unpack(
+			header)
+		if version > BLOCK_INDEX_VERSION or compressed_size != os.path.getsize(fileName):
+			return None
+
+		entries = fh.read(BLOCK_INDEX_ENTRY.size * num_blocks)
+		if len(entries) != BLOCK_INDEX_ENTRY.size * num_blocks:
+			return None
+
+	offsets = [BLOCK_INDEX_ENTRY.unpack_from(entries, BLOCK_INDEX_ENTRY.size * i)
+			   for i in range(num_blocks)]
+	ends = [compressed_offset for compressed_offset, uncompressed_offset in offsets[1:]]
+	ends.append(compressed_size)
+
+	return [(compressed_offset, end - compressed_offset, uncompressed_offset)
+			for (compressed_offset, uncompressed_offset), end in zip(offsets, ends)]
+
+
+class BlockGzipWriter(object):
+	'''
+	Writes a gzip file as independently compressed blocks (gzip members) using a
+	pool of threads, plus a block index so the file can be read back in parallel.
+
+	The blocks are written in order, and at most 2 blocks per thread are held in
+	memory. The caller has to close the writer (or use it in a with statement),
+	which writes the last block and the block index.
+	'''
+
+	def __init__(self, fileName, block_size=BLOCK_GZIP_SIZE, threads=None, level=6):
+		self.name = fileName
+		self.mode = 'wb'
+		self.closed = False
+
+		self.block_size = block_size
+		self.level = level
+		self.threads = threads or codec_threads()
+
+		self.buffer = []
+		self.buffer_size = 0
+		self.pending = deque()
+		self.blocks = []
+		self.compressed_offset = 0
+		self.uncompressed_offset = 0
+
+		self.fh = open(fileName, 'wb')
+		self.pool = ThreadPool(self.threads)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def write(self, data):
+		if not isinstance(data, bytes):
+			data = data.encode('utf-8')
+
+		self.buffer.append(data)
+		self.buffer_size += len(data)
+
+		if self.buffer_size >= self.block_size:
+			self.submit_blocks()
+
+	def submit_blocks(self):
+		'''
+		Hands the buffered data to the thread pool in blocks of block_size.
+		'''
+		data = b''.join(self.buffer)
+		self.buffer = []
+		self.buffer_size = 0
+
+		for start in range(0, len(data), self.block_size):
+			block = data[start:start + self.block_size]
+			self.pending.append((len(block), self.pool.apply_async(
+				compress_gzip_block, (block, self.level))))
+
+			while len(self.pending) > 2 * self.threads:
+				self.write_block()
+
+	def write_block(self):
+		'''
+		Waits for the oldest pending block and appends it to the file.
+		'''
+		block_size, result = self.pending.popleft()
+		member = result.get()
+
+		self.fh.write(member)
+		self.blocks.append((self.compressed_offset, self.uncompressed_offset))
+		self.compressed_offset += len(member)
+		self.uncompressed_offset += block_size
+
+	def flush(self):
+		self.submit_blocks()
+		while self.pending:
+			self.write_block()
+		self.fh.flush()
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.flush()
+
+		# An empty file still needs one gzip member to be a valid gzip file.
+		if not self.blocks:
+			self.pending.append((0, self.pool.apply_async(compress_gzip_block, (b'', self.level))))
+			self.write_block()
+
+		self.closed = True
+		self.pool.close()
+		self.pool.join()
+		self.fh.close()
+
+		write_block_index(self.name, self.blocks, self.compressed_offset)
+
+
+class BlockGzipReader(object):
+	'''
+	Reads a block gzip file (see BlockGzipWriter). A pool of threads decompresses
+	up to read_ahead blocks ahead of the reader, in order. Supports read, readline,
+	iterating over lines, seek (using the block index) and tell, like gzip.open(..., 'rb').
+	'''
+
+	def __init__(self, fileName, block_index, threads=None, read_ahead=None):
+		self.name = fileName
+		self.mode = 'rb'
+		self.closed = False
+
+		self.block_index = block_index
+		self.block_starts = [uncompressed_offset for compressed_offset,
+							 compressed_length, uncompressed_offset in block_index]
+
+		self.threads = threads or codec_threads()
+		self.read_ahead = read_ahead or 2 * self.threads
+		self.pool = ThreadPool(self.threads)
+
+		self.seek(0)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def __iter__(self):
+		while True:
+			line = self.readline()
+			if not line:
+				break
+			yield line
+
+	def fill_read_ahead(self):
+		while len(self.pending) < self.read_ahead and self.next_block < len(self.block_index):
+			compressed_offset, compressed_length, uncompressed_offset = self.block_index[self.next_block]
+			self.pending.append(self.pool.apply_async(
+				decompress_gzip_block, (self.name, compressed_offset, compressed_length)))
+			self.next_block += 1
+
+	def read_block(self):
+		'''
+		Moves the next decompressed block into the buffer. Returns False at the end of the file.
+		'''
+		if not self.pending:
+			return False
+
+		block = self.pending.popleft().get()
+		self.fill_read_ahead()
+
+		# Only a partial line (see readline) is carried over into the new block.
+		if self.buffer_pos < len(self.buffer):
+			block = self.buffer[self.buffer_pos:] + block
+		self.buffer = block
+		self.buffer_pos = 0
+		return True
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.position
+		elif whence != 0:
+			raise ValueError('Block gzip files can only seek from the start or current position')
+
+		# Restart the read ahead from the block holding offset.
+		block = max(bisect.bisect_right(self.block_starts, offset) - 1, 0)
+
+		self.pending = deque()
+		self.next_block = block
+		self.buffer = b''
+		self.buffer_pos = 0
+		self.position = self.block_starts[block] if self.block_starts else 0
+		self.fill_read_ahead()
+
+		if offset > self.position:
+			self.read(offset - self.position)
+
+		return self.position
+
+	def tell(self):
+		return self.position
+
+	def read(self, size=-1):
+		pieces = []
+		remaining = size
+		while size < 0 or remaining > 0:
+			available = len(self.buffer) - self.buffer_pos
+			if not available:
+				if not self.read_block():
+					break
+				continue
+
+			piece_size = available if size < 0 else min(available, remaining)
+			pieces.append(self.buffer[self.buffer_pos:self.buffer_pos + piece_size])
+			self.buffer_pos += piece_size
+			remaining -= piece_size
+
+		data = b''.join(pieces)
+		self.position += len(data)
+
+		return data
+
+	def readline(self):
+		end = self.buffer.find(b'\n', self.buffer_pos)
+		while end < 0:
+			searched = len(self.buffer) - self.buffer_pos
+			if not self.read_block():
+				break
+			end = self.buffer.find(b'\n', searched)
+
+		return self.read(end + 1 - self.buffer_pos if end >= 0 else -1)
+
+	def close(self):
+		if self.closed:
+			return
+
+		self.closed = True
+		self.pending = deque()
+		self.pool.terminate()
+		self.pool.join()
+
+
 def pass_column_file(fh, sep='\t'):
 	'''
 	Takes a file with columns seperated by 'sep' and yields each line:
@@ -157,6 +514,158 @@ def iterate_Kmer_sets(KmerSet1_fh, KmerSet2_fh, logger, Both_KmerSets=True, Kmer
 
 
 
+def hash_Kmer_code(code, seed=0):
+	'''
+	splitmix64 hash of a 2-bit packed kmer code.
+	'''
+	z = (code + 0x9E3779B97F4A7C15 * (seed + 1)) & MASK_64
+	z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+	z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK_64
+	return z ^ (z >> 31)
+
+
+def hash_Kmer_codes(codes, seed=0):
+	'''
+	splitmix64 hash of an array of 2-bit packed kmer codes (see hash_Kmer_code).
+	'''
+	z = np.asarray(codes, dtype=np.uint64) + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & MASK_64)
+	z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+	z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+	return z ^ (z >> np.uint64(31))
+
+
+def column_bytes(buf, column_starts, width):
+	'''
+	Copies the width bytes starting at each of column_starts out of buf as a
+	(len(column_starts), width) array, using a view whose row i starts at buf[i].
+	'''
+	windows = np.lib.stride_tricks.as_strided(buf, shape=(len(buf) - width + 1, width), strides=(1, 1))
+	return windows[column_starts]
+
+
+class KmerSketch(object):
+	'''
+	Collects the FracMinHash sketch (about 1 in sketch_scale kmers) of a sorted
+	kmer file while it is being converted, and writes it as a binary kmer profile.
+	'''
+
+	def __init__(self, fileName, sketch_scale=SKETCH_SCALE, seed=0, canonical=False):
+		self.name = fileName
+		self.sketch_scale = sketch_scale
+		self.seed = seed
+		self.flags = FLAG_SKETCH | (FLAG_CANONICAL if canonical else 0)
+		self.threshold = (1 << 64) // sketch_scale
+
+		self.k = None
+		self.codes = []
+		self.counts = []
+		self.num_source_kmers = 0
+
+	def add(self, kmer_seq, kmer_code, kmer_count):
+		'''
+		Add the next kmer (in sorted order) of the kmer file.
+		'''
+		self.k = len(kmer_seq)
+		self.num_source_kmers += 1
+
+		if hash_Kmer_code(kmer_code, self.seed) < self.threshold:
+			self.codes.append(kmer_code)
+			self.counts.append(min(int(kmer_count), PROFILE_MAX_COUNT))
+
+	def add_codes(self, k, codes, counts):
+		'''
+		Add the next block of kmers (numpy arrays of codes and counts, in sorted order).
+		'''
+		self.k = k
+		self.num_source_kmers += len(codes)
+
+		keep = hash_Kmer_codes(codes, self.seed) < np.uint64(self.threshold)
+		self.codes.extend(int(code) for code in codes[keep])
+		self.counts.extend(int(count) for count in np.minimum(counts[keep], PROFILE_MAX_COUNT))
+
+	def close(self, metadata=None):
+		'''
+		Write the sketch.
+		'''
+		if self.k is not None and self.k > PROFILE_MAX_K:
+			sys.exit('ERROR: Binary kmer profiles support k <= %s (got %s)!' % (PROFILE_MAX_K, self.k))
+
+		metadata = dict(metadata or {})
+		metadata.update({'sketch_scale': self.sketch_scale, 'sketch_seed': self.seed,
+				 'sketch_hash': SKETCH_HASH, 'source_num_kmers': self.num_source_kmers})
+		meta = json.dumps(metadata, sort_keys=True).encode('utf-8')
+
+		with open(self.name, 'wb') as fh:
+			fh.write(PROFILE_HEADER.pack(PROFILE_MAGIC, PROFILE_VERSION, self.flags, self.k or 0,
+						     len(self.codes), sum(self.counts), len(meta)))
+			for values, fmt in ((self.codes, 'Q'), (self.counts, 'I')):
+				for start in range(0, len(values), 1 << 16):
+					block = values[start:start + (1 << 16)]
+					fh.write(struct.pack('<%s%s' % (len(block), fmt), *block))
+			fh.write(meta)
+
+
+class KmerProfileWriter(object):
+	'''
+	Writes a binary kmer profile one block of sorted codes and counts at a time.
+
+	The counts are spooled to a temporary file next to the output and appended
+	after the last block, so the number of kmers does not need to be known
+	up front.
+
+	Counts above PROFILE_MAX_COUNT are stored as PROFILE_MAX_COUNT, and the
+	total count in the header is the sum of the stored counts.
+	'''
+
+	def __init__(self, fileName, k, flags=0):
+		if not 0 < k <= PROFILE_MAX_K:
+			sys.exit('ERROR: Binary kmer profiles support k <= %s (got %s)!' % (PROFILE_MAX_K, k))
+
+		self.name = fileName
+		self.k = k
+		self.flags = flags
+		self.num_kmers = 0
+		self.total_count = 0
+		self.last_code = None
+
+		self.fh = open(fileName, 'wb')
+		self.fh.write(b'\0' * PROFILE_HEADER.size)
+		self.counts_fh = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(fileName)))
+
+	def write(self, codes, counts):
+		'''
+		Append a block of codes (sorted, strictly increasing) and their counts.
+		'''
+		codes = np.asarray(codes, dtype='<u8')
+		counts = np.asarray(counts)
+
+		if not len(codes):
+			return
+
+		# Check that every code is > the one before it, thus sorted correctly.
+		if np.any(codes[1:] <= codes[:-1]) or (self.last_code is not None and codes[0] <= self.last_code):
+			sys.exit('ERROR: Kmers written to %s are not sorted!' % self.name)
+		self.last_code = codes[-1]
+
+		self.fh.write(codes.tobytes())
+		counts = np.minimum(counts, PROFILE_MAX_COUNT).astype('<u4')
+		self.counts_fh.write(counts.tobytes())
+
+		self.num_kmers += len(codes)
+		self.total_count += int(counts.sum(dtype=np.uint64))
 
+	def close(self, metadata=None):
+		'''
+		Append the counts and metadata, then fill in the header.
+		'''
+		self.counts_fh.seek(0)
+		shutil.copyfileobj(self.counts_fh, self.fh, 1 << 24)
+		self.counts_fh.close()
 
+		meta = json.dumps(metadata or {}, sort_keys=True).encode('utf-8')
+		self.fh.write(meta)
 
+		self.fh.seek(0)
+		self.fh.write(PROFILE_HEADER.pack(PROFILE_MAGIC, PROFILE_VERSION, self.flags, self.k,
+						  self.num_kmers, self.total_count, len(meta)))
+		self.fh.close()
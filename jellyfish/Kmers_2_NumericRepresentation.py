@@ -11,8 +11,28 @@ NOTE - This acript assumes:
 
 Input kmer file: kmer_seq<\\t>kmer_count
 Output kmer file: kmer_value<\\t>kmer_seq<\\t>kmer_count
+
+With --sketch the FracMinHash sketch of the kmers (about 1 in sketch_scale kmers, as a
+binary kmer profile) is written in the same pass, for screening with Sketch_D2S.py.
+
+Use --canonical when the kmers were counted with jellyfish count -C (each kmer together with
+its reverse complement), so the sketch is marked as canonical.
+
+With --min_count and --max_count the kmers counted fewer or more times are dropped while streaming
+(e.g. --min_count 2 drops the singletons of read sets). The thresholds and the number and total
+count of the removed kmers are recorded in the sketch metadata. NumKmers (from the .CharFreq
+file) still includes the removed kmers, so the expected counts of the kept kmers do not change.
+
+With --profile all the kmers are also written as a binary kmer profile (like Convert_Kmer_Profile.py),
+and -o can be left out if only the profile is needed.
+
+The kmers are read and converted --block_size bytes at a time with numpy. Kmers longer than 32
+bases do not fit into the 64 bit codes and are converted one line at a time.
 '''
+import os
+import io
 import sys
+import itertools
 from D2S_tools import *
 import argparse
 import logging
@@ -22,7 +42,15 @@ def main():
 	# Pass command line arguments. 
 	parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=DESCRIPTION)
 	parser.add_argument('-i', '--in_kmers', metavar='input.txt', type=lambda x: read_file_check_compression(x), default=sys.stdin, required=False, help='Input kmer count file (sorter), can be gziped (default: stdin)')
-	parser.add_argument('-o', '--out_kmers', metavar='output.txt', type=lambda x: write_file_check_compression(x), required=True, help='Output kmer file, can be gziped')
+	parser.add_argument('-o', '--out_kmers', metavar='output.txt', type=lambda x: write_file_check_compression(x), required=False, default=None, help='Output kmer file, can be gziped')
+	parser.add_argument('--profile', metavar='output.nkp', type=str, required=False, default=None, help='Output binary kmer profile of all the kmers (default: no profile)')
+	parser.add_argument('--sketch', metavar='output.sketch.nkp', type=str, required=False, default=None, help='Output FracMinHash sketch of the kmers (default: no sketch)')
+	parser.add_argument('--sketch_scale', metavar='S', type=int, required=False, default=SKETCH_SCALE, help='Keep about 1 in S kmers in the sketch (default: %(default)s)')
+	parser.add_argument('--sketch_seed', metavar='SEED', type=int, required=False, default=0, help='Seed of the sketch hash, sketches are only comparable with the same seed (default: %(default)s)')
+	parser.add_argument('--canonical', action='store_true', required=False, default=False, help='The kmers are canonical (jellyfish count -C) (default: %(default)s)')
+	parser.add_argument('--min_count', metavar='N', type=int, required=False, default=1, help='Drop kmers counted fewer than N times (default: %(default)s)')
+	parser.add_argument('--max_count', metavar='N', type=int, required=False, default=None, help='Drop kmers counted more than N times (default: no limit)')
+	parser.add_argument('--block_size', metavar='BYTES', type=int, required=False, default=1 << 24, help='Bytes of the kmer count file converted at a time (default: %(default)s)')
 	parser.add_argument('--debug', action='store_true', required=False, help='Print DEBUG info (default: %(default)s)')
 	args = parser.parse_args()
 	
@@ -37,27 +65,56 @@ def main():
 	logger.debug('%s', args) ## DEBUG
 	
 	char_mapping = {'A':'0', 'C':'1','G':'2','T': '3'} # Chracter mapping for ATGC only
-	Kmers_2_NumbericRepresentation(args.in_kmers, args.out_kmers, char_mapping, logger=logger)
+	if args.sketch_scale < 1:
+		sys.exit('ERROR: --sketch_scale has to be at least 1!')
+	if args.min_count < 1 or (args.max_count is not None and args.max_count < args.min_count):
+		sys.exit('ERROR: --min_count has to be at least 1 and at most --max_count!')
+	if args.out_kmers is None and args.profile is None:
+		sys.exit('ERROR: Give an output kmer file (-o) and/or a binary kmer profile (--profile)!')
+	sketch = KmerSketch(args.sketch, args.sketch_scale, args.sketch_seed, args.canonical) if args.sketch else None
+	profile_flags = FLAG_CANONICAL if args.canonical else 0
+	
+	removed_num_kmers, removed_total_count, profile = Kmers_2_NumbericRepresentation_Blocks(args.in_kmers, args.out_kmers, char_mapping, logger=logger, sketch=sketch, profile_fileName=args.profile, profile_flags=profile_flags, min_count=args.min_count, max_count=args.max_count, block_size=args.block_size)
+	if args.out_kmers is not None:
+		args.out_kmers.close()
+	
+	logger.info('Removed %s kmers (total count %s) outside the count range [%s, %s]', removed_num_kmers, removed_total_count, args.min_count, args.max_count) ## INFO
 	
+	metadata = {'source': os.path.basename(args.out_kmers.name if args.out_kmers is not None else getattr(args.in_kmers, 'name', '<stdin>')), 'canonical': args.canonical}
+	if args.min_count > 1 or args.max_count is not None:
+		metadata.update({'min_count': args.min_count, 'max_count': args.max_count, 'removed_num_kmers': removed_num_kmers, 'removed_total_count': removed_total_count})
 	
+	if sketch is not None:
+		sketch.close(metadata=metadata)
+	if profile is not None:
+		profile.close(metadata=metadata)
 	
 	
 	
 	
-def Kmers_2_NumbericRepresentation(input_kmer_file, output_kmer_file, char_mapping, logger, sep='\t'):
+	
+	
+def Kmers_2_NumbericRepresentation(input_kmer_file, output_kmer_file, char_mapping, logger, sep='\t', sketch=None, min_count=1, max_count=None):
 	'''
 	Convert kmer_seq into a numberic representation.
 	Check that kmmer_value is > last kmer_value, thus file is sorted correctly. 
+	Kmers are also added to the sketch (KmerSketch) if one is given.
+	Kmers counted fewer than min_count or more than max_count times are dropped.
+	
+	Returns the number and total count of the dropped kmers.
 	'''
 	
 	last_kmer_value = -1
+	removed_num_kmers = 0
+	removed_total_count = 0
 	
 	for kmer_seq, kmer_count in pass_column_file(input_kmer_file, sep):
 		kmer_seq.upper() # Convert to upper case.
 		
 		logger.debug('%s\t%s', kmer_seq, kmer_count) ## DEBUG
 		
-		kmer_value = int(''.join([char_mapping[base] for base in list(kmer_seq)]))
+		kmer_digits = ''.join([char_mapping[base] for base in list(kmer_seq)])
+		kmer_value = int(kmer_digits)
 		
 		logger.debug('kmer value: %s', kmer_value) ## DEBUG
 		
@@ -66,7 +123,173 @@ def Kmers_2_NumbericRepresentation(input_kmer_file, output_kmer_file, char_mappi
 		
 		last_kmer_value = kmer_value
 		
+		if int(kmer_count) < min_count or (max_count is not None and int(kmer_count) > max_count):
+			removed_num_kmers += 1
+			removed_total_count += int(kmer_count)
+			continue
+		
 		output_kmer_file.write(str(kmer_value) + '\t' + kmer_seq + '\t' + kmer_count + '\n')
+		
+		if sketch is not None:
+			sketch.add(kmer_seq, int(kmer_digits, 4), kmer_count) # The base 4 digits are the 2-bit packed code.
+	
+	return removed_num_kmers, removed_total_count
+
+
+
+def Kmers_2_NumbericRepresentation_Blocks(input_kmer_file, output_kmer_file, char_mapping, logger, sketch=None, profile_fileName=None, profile_flags=0, min_count=1, max_count=None, block_size=1 << 24):
+	'''
+	Same as Kmers_2_NumbericRepresentation, but reads block_size bytes at a time and
+	converts all the kmers of a block at once with numpy. The output is the same byte
+	for byte. Kmers are also written to a binary kmer profile (KmerProfileWriter) if
+	profile_fileName is given, once the kmer size is known.
+	
+	Returns the number and total count of the dropped kmers, and the (open) KmerProfileWriter or None.
+	'''
+	
+	# The kmer size is the length of the kmer_seq of the first kmer line.
+	head = []
+	for line in iter(input_kmer_file.readline, ''):
+		head.append(line)
+		if line.strip() and not line.startswith('#'):
+			break
+	
+	if not head:
+		if profile_fileName is not None:
+			sys.exit('ERROR: No kmers to write a binary kmer profile of!')
+		return 0, 0, None
+	k = len(head[-1].strip().split('\t')[0])
+	
+	profile = KmerProfileWriter(profile_fileName, k, flags=profile_flags) if profile_fileName is not None else None
+	
+	if k > PROFILE_MAX_K:
+		logger.info('k-mer:%s is too long for 64 bit codes, converting one line at a time', k) ## INFO
+		removed_num_kmers, removed_total_count = Kmers_2_NumbericRepresentation(itertools.chain(head, input_kmer_file), output_kmer_file, char_mapping, logger, sketch=sketch, min_count=min_count, max_count=max_count)
+		return removed_num_kmers, removed_total_count, None
+	
+	last_code = None
+	removed_num_kmers = 0
+	removed_total_count = 0
+	
+	rest = ''.join(head)
+	while True:
+		block = input_kmer_file.read(block_size)
+		
+		if block:
+			# Only convert up to the last complete line, keep the rest for the next block.
+			end = block.rfind('\n') + 1
+			if not end:
+				rest += block
+				continue
+			lines, rest = rest + block[:end], block[end:]
+		elif rest:
+			lines, rest = rest + '\n', ''
+		else:
+			break
+		
+		buf = np.frombuffer(lines, dtype=np.uint8)
+		
+		ends = np.flatnonzero(buf == ord('\n'))
+		starts = np.concatenate(([0], ends[:-1] + 1))
+		
+		# Drop the '\r' of Windows line endings, ignore blank and comment lines.
+		ends = ends - (buf[np.maximum(ends - 1, 0)] == ord('\r')) * (ends > starts)
+		keep = (ends > starts) & (buf[np.minimum(starts, len(buf) - 1)] != ord('#'))
+		starts, ends = starts[keep], ends[keep]
+		if not len(starts):
+			continue
+		
+		# Every line is kmer_seq<\t>kmer_count, with a kmer_seq of k bases.
+		tabs = np.flatnonzero(buf == ord('\t'))
+		if len(tabs) != len(starts) or np.any(tabs != starts + k) or np.any(ends <= tabs + 1):
+			sys.exit('ERROR: Kmer lines are not all kmer_seq<\\t>kmer_count with a kmer_seq of length %s!' % k)
+		
+		base_codes = BASE_CODE_TABLE[column_bytes(buf, starts, k)]
+		if np.any(base_codes == 255):
+			sys.exit('ERROR: Kmers contain bases other than ATGC!')
+		
+		codes = np.zeros(len(starts), dtype=np.uint64)
+		for i in range(k):
+			codes <<= np.uint64(2)
+			codes |= base_codes[:, i]
+		
+		# Break if a kmer has a value <= the kmer before it.
+		if np.any(codes[1:] <= codes[:-1]) or (last_code is not None and codes[0] <= last_code):
+			sys.exit("Kmers not sorted")
+		last_code = codes[-1]
+		
+		counts = None
+		if sketch is not None or profile is not None or min_count > 1 or max_count is not None:
+			counts = parse_Kmer_counts(buf, tabs + 1, ends)
+		
+		if counts is not None and (min_count > 1 or max_count is not None):
+			kept = counts >= min_count
+			if max_count is not None:
+				kept &= counts <= max_count
+			removed_num_kmers += int(len(kept) - np.count_nonzero(kept))
+			removed_total_count += int(counts[~kept].sum())
+			
+			base_codes, codes, counts = base_codes[kept], codes[kept], counts[kept]
+			starts, ends = starts[kept], ends[kept]
+		
+		if output_kmer_file is not None and len(starts):
+			output_kmer_file.write(Kmer_lines(buf, base_codes, starts, ends))
+		
+		if sketch is not None:
+			sketch.add_codes(k, codes, counts)
+		if profile is not None:
+			profile.write(codes, counts)
+	
+	return removed_num_kmers, removed_total_count, profile
+
+
+
+def parse_Kmer_counts(buf, count_starts, count_ends):
+	'''
+	Parses the kmer_count columns (buf[count_starts[i]:count_ends[i]]) of a block.
+	'''
+	num_digits = count_ends - count_starts
+	max_digits = int(num_digits.max())
+	if max_digits > 18:
+		sys.exit('ERROR: Kmer counts are too large!')
+	
+	# Right align the digits and add them up by their place value.
+	digits = column_bytes(buf, count_ends - max_digits, max_digits).astype(np.int64) - ord('0')
+	has_digit = np.arange(max_digits, 0, -1) <= num_digits[:, None]
+	if np.any(has_digit & ((digits < 0) | (digits > 9))):
+		sys.exit('ERROR: Kmer counts are not integers!')
+	
+	return np.where(has_digit, digits, 0).dot(10 ** np.arange(max_digits - 1, -1, -1, dtype=np.int64))
+
+
+
+def Kmer_lines(buf, base_codes, starts, ends):
+	'''
+	Builds the kmer_value<\t>kmer_seq<\t>kmer_count output lines of a block. The
+	kmer_value is the base 4 digits of the kmer without leading zeros (0 if all
+	bases are A), followed by the input line buf[starts[i]:ends[i]].
+	'''
+	num_kmers, k = base_codes.shape
+	
+	# The digits of each kmer_value followed by a tab, one row per kmer.
+	digits = np.empty((num_kmers, k + 1), dtype=np.uint8)
+	digits[:, :k] = base_codes + ord('0')
+	digits[:, k] = ord('\t')
+	
+	nonzero = base_codes != 0
+	first_digit = np.where(nonzero.any(axis=1), nonzero.argmax(axis=1), k - 1)
+	
+	# Gather the value, the input line and a newline for each kmer from one buffer.
+	source = np.concatenate((digits.ravel(), buf, np.array([ord('\n')], dtype=np.uint8)))
+	range_starts = np.column_stack((np.arange(num_kmers) * (k + 1) + first_digit,
+					digits.size + starts,
+					np.full(num_kmers, len(source) - 1))).ravel()
+	range_lengths = np.column_stack((k + 1 - first_digit, ends - starts, np.ones(num_kmers, dtype=np.int64))).ravel()
+	
+	offsets = np.cumsum(range_lengths) - range_lengths
+	index = np.repeat(range_starts - offsets, range_lengths) + np.arange(int(range_lengths.sum()))
+	
+	return source[index].tobytes()
 
 
 
@@ -5,8 +5,33 @@
 
 file=sequence.fa
 k=21
+# Set canonical=1 to count each kmer together with its reverse complement (about half the kmers).
+canonical=0
+# Set min_count=2 to drop the singleton kmers (mostly sequencing errors in read sets).
+min_count=1
+# Set counter=numpy to count the kmers with calculate_d2s/Count_Kmers.py straight into a binary
+# kmer profile, instead of the jellyfish hash, dump and sort. Set counter=jf to count with jellyfish
+# and convert the .jf file with calculate_d2s/Jellyfish_2_Profile.py, skipping the dump and sort.
+counter=jellyfish
+
+count_opts=""
+numeric_opts=""
+if [ "$canonical" = 1 ]; then
+	count_opts="-C"
+	numeric_opts="--canonical"
+fi
+numeric_opts="$numeric_opts --min_count $min_count"
 
 echo "## File:" $file
-jellyfish count -m $k -s $s -t $NCPUS -o $file.$k.jf $file
-jellyfish dump -ct $file.$k.jf | sort -k1,1 | python2 Kmers_2_NumericRepresentation.py -o $file.${k}mer.nkc.gz
-python2 Composition_of_InputSeqs.py --fasta $file --freq $file.CharFreq
\ No newline at end of file
+if [ "$counter" = numpy ]; then
+	# One read of the fasta file writes the kmer profile, the CharFreq file and the .done marker.
+	python2 ../calculate_d2s/Count_Kmers.py --fasta $file -k $k -o $file.${k}mer.nkp --freq $file.CharFreq --done $file.done $numeric_opts
+elif [ "$counter" = jf ]; then
+	jellyfish count $count_opts -m $k -s $s -t $NCPUS -o $file.$k.jf $file
+	python2 ../calculate_d2s/Jellyfish_2_Profile.py --jf $file.$k.jf -o $file.${k}mer.nkp --min_count $min_count
+	python2 Composition_of_InputSeqs.py --fasta $file --freq $file.CharFreq
+else
+	jellyfish count $count_opts -m $k -s $s -t $NCPUS -o $file.$k.jf $file
+	jellyfish dump -ct $file.$k.jf | sort -k1,1 | python2 Kmers_2_NumericRepresentation.py -o $file.${k}mer.nkc.gz --sketch $file.${k}mer.sketch.nkp $numeric_opts
+	python2 Composition_of_InputSeqs.py --fasta $file --freq $file.CharFreq
+fi
\ No newline at end of file